@@ -0,0 +1,517 @@
+"""
+Offline evaluation of the classification paths on a labelled JSONL corpus of {"text": ..., "label": ...} records.
+
+The labels are the topics of a synthetic chat. `--shots` messages of every topic are its history, the mean of
+their embeddings is the topic centroid; the other messages are classified by every path:
+
+* `gpt:<model>`    - GptClassifier with the model as its only cascade step;
+* `centroid:names` - the nearest centroid of a new chat, seeded from the embedded topic names, always accepted;
+* `centroid`       - the nearest centroid of the history, always accepted;
+* `hybrid@s/m`     - the bot's path: a centroid prediction with similarity >= s and margin >= m (and at least
+  `--min-count` history messages) is accepted, other messages go to `--hybrid-model` with the centroid guess as
+  the 'local' cascade step; one path per pair of `--similarities` and `--margins`.
+
+The local paths run the production CentroidClassifier on the embeddings of `emb_model_name` (the model must be in
+the local cache, otherwise they are skipped); `--embedder hash` uses a bag-of-words stand-in to try the harness
+without the model, its accuracy means nothing. The GPT paths never need a key with `--api fake` or `replay`:
+
+* `fake`   - every model answers the gold label with its accuracy after a log-normal delay around its median,
+  `--models gpt-3.5-turbo-0125:0.85:600 gpt-4o:0.95:1200` (model[:accuracy[:latency_ms]]);
+* `record` - the real API; the responses and their latencies are appended to `--recordings`;
+* `replay` - the recorded responses, keyed by model and prompt, after their recorded latency times `--time-scale`.
+
+Reported per path are accuracy, macro recall, throughput with `--concurrency` messages in flight, p50/p95
+latency per message (the GPT paths don't embed, the others include the embedding), the share sent to GPT, tokens
+and USD per 1000 messages at the `usage_prices`. Paths that no other path beats on accuracy, cost and p95 at once
+are marked `*` and drawn as the Pareto frontier with `--plot` (needs matplotlib):
+
+    python -m benchmarks.classifier_eval --api fake --similarities 0.4 0.5 0.6 --margins 0.05 0.1 --plot pareto.png
+    python -m benchmarks.classifier_eval --api record --recordings benchmarks/results/gpt_recordings.jsonl
+    python -m benchmarks.classifier_eval --api replay --recordings benchmarks/results/gpt_recordings.jsonl --per-label
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import defaultdict
+from itertools import product
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+
+BENCH_USER_ID = -1
+BENCH_CHAT_ID = -1
+
+
+def load_corpus(path: str) -> List[Tuple[str, str]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [(record['text'], record['label']) for record in map(json.loads, filter(str.strip, f))]
+
+
+def split_corpus(corpus: List[Tuple[str, str]], shots: int, seed: int) -> Tuple[Dict[str, List[str]], List[Tuple[str, str]]]:
+    """Picks `shots` random messages of every topic but 'unknown' as its history; the rest is evaluated."""
+    rng = np.random.default_rng(seed)
+    by_label = defaultdict(list)
+
+    for text, label in corpus:
+        by_label[label].append(text)
+
+    history, evaluated = {}, []
+
+    for label in sorted(by_label):
+        texts = [by_label[label][i] for i in rng.permutation(len(by_label[label]))]
+        n = 0 if label == 'unknown' else min(shots, len(texts) - 1)
+        history[label] = texts[:n]
+        evaluated.extend((text, label) for text in texts[n:])
+
+    return history, evaluated
+
+
+def parse_model(spec: str, accuracy: float, latency_ms: float) -> Tuple[str, float, float]:
+    """Parses 'model[:accuracy[:latency_ms]]'; model names may contain colons only without the other fields."""
+    parts = spec.split(':')
+
+    try:
+        if len(parts) >= 3:
+            return ':'.join(parts[:-2]), float(parts[-2]), float(parts[-1])
+
+        if len(parts) == 2:
+            return parts[0], float(parts[1]), latency_ms
+    except ValueError:
+        pass
+
+    return spec, accuracy, latency_ms
+
+
+def fake_completion(content: str, prompt_tokens: int, completion_tokens: int = 1) -> SimpleNamespace:
+    """A chat completion response with the fields GptClassifier reads."""
+    return SimpleNamespace(
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens),
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+
+
+def recording_key(model: str, prompt: str) -> str:
+    return hashlib.sha1(f'{model}\n{prompt}'.encode('utf-8')).hexdigest()
+
+
+class FakeCompletions:
+    """
+    Answers a prompt with its gold label with the model's accuracy, otherwise with another label, after a
+    log-normal delay around the model's median. Answers are deterministic per model and prompt.
+    """
+
+    def __init__(self, gold: Dict[str, Tuple[str, int]], labels: List[str], models: Dict[str, Tuple[float, float]],
+                 time_scale: float, seed: int = 0):
+        self.gold = gold
+        self.labels = labels
+        self.models = models
+        self.time_scale = time_scale
+        self.seed = seed
+
+    async def create(self, model: str, messages: List[Dict], **kwargs) -> SimpleNamespace:
+        prompt = messages[0]['content']
+        label, prompt_tokens = self.gold[prompt]
+        accuracy, latency_ms = self.models[model]
+        rng = np.random.default_rng([self.seed, zlib.crc32(recording_key(model, prompt).encode())])
+
+        await asyncio.sleep(float(rng.lognormal(np.log(latency_ms / 1000), 0.35)) * self.time_scale)
+
+        if rng.random() >= accuracy:
+            label = str(rng.choice([other for other in self.labels if other != label]))
+
+        # the chat message framing adds a few prompt tokens
+        return fake_completion(label, prompt_tokens + 7)
+
+
+class RecordedCompletions:
+    """Replays recorded responses after their recorded latency; a prompt without a recording fails the request."""
+
+    def __init__(self, path: str, time_scale: float):
+        self.time_scale = time_scale
+        self.responses = {}
+        self.missing = 0
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for record in map(json.loads, filter(str.strip, f)):
+                self.responses[record['key']] = record
+
+    async def create(self, model: str, messages: List[Dict], **kwargs) -> SimpleNamespace:
+        record = self.responses.get(recording_key(model, messages[0]['content']))
+
+        if record is None:
+            self.missing += 1
+            raise LookupError(f'No recorded response of {model} to this prompt')
+
+        await asyncio.sleep(record['latency_ms'] / 1000 * self.time_scale)
+
+        return fake_completion(record['content'], record['prompt_tokens'], record['completion_tokens'])
+
+
+class RecordingCompletions:
+    """Calls the real API and appends every response with its latency to the recordings file."""
+
+    def __init__(self, completions, path: str):
+        self.completions = completions
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    async def create(self, model: str, messages: List[Dict], **kwargs):
+        start = time.perf_counter()
+        response = await self.completions.create(model=model, messages=messages, **kwargs)
+        record = {
+            'key': recording_key(model, messages[0]['content']),
+            'model': model,
+            'content': response.choices[0].message.content,
+            'prompt_tokens': response.usage.prompt_tokens,
+            'completion_tokens': response.usage.completion_tokens,
+            'latency_ms': round((time.perf_counter() - start) * 1000, 1)
+        }
+
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        return response
+
+
+class HashEmbedder:
+    """Hashed bag of words, normalised; only a stand-in to try the harness without the embedding model."""
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.model = self
+
+    def encode(self, text: str) -> np.ndarray:
+        emb = np.zeros(self.dim, dtype=np.float32)
+
+        for word in text.lower().split():
+            emb[zlib.crc32(word.strip('.,:;!?()«»"\'').encode()) % self.dim] += 1
+
+        norm = np.linalg.norm(emb)
+
+        return emb / norm if norm > 0 else emb
+
+
+def load_embedder(name: str):
+    if name == 'hash':
+        return HashEmbedder()
+
+    from src.config import EMBEDDER_OPTIONS
+    from src.models.embedder import TextEmbedder
+
+    return TextEmbedder(name or EMBEDDER_OPTIONS['model_name'])
+
+
+def make_classifier(topics: Dict[str, int], cascade: List[Tuple[str, float]], completions):
+    from src.models.gpt_classifier import GptClassifier
+
+    classifier = GptClassifier(topics)
+    classifier.cascade = cascade
+    classifier.timelimit = cascade[0][1]
+
+    if completions is not None:
+        classifier.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    return classifier
+
+
+def seed_centroids(history: Dict[str, List[str]], topics: Dict[str, int], embed: Callable[[str], np.ndarray],
+                   from_names: bool):
+    """Puts the bench chat's centroids into the CentroidClassifier, so that predictions never touch the database."""
+    from src.models.centroid_classifier import CentroidClassifier, ChatCentroids
+
+    chat = None
+
+    for name, topic_id in topics.items():
+        if name == 'unknown':
+            continue
+
+        texts = history.get(name) if not from_names else None
+        embs = np.stack([embed(text) for text in texts]) if texts else embed(name)[None, :]
+
+        if chat is None:
+            chat = ChatCentroids(embs.shape[1])
+
+        chat.set(topic_id, 0 if not texts else len(texts), embs.mean(axis=0))
+
+    CentroidClassifier()._chats[(BENCH_USER_ID, BENCH_CHAT_ID)] = chat
+
+
+async def run_path(evaluated: List[Tuple[str, str]], classify, concurrency: int) -> List[Dict]:
+    """Classifies the messages `concurrency` at a time; `classify(i, text)` returns the outcome of a message."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(i: int, text: str) -> Dict:
+        async with semaphore:
+            start = time.perf_counter()
+            outcome = await classify(i, text)
+            outcome['latency_ms'] = (time.perf_counter() - start) * 1000
+
+            return outcome
+
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*[timed(i, text) for i, (text, _) in enumerate(evaluated)])
+    wall = time.perf_counter() - start
+
+    for outcome in outcomes:
+        outcome['wall_s'] = wall
+
+    return outcomes
+
+
+def gpt_outcome(result: Dict) -> Dict:
+    return {
+        'msg_class': result['msg_class'], 'gpt': result['requests'] > 0, 'model': result['model'],
+        'prompt_tokens': result['prompt_tokens'], 'completion_tokens': result['completion_tokens']
+    }
+
+
+def cost(model: Optional[str], prompt_tokens: int, completion_tokens: int, prices: Dict, unpriced: set) -> float:
+    if not model or model == 'local':
+        return 0.0
+
+    if model not in prices:
+        unpriced.add(model)
+        return 0.0
+
+    prompt_price, completion_price = prices[model]
+
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def summarize(outcomes: List[Dict], evaluated: List[Tuple[str, str]], prices: Dict, unpriced: set) -> Dict:
+    gold = [label for _, label in evaluated]
+    predicted = [outcome['msg_class'] for outcome in outcomes]
+    latencies = [outcome['latency_ms'] for outcome in outcomes]
+    tokens = sum(outcome.get('prompt_tokens', 0) + outcome.get('completion_tokens', 0) for outcome in outcomes)
+    usd = sum(
+        cost(outcome.get('cost_model'), outcome.get('prompt_tokens', 0), outcome.get('completion_tokens', 0), prices, unpriced)
+        for outcome in outcomes
+    )
+    recalls = {
+        label: np.mean([p == label for p, g in zip(predicted, gold) if g == label]) for label in sorted(set(gold))
+    }
+    n = len(outcomes)
+
+    return {
+        'accuracy': float(np.mean([p == g for p, g in zip(predicted, gold)])),
+        'recall': float(np.mean(list(recalls.values()))),
+        'msgs_per_s': n / outcomes[0]['wall_s'],
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'gpt_share': float(np.mean([outcome['gpt'] for outcome in outcomes])),
+        'tokens_per_1k': tokens / n * 1000,
+        'usd_per_1k': usd / n * 1000,
+        'failed': sum(p is None for p in predicted),
+        'per_label': {label: float(recall) for label, recall in recalls.items()}
+    }
+
+
+def pareto(rows: Dict[str, Dict]) -> List[str]:
+    """Paths that no other path matches or beats on accuracy, cost and p95 latency while beating it on one."""
+    def dominates(a: Dict, b: Dict) -> bool:
+        no_worse = a['accuracy'] >= b['accuracy'] and a['usd_per_1k'] <= b['usd_per_1k'] and a['p95_ms'] <= b['p95_ms']
+        better = a['accuracy'] > b['accuracy'] or a['usd_per_1k'] < b['usd_per_1k'] or a['p95_ms'] < b['p95_ms']
+        return no_worse and better
+
+    return [name for name, row in rows.items() if not any(dominates(other, row) for other in rows.values() if other is not row)]
+
+
+def print_table(rows: Dict[str, Dict], optimal: List[str], per_label: bool):
+    print(f'\n{"path":<28} {"acc":>6} {"recall":>6} {"msg/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"gpt %":>6} '
+          f'{"tok/1k":>9} {"usd/1k":>8} {"failed":>6}')
+
+    for name, row in rows.items():
+        print(f'{name:<26}{"*" if name in optimal else " ":>2} {row["accuracy"]:>6.3f} {row["recall"]:>6.3f} '
+              f'{row["msgs_per_s"]:>8.1f} {row["p50_ms"]:>8.1f} {row["p95_ms"]:>8.1f} {row["gpt_share"] * 100:>6.1f} '
+              f'{row["tokens_per_1k"]:>9.0f} {row["usd_per_1k"]:>8.4f} {row["failed"]:>6}')
+
+    if per_label:
+        labels = sorted({label for row in rows.values() for label in row['per_label']})
+        print(f'\n{"recall per label":<28} ' + ' '.join(f'{label[:11]:>11}' for label in labels))
+
+        for name, row in rows.items():
+            print(f'{name:<28} ' + ' '.join(f'{row["per_label"].get(label, 0):>11.3f}' for label in labels))
+
+
+def plot(rows: Dict[str, Dict], optimal: List[str], path: str):
+    """Draws accuracy against cost and against p95 latency, with the Pareto-optimal paths joined."""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print(f'matplotlib is not installed, {path} not drawn')
+        return
+
+    fig, axes = plt.subplots(1, 2, figsize=(13, 5), sharey=True)
+
+    for ax, key, xlabel in ((axes[0], 'usd_per_1k', 'USD per 1000 messages'), (axes[1], 'p95_ms', 'p95 latency, ms')):
+        for name, row in rows.items():
+            ax.scatter(row[key], row['accuracy'], color='tab:red' if name in optimal else 'tab:blue', zorder=3)
+            ax.annotate(name, (row[key], row['accuracy']), fontsize=7, xytext=(4, 3), textcoords='offset points')
+
+        frontier = sorted((rows[name][key], rows[name]['accuracy']) for name in optimal)
+        best, points = -1.0, []
+
+        # the frontier of this projection: the optimal paths that improve accuracy as the axis grows
+        for x, accuracy in frontier:
+            if accuracy > best:
+                best = accuracy
+                points.append((x, accuracy))
+
+        ax.step(*zip(*points), where='post', color='tab:red', alpha=0.5)
+        ax.set_xlabel(xlabel)
+        ax.grid(alpha=0.3)
+
+    axes[0].set_ylabel('accuracy')
+    fig.suptitle('Classification paths, Pareto-optimal in red')
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+    print(f'plot written to {path}')
+
+
+async def run(args):
+    from src.config import GPT_POLICY_OPTIONS, USAGE_OPTIONS, CENTROID_OPTIONS
+    from src.models.centroid_classifier import CentroidClassifier
+
+    corpus = load_corpus(args.corpus)
+    labels = sorted({label for _, label in corpus})
+    topics = {name: 1000 + i for i, name in enumerate(labels)}
+    history, evaluated = split_corpus(corpus, args.shots, args.seed)
+    timeout = args.timeout or GPT_POLICY_OPTIONS['cascade'][0][1]
+    models = [parse_model(spec, args.fake_accuracy, args.fake_latency_ms) for spec in args.models]
+    hybrid_model = args.hybrid_model or models[0][0]
+    prices, unpriced = USAGE_OPTIONS['prices'], set()
+
+    print(f'{len(corpus)} messages, {len(labels)} topics, {sum(map(len, history.values()))} history, '
+          f'{len(evaluated)} evaluated; api={args.api} concurrency={args.concurrency}')
+
+    completions = None
+    probe = make_classifier(topics, [(models[0][0], timeout)], None)
+
+    if args.api == 'fake':
+        gold = {}
+
+        for text, label in evaluated:
+            prompt, prompt_tokens = probe.prompt_builder.build(topics, text)
+            gold[prompt] = (label, prompt_tokens)
+
+        profiles = {name: (accuracy, latency_ms) for name, accuracy, latency_ms in models}
+        profiles.setdefault(hybrid_model, (args.fake_accuracy, args.fake_latency_ms))
+        completions = FakeCompletions(gold, labels, profiles, args.time_scale, args.seed)
+    elif args.api == 'replay':
+        completions = RecordedCompletions(args.recordings, args.time_scale)
+    else:
+        completions = RecordingCompletions(probe.client.chat.completions, args.recordings)
+
+    rows: Dict[str, Dict] = {}
+
+    for model, _, _ in models:
+        classifier = make_classifier(topics, [(model, timeout)], completions)
+
+        async def classify(i: int, text: str, classifier=classifier, model=model) -> Dict:
+            result = await classifier._predict_text(text)
+            return {**gpt_outcome(result), 'cost_model': model}
+
+        rows[f'gpt:{model}'] = summarize(await run_path(evaluated, classify, args.concurrency), evaluated, prices, unpriced)
+        print(f'gpt:{model} done')
+
+    try:
+        embedder = load_embedder(args.embedder)
+    except Exception as e:
+        embedder = None
+        print(f'local paths skipped: {type(e).__name__}: {e}')
+
+    if embedder is not None:
+        from database.msg_controller import MsgController
+
+        def embed(text: str) -> np.ndarray:
+            return MsgController.storage_emb(embedder.model.encode(text))
+
+        centroids = CentroidClassifier()
+        centroids.min_count = min(args.min_count if args.min_count is not None else CENTROID_OPTIONS['min_count'], args.shots)
+
+        async def centroid_predict(text: str) -> Dict:
+            msg_emb = await asyncio.to_thread(embed, text)
+            return centroids.predict(BENCH_USER_ID, BENCH_CHAT_ID, msg_emb, topics, embed)
+
+        async def classify_local(i: int, text: str) -> Dict:
+            pred = await centroid_predict(text)
+            return {'msg_class': pred['msg_class'], 'gpt': False}
+
+        seed_centroids(history, topics, embed, from_names=True)
+        rows['centroid:names'] = summarize(await run_path(evaluated, classify_local, args.concurrency), evaluated, prices, unpriced)
+
+        seed_centroids(history, topics, embed, from_names=False)
+        rows['centroid'] = summarize(await run_path(evaluated, classify_local, args.concurrency), evaluated, prices, unpriced)
+
+        for similarity, margin in product(args.similarities, args.margins):
+            centroids.min_similarity, centroids.min_margin = similarity, margin
+            classifier = make_classifier(topics, [(hybrid_model, timeout), ('local', 0)], completions)
+
+            async def classify_hybrid(i: int, text: str, classifier=classifier) -> Dict:
+                pred = await centroid_predict(text)
+
+                if pred['confident']:
+                    return {'msg_class': pred['msg_class'], 'gpt': False}
+
+                result = await classifier._predict_text(text, pred['msg_class'])
+                return {**gpt_outcome(result), 'cost_model': hybrid_model}
+
+            rows[f'hybrid@{similarity:g}/{margin:g}'] = summarize(
+                await run_path(evaluated, classify_hybrid, args.concurrency), evaluated, prices, unpriced
+            )
+
+        print(f'local paths done; hybrid model {hybrid_model}, min_count {centroids.min_count}')
+
+    if isinstance(completions, RecordedCompletions) and completions.missing:
+        print(f'{completions.missing} requests had no recorded response and failed')
+
+    if unpriced:
+        print(f'no usage_prices for {", ".join(sorted(unpriced))}, their cost is counted as 0')
+
+    optimal = pareto(rows)
+    print_table(rows, optimal, args.per_label)
+
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'rows': rows, 'pareto': optimal}, f, indent=2, ensure_ascii=False)
+
+    if args.plot:
+        plot(rows, optimal, args.plot)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default='benchmarks/data/messages.jsonl')
+    parser.add_argument('--shots', type=int, default=2, help='history messages per topic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api', choices=['fake', 'record', 'replay'], default='fake')
+    parser.add_argument('--models', nargs='+', default=['gpt-3.5-turbo-0125'], help='model[:accuracy[:latency_ms]]')
+    parser.add_argument('--fake-accuracy', type=float, default=0.9, help='default accuracy of a fake model')
+    parser.add_argument('--fake-latency-ms', type=float, default=700, help='default median latency of a fake model')
+    parser.add_argument('--recordings', default='benchmarks/results/gpt_recordings.jsonl')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiplier of the fake and replayed latencies')
+    parser.add_argument('--timeout', type=float, help='timeout of a GPT request, the first gpt_cascade step by default')
+    parser.add_argument('--concurrency', type=int, default=8, help='messages in flight')
+    parser.add_argument('--embedder', default='', help="embedding model, emb_model_name by default; 'hash' for a stand-in")
+    parser.add_argument('--hybrid-model', help='model behind the centroid in the hybrid paths, the first of --models by default')
+    parser.add_argument('--similarities', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--margins', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--min-count', type=int, help='history messages a confident topic needs, centroid_min_count '
+                                                      'by default; never more than --shots')
+    parser.add_argument('--per-label', action='store_true', help='also print the recall of every label')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--plot', help='draw the Pareto plot to this image file')
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
@@ -0,0 +1,223 @@
+"""
+Tunes the embedding model's runtime settings for the local CPU and writes a profile loaded by TextEmbedder
+at startup (point `emb_profile_path` at the file).
+
+    python -m benchmarks.embedder_autotune --sample 2000 --out embedder_profile.json
+    python -m benchmarks.embedder_autotune --source corpus --corpus benchmarks/data/messages.jsonl --threads 1 2
+
+The texts are a random sample of `zib.user_messages` (the enriched texts the bot embeds), or a JSONL corpus.
+For every backend and thread count the single-message latency (the live path embeds one message at a time) is
+measured; then every batching setting embeds the whole sample, either in fixed batches of `--batch-sizes` texts
+or length-bucketed under each `--max-batch-tokens` budget. Reported per setting are throughput, single-message
+p50/p95 latency, the padding share of the tokens the model processed and, for `int8`, the lowest cosine
+similarity to the float32 embeddings of the same texts.
+
+Settings whose embeddings agree with float32 less than `--min-agreement` are not eligible: stored vectors must
+stay comparable with new ones under the same `emb_model_version`. Of the eligible settings the one with the
+highest throughput is chosen (`--objective throughput`), or the one with the lowest single-message p95
+(`--objective latency`).
+"""
+import argparse
+import json
+import os
+import platform
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+import numpy as np
+import torch
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS
+from src.models.embedder import TextEmbedder
+from database.pg_connector import PgConnector
+
+
+def load_db_sample(size: int) -> List[str]:
+    """Loads a random sample of stored message texts."""
+    x, error, result = PgConnector(**DB_PARAMS).get_data('''
+        select msg_text
+        from zib.user_messages
+        order by random()
+        limit %(size)s;
+    ''', {'size': size}, readonly=True)
+
+    if x != 0:
+        raise RuntimeError(error)
+
+    if not result:
+        raise RuntimeError('zib.user_messages is empty, nothing to sample')
+
+    return [row[0] for row in result]
+
+
+def load_corpus_sample(path: str, size: int) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        texts = [json.loads(line)['text'] for line in f if line.strip()]
+
+    rng = np.random.default_rng(0)
+
+    return [texts[i] for i in rng.integers(len(texts), size=size)]
+
+
+def make_embedder(model_name: str, backend: str) -> TextEmbedder:
+    """An embedder with default settings and the given backend, ignoring any configured profile."""
+    embedder = TextEmbedder(model_name, profile_path='')
+
+    if backend != embedder.profile['backend']:
+        embedder.profile['backend'] = backend
+        embedder.model = embedder.init_model()
+
+    return embedder
+
+
+def padding_share(embedder: TextEmbedder, texts: List[str], lengths: np.ndarray, batch_size: int, max_batch_tokens: int) -> float:
+    """The share of padding in the tokens processed by the model for one batching setting."""
+    if max_batch_tokens > 0:
+        batches = embedder.length_buckets(texts, max_batch_tokens)
+    else:
+        # SentenceTransformer sorts every call's texts by character length before cutting batches
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    padded = sum(len(rows) * lengths[rows].max() for rows in batches)
+
+    return 1 - lengths.sum() / padded
+
+
+def single_latency(embedder: TextEmbedder, texts: List[str]) -> np.ndarray:
+    """Latencies in milliseconds of embedding one text per call."""
+    latencies = []
+
+    for text in texts:
+        start = time.perf_counter()
+        embedder.encode([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return np.array(latencies)
+
+
+def min_agreement(embs: np.ndarray, reference: np.ndarray) -> float:
+    """The lowest cosine similarity between corresponding rows."""
+    num = (embs * reference).sum(axis=1)
+    den = np.linalg.norm(embs, axis=1) * np.linalg.norm(reference, axis=1)
+
+    return float((num / np.maximum(den, 1e-12)).min())
+
+
+def sweep(args, texts: List[str]) -> List[Dict]:
+    """Measures every combination of backend, thread count and batching setting."""
+    rng = np.random.default_rng(0)
+    single_texts = [texts[i] for i in rng.integers(len(texts), size=args.single)]
+    batchings = [(batch_size, 0) for batch_size in args.batch_sizes] + \
+                [(args.batch_sizes[-1], max_batch_tokens) for max_batch_tokens in args.max_batch_tokens]
+    reference = None
+    results = []
+
+    for backend in args.backends:
+        embedder = make_embedder(args.model, backend)
+        lengths = embedder.token_lengths(texts)
+
+        if reference is None:
+            print(f'tokens per text: p50={np.percentile(lengths, 50):.0f}  p95={np.percentile(lengths, 95):.0f}  '
+                  f'max={lengths.max()}  (model limit {embedder.model.max_seq_length})')
+
+        for num_threads in args.threads:
+            torch.set_num_threads(num_threads)
+
+            # warm-up
+            embedder.encode(texts[:32])
+            single = single_latency(embedder, single_texts)
+
+            for batch_size, max_batch_tokens in batchings:
+                embedder.profile.update(batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+
+                start = time.perf_counter()
+                embs = embedder.encode(texts)
+                elapsed = time.perf_counter() - start
+
+                if reference is None:
+                    reference = embs
+
+                result = {
+                    'backend': backend,
+                    'num_threads': num_threads,
+                    'batch_size': batch_size,
+                    'max_batch_tokens': max_batch_tokens,
+                    'texts_per_s': len(texts) / elapsed,
+                    'single_p50_ms': float(np.percentile(single, 50)),
+                    'single_p95_ms': float(np.percentile(single, 95)),
+                    'padding': padding_share(embedder, texts, lengths, batch_size, max_batch_tokens),
+                    'agreement': min_agreement(embs, reference)
+                }
+                results.append(result)
+
+                print(f"{backend:<6} threads={num_threads:<3} batch={batch_size:<4} tokens={max_batch_tokens:<6} "
+                      f"texts/s={result['texts_per_s']:8.1f}  single_p50={result['single_p50_ms']:6.1f} ms  "
+                      f"single_p95={result['single_p95_ms']:6.1f} ms  padding={result['padding']:.1%}  "
+                      f"agreement={result['agreement']:.4f}")
+
+    return results
+
+
+def choose(results: List[Dict], objective: str, agreement: float) -> Dict:
+    eligible = [result for result in results if result['agreement'] >= agreement]
+
+    if objective == 'latency':
+        return min(eligible, key=lambda result: (result['single_p95_ms'], -result['texts_per_s']))
+
+    return max(eligible, key=lambda result: result['texts_per_s'])
+
+
+def run(args):
+    """Runs the sweep and writes the chosen profile."""
+    if args.source == 'db':
+        texts = load_db_sample(args.sample)
+    else:
+        texts = load_corpus_sample(args.corpus, args.sample)
+
+    print(f'{len(texts)} texts, {os.cpu_count()} CPUs, torch {torch.__version__}')
+
+    results = sweep(args, texts)
+    best = choose(results, args.objective, args.min_agreement)
+
+    profile = {
+        'model_name': args.model,
+        'num_threads': best['num_threads'],
+        'batch_size': best['batch_size'],
+        'max_batch_tokens': best['max_batch_tokens'],
+        'backend': best['backend'],
+        'measured': best,
+        'objective': args.objective,
+        'host': {'machine': platform.machine(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+    }
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2)
+
+    print(f"chosen: backend={best['backend']} threads={best['num_threads']} batch={best['batch_size']} "
+          f"tokens={best['max_batch_tokens']}, written to {args.out}")
+
+
+if __name__ == '__main__':
+    cpus = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=EMBEDDER_OPTIONS['model_name'])
+    parser.add_argument('--source', choices=['db', 'corpus'], default='db')
+    parser.add_argument('--corpus', default='benchmarks/data/messages.jsonl')
+    parser.add_argument('--sample', type=int, default=2000, help='texts embedded per setting')
+    parser.add_argument('--single', type=int, default=100, help='texts embedded one by one for latency')
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, 2, 4, cpus // 2 or 1, cpus} - {0}))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    parser.add_argument('--max-batch-tokens', type=int, nargs='+', default=[2048, 4096, 8192, 16384],
+                        help='token budgets of length-bucketed batching')
+    parser.add_argument('--backends', nargs='+', choices=['torch', 'int8'], default=['torch', 'int8'])
+    parser.add_argument('--min-agreement', type=float, default=0.99, help='lowest cosine similarity to float32 embeddings')
+    parser.add_argument('--objective', choices=['throughput', 'latency'], default='throughput')
+    parser.add_argument('--out', default='embedder_profile.json')
+    args = parser.parse_args()
+
+    args.threads = [n for n in args.threads if n <= cpus]
+    # float32 first, it is the reference of the agreement
+    args.backends = sorted(set(args.backends), key=['torch', 'int8'].index)
+    run(args)
@@ -0,0 +1,163 @@
+"""
+Tail latency of GptClassifier against a local fake OpenAI server with heavy-tailed response times.
+
+The server answers `/v1/chat/completions` for any model after a delay drawn per model: log-normal around the
+model's median, multiplied by a Pareto factor for a share of the requests (`--tail-share`, 5% by default).
+`--messages` messages are classified `--concurrency` at a time under three policies:
+
+* `baseline` - one request per message with the previous 5 s timeout, no hedging;
+* `hedge`    - the same with a duplicate request at the observed p90, the slower request cancelled;
+* `cascade`  - hedging plus `main:2,fast:1.5,local`: the main model, then a faster model, then a local guess.
+
+Reported are p50/p90/p99 latency per message, the share of messages left without a class, requests sent per
+message and the classifier's counters. No OpenAI key is needed; any value of OPENAI_API_KEY is accepted.
+
+    python -m benchmarks.gpt_hedging --messages 2000 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+
+# model -> (median latency in seconds, log-normal sigma)
+PROFILES = {'main': (0.6, 0.35), 'fast': (0.3, 0.3)}
+CLASSES = ['news', 'sport', 'tech']
+
+
+class FakeOpenAIServer:
+    """A minimal HTTP/1.1 server with keep-alive speaking enough of the chat completions API for the OpenAI client."""
+
+    def __init__(self, tail_share: float, tail_alpha: float, seed: int = 0):
+        self.tail_share = tail_share
+        self.tail_alpha = tail_alpha
+        self.rng = np.random.default_rng(seed)
+        self.requests = 0
+        self.port = None
+        self._server = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        return f'http://127.0.0.1:{self.port}/v1'
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def delay(self, model: str) -> float:
+        median, sigma = PROFILES.get(model, PROFILES['main'])
+        delay = self.rng.lognormal(np.log(median), sigma)
+
+        if self.rng.random() < self.tail_share:
+            delay *= 1 + self.rng.pareto(self.tail_alpha) * 4
+
+        return float(delay)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+
+                if not request_line:
+                    break
+
+                headers = {}
+
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+
+                    if not line:
+                        break
+
+                    name, _, value = line.partition(':')
+                    headers[name.lower()] = value.strip()
+
+                body = json.loads(await reader.readexactly(int(headers.get('content-length', 0))) or b'{}')
+                self.requests += 1
+                model = body.get('model', 'main')
+
+                await asyncio.sleep(self.delay(model))
+
+                payload = json.dumps({
+                    'id': f'chatcmpl-{self.requests}', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': CLASSES[0]}}],
+                    'usage': {'prompt_tokens': len(body['messages'][0]['content']) // 4, 'completion_tokens': 1,
+                              'total_tokens': len(body['messages'][0]['content']) // 4 + 1}
+                }).encode()
+
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # the client cancelled a hedged request, or the server is stopping
+            pass
+        finally:
+            writer.close()
+
+
+async def run_policy(policy: Dict, messages: int, concurrency: int, server: FakeOpenAIServer) -> Dict:
+    from src.config import GPT_POLICY_OPTIONS
+    from src.models.gpt_classifier import GptClassifier
+    from database.msg_data import MsgData
+
+    GPT_POLICY_OPTIONS.update(policy)
+    classifier = GptClassifier(CLASSES)
+    semaphore = asyncio.Semaphore(concurrency)
+    requests_before = server.requests
+    latencies: List[float] = []
+    unsorted = 0
+
+    async def classify(i: int):
+        nonlocal unsorted
+
+        async with semaphore:
+            start = time.perf_counter()
+            result = (await classifier.predict([MsgData(1, 1, i, f'message {i}')], [CLASSES[1]]))[0]
+            latencies.append(time.perf_counter() - start)
+            unsorted += result['msg_class'] is None
+
+    await asyncio.gather(*[classify(i) for i in range(messages)])
+    await classifier.client.close()
+
+    return {
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p90_s': float(np.percentile(latencies, 90)),
+        'p99_s': float(np.percentile(latencies, 99)),
+        'unsorted': unsorted / messages,
+        'requests_per_msg': (server.requests - requests_before) / messages,
+        'counters': {k: v for k, v in classifier.counters.items() if k != 'messages'}
+    }
+
+
+async def run(messages: int, concurrency: int, tail_share: float, tail_alpha: float):
+    server = FakeOpenAIServer(tail_share, tail_alpha)
+    os.environ['OPENAI_BASE_URL'] = await server.start()
+
+    policies: List[Tuple[str, Dict]] = [
+        ('baseline', {'hedge_enabled': False, 'cascade': [('main', 5)]}),
+        ('hedge', {'hedge_enabled': True, 'cascade': [('main', 5)]}),
+        ('cascade', {'hedge_enabled': True, 'cascade': [('main', 2), ('fast', 1.5), ('local', 0)]})
+    ]
+
+    try:
+        for name, policy in policies:
+            result = await run_policy(policy, messages, concurrency, server)
+            counters = result.pop('counters')
+            print(f'{name:<9} ' + '  '.join(f'{k}={v:.3f}' for k, v in result.items()) + f'  {dict(counters)}')
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--tail-share', type=float, default=0.05, help='share of responses with a Pareto delay factor')
+    parser.add_argument('--tail-alpha', type=float, default=1.2, help='Pareto shape, lower is heavier')
+    args = parser.parse_args()
+
+    asyncio.run(run(args.messages, args.concurrency, args.tail_share, args.tail_alpha))
@@ -0,0 +1,216 @@
+"""
+Per-message enrichment latency of messages with several links, against a local HTTP server with heavy-tailed
+response times.
+
+The server returns a generated article for any path after a log-normal delay around `--median-ms`, multiplied by
+a Pareto factor for a `--tail-share` of the requests. Every message has the user's own text and 1 to `--links`
+links and is enriched `--concurrency` messages at a time under three policies:
+
+* `first_link` - the previous behaviour: `link_pattern.match` at the start of the text, one page fetched;
+* `sequential` - every link fetched one after another;
+* `concurrent` - `UrlStore.get_many`: every link at once within the shared `--budget-s` timeout.
+
+Reported are p50/p95/p99 latency per message, the share of links enriched, the mean length of the classification
+input, and the cost of finding the links with `link_pattern` (at the start of the text as before, and anywhere)
+and with the linear-time `find_urls` scanner. The shared url table is disabled, so no database is needed:
+
+    python -m benchmarks.link_enrichment --messages 300 --links 4 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+from typing import Callable, Dict, List
+import numpy as np
+
+# link detection of the previous behaviour, replaced by `find_urls` in the bot
+link_pattern = re.compile(r"((http|https)\:\/\/)?[а-яА-Яa-zA-Z0-9\.\/\?\:@\-_=#]+\.([а-яА-Яa-zA-Z]){2,6}([а-яА-Яa-zA-Z0-9\.\&\/\?\:@\-_=#])*")
+
+WORDS = 'новости технологии спорт рынок команда матч выпуск модель данные город история проект'.split()
+
+
+class FakeSiteServer:
+    """A minimal HTTP/1.1 server answering every GET with an article after a random delay."""
+
+    def __init__(self, median_ms: float, tail_share: float, tail_alpha: float, seed: int = 0):
+        self.median = median_ms / 1000
+        self.tail_share = tail_share
+        self.tail_alpha = tail_alpha
+        self.rng = np.random.default_rng(seed)
+        self.requests = 0
+        self.port = None
+        self._server = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        return f'http://127.0.0.1:{self.port}'
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def delay(self) -> float:
+        delay = self.rng.lognormal(np.log(self.median), 0.4)
+
+        if self.rng.random() < self.tail_share:
+            delay *= 1 + self.rng.pareto(self.tail_alpha) * 4
+
+        return float(delay)
+
+    def page(self) -> bytes:
+        paragraphs = [' '.join(self.rng.choice(WORDS, 60)) for _ in range(8)]
+
+        return ('<html><body>' + ''.join(f'<p>{p}</p>' for p in paragraphs) + '</body></html>').encode()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+
+                if not request_line:
+                    break
+
+                while (await reader.readline()).strip():
+                    pass
+
+                self.requests += 1
+                await asyncio.sleep(self.delay())
+                payload = self.page()
+
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_messages(base_url: str, messages: int, max_links: int, seed: int = 0) -> List[str]:
+    rng = np.random.default_rng(seed)
+    texts = []
+
+    for i in range(messages):
+        links = [f'{base_url}/article/{i}/{j}.html' for j in range(rng.integers(1, max_links + 1))]
+        # the first link opens the message, so that the previous behaviour enriches something
+        texts.append(f'{links[0]} ' + ' '.join(rng.choice(WORDS, 12)) + ' ' + ' '.join(links[1:]))
+
+    return texts
+
+
+def extract_text_from_url(url: str, limit: int = 2000, timeout: float = None) -> str:
+    """The page fetch of the previous behaviour: a plain GET without revalidation or a shared cache."""
+    import requests
+    from src.utils.utils import extract_text_from_html
+
+    return extract_text_from_html(requests.get(url, timeout=timeout).text, limit)
+
+
+async def run_policy(name: str, texts: List[str], concurrency: int, budget_s: float) -> Dict:
+    from src.config import ENRICH_OPTIONS
+    from src.utils.utils import extract_urls, strip_urls, merge_enriched_text
+    from src.utils.url_store import UrlStore
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    enriched, total, input_chars = 0, 0, []
+
+    async def enrich(text: str):
+        nonlocal enriched, total
+
+        urls = extract_urls(text)
+        total += len(urls)
+
+        async with semaphore:
+            start = time.perf_counter()
+
+            if name == 'first_link':
+                link = link_pattern.match(text)
+
+                try:
+                    link_texts = [await asyncio.to_thread(extract_text_from_url, link.group(0), 2000, budget_s)] if link else []
+                except Exception:
+                    link_texts = []
+
+                result = link_texts[0] if link_texts else text
+            else:
+                if name == 'sequential':
+                    link_texts = [(await UrlStore().get(url))[0] for url in urls]
+                else:
+                    link_texts = [r[0] for r in await UrlStore().get_many(urls, budget_s) if r is not None]
+
+                link_texts = [t for t in link_texts if t]
+                result = merge_enriched_text(strip_urls(text, urls), link_texts, ENRICH_OPTIONS['max_chars'])
+
+            latencies.append(time.perf_counter() - start)
+            enriched += len(link_texts)
+            input_chars.append(len(result))
+
+    await asyncio.gather(*[enrich(text) for text in texts])
+
+    return {
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p95_s': float(np.percentile(latencies, 95)),
+        'p99_s': float(np.percentile(latencies, 99)),
+        'links_enriched': enriched / total,
+        'input_chars': float(np.mean(input_chars))
+    }
+
+
+def time_per_call(fn: Callable[[str], object], texts: List[str], repeats: int = 20) -> float:
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        for text in texts:
+            fn(text)
+
+    return (time.perf_counter() - start) / (repeats * len(texts)) * 1e6
+
+
+def scan_costs(texts: List[str]) -> Dict:
+    from src.utils.utils import find_urls
+
+    long_token = ['a' * 10000]
+
+    return {
+        'link_pattern_us': time_per_call(link_pattern.match, texts),
+        'link_pattern_search_us': time_per_call(link_pattern.search, texts),
+        'find_urls_us': time_per_call(find_urls, texts),
+        'link_pattern_long_token_us': time_per_call(link_pattern.match, long_token, 5),
+        'find_urls_long_token_us': time_per_call(find_urls, long_token, 5)
+    }
+
+
+async def run(messages: int, links: int, concurrency: int, budget_s: float, median_ms: float, tail_share: float):
+    from src.config import URL_CONTENT_OPTIONS
+
+    URL_CONTENT_OPTIONS['enabled'] = False
+    os.environ['NO_PROXY'] = '127.0.0.1,localhost'
+
+    server = FakeSiteServer(median_ms, tail_share, tail_alpha=1.2)
+    texts = make_messages(await server.start(), messages, links)
+
+    try:
+        print('scan ' + '  '.join(f'{k}={v:.2f}' for k, v in scan_costs(texts).items()))
+
+        for name in ('first_link', 'sequential', 'concurrent'):
+            result = await run_policy(name, texts, concurrency, budget_s)
+            print(f'{name:<11} ' + '  '.join(f'{k}={v:.3f}' for k, v in result.items()))
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--links', type=int, default=4, help='maximum number of links per message')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--budget-s', type=float, default=4, help='shared enrichment timeout of a message')
+    parser.add_argument('--median-ms', type=float, default=300, help='median response time of the server')
+    parser.add_argument('--tail-share', type=float, default=0.05, help='share of responses with a Pareto delay factor')
+    args = parser.parse_args()
+
+    asyncio.run(run(args.messages, args.links, args.concurrency, args.budget_s, args.median_ms, args.tail_share))
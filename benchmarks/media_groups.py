@@ -0,0 +1,148 @@
+"""
+Time-to-sorted of albums: the previous fixed wait of aiogram_media_group against MediaGroupAggregator.
+
+Albums of 2 to 10 parts arrive with log-normal gaps between parts around `--gap-ms`, a `--slow-share` of the
+gaps ten times longer; a `--next-share` of the albums is followed by another message of the chat `--next-ms`
+after the last part. Every Bot API call takes a log-normal round trip around `--rtt-ms`. Classification is
+left out, it costs the same on both paths. Time-to-sorted runs from the first part to the end of the move:
+
+* `fixed`    - the album is handed over `--fixed-wait-s` after its first part, re-sent with send_media_group and
+  every part deleted with its own call; parts arriving later are sorted as albums of their own (`split`);
+* `adaptive` - the real aggregator (see src/bot/media_group.py), then one copy_messages and one delete_messages.
+
+    python -m benchmarks.media_groups --albums 300 --gap-ms 20 --next-share 0.3 --rtt-ms 80
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+import numpy as np
+
+
+class FakeBotApi:
+    """Counts Bot API calls; every call takes a random round trip."""
+
+    def __init__(self, rtt_ms: float, seed: int = 0):
+        self.rtt = rtt_ms / 1000
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(float(self.rng.lognormal(np.log(self.rtt), 0.3)))
+
+
+def make_albums(albums: int, gap_ms: float, slow_share: float, next_share: float, seed: int = 0) -> List[Dict]:
+    """Arrival offsets in seconds of the parts of every album and of the next message of its chat, if any."""
+    rng = np.random.default_rng(seed)
+    result = []
+
+    for _ in range(albums):
+        gaps = rng.lognormal(np.log(gap_ms / 1000), 0.8, size=int(rng.integers(2, 11)) - 1)
+        gaps[rng.random(len(gaps)) < slow_share] *= 10
+        result.append({'arrivals': np.concatenate([[0.0], np.cumsum(gaps)]), 'next': rng.random() < next_share})
+
+    return result
+
+
+async def run_fixed(api: FakeBotApi, album: Dict, fixed_wait_s: float) -> Dict:
+    """The previous handler: the first part sleeps the fixed wait, the parts that arrived by then are moved."""
+    start = time.perf_counter()
+    arrivals = album['arrivals']
+    await asyncio.sleep(fixed_wait_s)
+    parts = int(np.sum(arrivals <= fixed_wait_s))
+
+    await api.call()
+
+    for _ in range(parts):
+        await api.call()
+
+    return {'sorted_s': time.perf_counter() - start, 'split': parts < len(arrivals)}
+
+
+async def run_adaptive(api: FakeBotApi, album: Dict, chat_id: int, next_ms: float) -> Dict:
+    """Feeds the parts to the aggregator at their arrival times, as the router middleware and handler would."""
+    from src.bot.media_group import MediaGroupAggregator
+
+    aggregator = MediaGroupAggregator()
+    start = time.perf_counter()
+    result = {}
+
+    def message(msg_id: int, media_group_id=None) -> SimpleNamespace:
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=msg_id, media_group_id=media_group_id)
+
+    async def part(msg_id: int, arrival: float):
+        await asyncio.sleep(max(start + arrival - time.perf_counter(), 0))
+        msg = message(msg_id, str(chat_id))
+        aggregator.observe(msg)
+        group = await aggregator.collect(msg)
+
+        if group is not None:
+            await api.call()
+            await api.call()
+
+            # only the first handing over of the album counts, late parts are albums of their own
+            if 'sorted_s' not in result:
+                result.update(sorted_s=time.perf_counter() - start, reason=group.reason)
+            else:
+                result['split'] = True
+
+    async def next_message(arrival: float):
+        await asyncio.sleep(max(start + arrival - time.perf_counter(), 0))
+        aggregator.observe(message(len(album['arrivals']) + 1))
+
+    tasks = [part(i + 1, arrival) for i, arrival in enumerate(album['arrivals'])]
+
+    if album['next']:
+        tasks.append(next_message(album['arrivals'][-1] + next_ms / 1000))
+
+    await asyncio.gather(*tasks)
+
+    return {'split': False, **result}
+
+
+def report(name: str, results: List[Dict], calls: int, extra: str = ''):
+    sorted_s = [r['sorted_s'] for r in results]
+    print(f'{name:<8} albums={len(results)}  p50_s={np.percentile(sorted_s, 50):.3f}  '
+          f'p95_s={np.percentile(sorted_s, 95):.3f}  max_s={max(sorted_s):.3f}  calls={calls / len(results):.1f}  '
+          f'split={sum(r["split"] for r in results)}  {extra}'.rstrip())
+
+
+async def run(albums: int, gap_ms: float, slow_share: float, next_share: float, next_ms: float, rtt_ms: float,
+              fixed_wait_s: float, interval_ms: float):
+    from src.bot.media_group import MediaGroupAggregator
+
+    generated = make_albums(albums, gap_ms, slow_share, next_share)
+
+    async def staggered(i: int, coro):
+        await asyncio.sleep(i * interval_ms / 1000)
+        return await coro
+
+    api = FakeBotApi(rtt_ms)
+    results = await asyncio.gather(*[staggered(i, run_fixed(api, album, fixed_wait_s)) for i, album in enumerate(generated)])
+    report('fixed', results, api.calls)
+
+    api = FakeBotApi(rtt_ms)
+    results = await asyncio.gather(*[
+        staggered(i, run_adaptive(api, album, -1000 - i, next_ms)) for i, album in enumerate(generated)
+    ])
+    aggregator = MediaGroupAggregator()
+    reasons = '  '.join(f'{reason}={count}' for reason, count in sorted(aggregator.counters.items()))
+    report('adaptive', results, api.calls, f'{reasons}  final_wait_s={aggregator.wait_s():.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--albums', type=int, default=300)
+    parser.add_argument('--gap-ms', type=float, default=20, help='median gap between the parts of an album')
+    parser.add_argument('--slow-share', type=float, default=0.02, help='share of gaps ten times longer')
+    parser.add_argument('--next-share', type=float, default=0.3, help='share of albums followed by another message')
+    parser.add_argument('--next-ms', type=float, default=300, help='time from the last part to the next message')
+    parser.add_argument('--rtt-ms', type=float, default=80, help='median round trip of a Bot API call')
+    parser.add_argument('--fixed-wait-s', type=float, default=1.0, help='receive_timeout of aiogram_media_group')
+    parser.add_argument('--interval-ms', type=float, default=50, help='time between the first parts of albums')
+    args = parser.parse_args()
+
+    asyncio.run(run(args.albums, args.gap_ms, args.slow_share, args.next_share, args.next_ms, args.rtt_ms,
+                    args.fixed_wait_s, args.interval_ms))
@@ -0,0 +1,99 @@
+"""
+Memory and time of holding `--n` embedded messages in three layouts:
+
+* `legacy`  - the previous MsgData without slots: an instance dict per message and one embedding array per row;
+* `slots`   - the slotted MsgData, still one embedding array per row;
+* `batch`   - a MsgBatch with identifier arrays and one contiguous embedding matrix.
+
+For every layout the messages are built from the same random embeddings, then scored against a query vector
+the way bulk paths do it (stacking the rows first where needed). Reported are the traced allocation peak and
+the resident size of the built messages, the build time and the scoring time.
+
+    python -m benchmarks.msg_batch --n 1000000 --dim 312
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+import numpy as np
+from database.msg_data import MsgData, MsgBatch
+
+
+class LegacyMsgData:
+    """MsgData as it was before slots."""
+
+    def __init__(self, user_id: int, chat_id: int, msg_id: int, msg_text: str):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.topic_id = 0
+        self.msg_id = msg_id
+        self.msg_text = msg_text
+        self.msg_emb = np.array([])
+        self.msg_fingerprint = None
+        self.topic_msg_id = None
+        self.category = 'unknown'
+
+
+def build_rows(cls, texts, embs):
+    messages = []
+
+    for i, (text, emb) in enumerate(zip(texts, embs)):
+        msg = cls(1, 1, i, text)
+        msg.msg_emb = emb.copy()
+        messages.append(msg)
+
+    return messages
+
+
+def build_batch(texts, embs):
+    n = len(texts)
+    return MsgBatch(np.ones(n), np.ones(n), np.arange(n), texts, msg_embs=embs.copy())
+
+
+def score(messages, query: np.ndarray) -> np.ndarray:
+    if isinstance(messages, MsgBatch):
+        return messages.msg_embs @ query
+
+    return np.stack([msg.msg_emb for msg in messages]) @ query
+
+
+def run(n: int, dim: int):
+    """Prints the measurements of every layout."""
+    rng = np.random.default_rng(0)
+    embs = rng.standard_normal((n, dim), dtype=np.float32)
+    texts = [f'message {i}' for i in range(n)]
+    query = rng.standard_normal(dim, dtype=np.float32)
+    builders = (
+        ('legacy', lambda: build_rows(LegacyMsgData, texts, embs)),
+        ('slots', lambda: build_rows(MsgData, texts, embs)),
+        ('batch', lambda: build_batch(texts, embs))
+    )
+
+    for name, build in builders:
+        gc.collect()
+        tracemalloc.start()
+
+        start = time.perf_counter()
+        messages = build()
+        build_s = time.perf_counter() - start
+        held, _ = tracemalloc.get_traced_memory()
+
+        start = time.perf_counter()
+        score(messages, query)
+        score_s = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+
+        tracemalloc.stop()
+        del messages
+
+        print(f'{name:<7} held_mb={held / 2 ** 20:.1f}  peak_mb={peak / 2 ** 20:.1f}  '
+              f'build_s={build_s:.2f}  score_s={score_s:.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=1_000_000, help='number of messages')
+    parser.add_argument('--dim', type=int, default=312, help='embedding dimension')
+    args = parser.parse_args()
+
+    run(args.n, args.dim)
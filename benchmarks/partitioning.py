@@ -0,0 +1,126 @@
+"""
+Compares the single-heap `zib.user_messages` layout with the hash-partitioned one on synthetic data:
+bulk load, single-row insert throughput, per-user search latency, vacuum and vector index build time.
+
+Both layouts are created in a scratch schema `zib_bench`, which is dropped at the end. Run with the same
+environment variables as `run_bot.sh`; loading 10M rows of 312-dim vectors takes a while and ~15GB of disk.
+
+    python -m benchmarks.partitioning --rows 10000000 --users 20000
+"""
+import argparse
+import time
+from typing import Dict
+import numpy as np
+from src.config import DB_PARAMS
+from database.pg_connector import PgConnector
+
+LAYOUTS = {
+    'heap': '''
+        create table zib_bench.heap(
+            msg_id integer not null, user_id int not null, chat_id bigint not null, topic_id integer not null,
+            msg_text text not null, msg_emb vector({dim}) not null,
+            constraint heap_pkey primary key(msg_id)
+        );
+        create index heap_idx1 on zib_bench.heap (user_id, chat_id);
+        create index heap_idx2 on zib_bench.heap (user_id, chat_id, topic_id);
+        create unique index heap_idx3 on zib_bench.heap (user_id, chat_id, msg_id);
+    ''',
+    'part': '''
+        create table zib_bench.part(
+            msg_id integer not null, user_id int not null, chat_id bigint not null, topic_id integer not null,
+            msg_text text not null, msg_emb vector({dim}) not null,
+            constraint part_pkey primary key(user_id, chat_id, msg_id)
+        ) partition by hash(user_id);
+        do $$
+        begin
+            for i in 0..{last_partition} loop
+                execute format('create table zib_bench.part_p%s partition of zib_bench.part for values with (modulus {partitions}, remainder %s);', i, i);
+            end loop;
+        end $$;
+        create index part_topic_idx on zib_bench.part (user_id, chat_id, topic_id);
+    '''
+}
+
+LOAD_SQL = '''
+    insert into zib_bench.{table}
+    select g, g % {users}, g % {users}, 1, md5(g::text),
+           (select array_agg(random())::vector({dim}) from generate_series(1, {dim}) where g > 0)
+    from generate_series(1, {rows}) g;
+'''
+
+SEARCH_SQL = '''
+    select msg_id, msg_text, 1 - (msg_emb <=> %(msg_emb)s::vector) as cos_sim
+    from zib_bench.{table}
+    where user_id=%(user_id)s and chat_id=%(chat_id)s
+    order by cos_sim desc
+    limit 3;
+'''
+
+
+def timed(cursor, query: str, params: Dict = None) -> float:
+    """Executes a statement and returns its duration in seconds."""
+    start = time.perf_counter()
+    cursor.execute(query, params)
+    return time.perf_counter() - start
+
+
+def run(rows: int, users: int, dim: int, partitions: int, n_inserts: int, n_queries: int):
+    """Prints the measurements of both layouts."""
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+    conn.autocommit = True
+    rng = np.random.default_rng(0)
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('drop schema if exists zib_bench cascade; create schema zib_bench;')
+
+            for table, ddl in LAYOUTS.items():
+                cursor.execute(ddl.format(dim=dim, partitions=partitions, last_partition=partitions - 1))
+
+                result = {'bulk_load_s': timed(cursor, LOAD_SQL.format(table=table, users=users, dim=dim, rows=rows))}
+
+                start = time.perf_counter()
+                for i in range(n_inserts):
+                    cursor.execute(
+                        f'insert into zib_bench.{table} values(%s, %s, %s, 1, %s, %s) on conflict do nothing;',
+                        (rows + 1 + i, i % users, i % users, '', rng.standard_normal(dim).tolist())
+                    )
+                result['insert_rows_per_s'] = n_inserts / (time.perf_counter() - start)
+
+                cursor.execute(f'analyze zib_bench.{table};')
+
+                latencies = []
+                for _ in range(n_queries):
+                    user_id = int(rng.integers(users))
+                    params = {'user_id': user_id, 'chat_id': user_id, 'msg_emb': str(rng.standard_normal(dim).tolist())}
+                    latencies.append(timed(cursor, SEARCH_SQL.format(table=table), params) * 1000)
+                    cursor.fetchall()
+                result['search_p50_ms'] = float(np.percentile(latencies, 50))
+                result['search_p99_ms'] = float(np.percentile(latencies, 99))
+
+                cursor.execute(f'delete from zib_bench.{table} where msg_id % 100 = 0;')
+                result['vacuum_s'] = timed(cursor, f'vacuum zib_bench.{table};')
+
+                result['index_build_s'] = timed(cursor, f'create index on zib_bench.{table} using hnsw (msg_emb vector_cosine_ops);')
+
+                print(f'{table:<5} ' + '  '.join(f'{k}={v:.3f}' for k, v in result.items()))
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute('drop schema if exists zib_bench cascade;')
+
+        conn.autocommit = False
+        pg.disconnect(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--dim', type=int, default=312)
+    parser.add_argument('--partitions', type=int, default=16)
+    parser.add_argument('--inserts', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    run(args.rows, args.users, args.dim, args.partitions, args.inserts, args.queries)
@@ -0,0 +1,74 @@
+"""
+Compares prompt size and build time of the token-budgeted PromptBuilder with the previous prompt
+construction (Python repr of the topic dictionary, message cropped at 1024 characters) on a fixed corpus.
+
+    python -m benchmarks.prompt_tokens --corpus benchmarks/data/messages.jsonl
+"""
+import argparse
+import json
+import time
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import yaml
+from src.models.prompt_builder import PromptBuilder
+
+LEGACY_TEMPLATE = '''Categorize text into predefined classes: {msg_classes}, if you can't categorize the text, return "unknown".
+Don't offer any classes other than the above list.
+
+Input Data: `{msg_text}`
+
+Output Format: Provide only one word as an answer, without punctuation and tags, all lowercase.'''
+
+MODEL = 'gpt-3.5-turbo-0125'
+
+
+def load_corpus(path: str) -> List[Dict]:
+    """Loads a JSONL corpus of {"text": ..., "label": ...} records."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def measure(build: Callable[[str], str], texts: List[str], count: Callable[[str], int], repeats: int) -> Tuple[float, float]:
+    """Returns mean prompt tokens and mean build time in microseconds."""
+    tokens = [count(build(text)) for text in texts]
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            build(text)
+    build_us = (time.perf_counter() - start) * 1e6 / (repeats * len(texts))
+
+    return float(np.mean(tokens)), build_us
+
+
+def run(corpus_path: str, max_msg_tokens: int, repeats: int):
+    """Prints mean prompt tokens and build latency before and after."""
+    corpus = load_corpus(corpus_path)
+    texts = [record['text'] for record in corpus]
+
+    # topic ids as stored by the bot: names mapped to forum thread ids
+    labels = sorted({record['label'] for record in corpus})
+    topics = {name: 1000 + i for i, name in enumerate(labels)}
+
+    with open('prompts.yml', 'r', encoding='utf-8') as f:
+        template = yaml.safe_load(f)['msg_classification_prompt']
+
+    builder = PromptBuilder(template, max_msg_tokens, MODEL)
+
+    results = {
+        'before': measure(lambda text: LEGACY_TEMPLATE.format(msg_classes=topics, msg_text=text[:1024]), texts, builder.count_tokens, repeats),
+        'after': measure(lambda text: builder.build(topics, text)[0], texts, builder.count_tokens, repeats)
+    }
+
+    for name, (tokens, build_us) in results.items():
+        print(f'{name:<7} messages={len(texts):<5} mean_prompt_tokens={tokens:.1f}  mean_build_us={build_us:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default='benchmarks/data/messages.jsonl')
+    parser.add_argument('--max-msg-tokens', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=100)
+    args = parser.parse_args()
+
+    run(args.corpus, args.max_msg_tokens, args.repeats)
@@ -0,0 +1,119 @@
+"""
+Measures a read-heavy `/search` load against the stored messages in three modes:
+
+* `legacy`   - the previous unprepared query, parsed and planned on the primary for every call;
+* `prepared` - the named prepared statement on the primary;
+* `replica`  - the prepared statement routed to the read replica (requires `db_replica_host`).
+
+Every mode runs `--workers` processes issuing `--queries` searches each for random (user, chat) pairs
+that have saved messages, bypassing the vector cache. Reported are p50/p99 latency, throughput and the
+primary's CPU time spent on the searches, taken from `pg_stat_statements` (execution + planning time) if
+the extension is installed on the primary. Run with the same environment variables as `run_bot.sh`:
+
+    python -m benchmarks.read_routing --workers 8 --queries 500
+"""
+import argparse
+import time
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from src.config import DB_PARAMS, EMB_STORAGE_OPTIONS
+from database.pg_connector import PgConnector
+from database.msg_controller import MsgController
+
+LEGACY_SQL = '''
+    select msg_id, msg_text, 1 - (msg_emb <=> %(msg_emb)s::{emb_type}) as cos_sim
+    from zib.user_messages
+    where user_id=%(user_id)s and chat_id=%(chat_id)s
+    order by cos_sim desc
+    limit %(top_k)s;
+'''
+
+STATS_SQL = '''
+    select coalesce(sum(total_exec_time + total_plan_time), 0)
+    from pg_stat_statements
+    where query like '%%msg_emb <=>%%' and dbid = (select oid from pg_database where datname = current_database());
+'''
+
+
+def load_targets(limit: int) -> Tuple[List[Tuple[int, int]], int]:
+    """Returns (user_id, chat_id) pairs with saved messages and the embedding dimension."""
+    _, _, result = PgConnector(**DB_PARAMS).get_data('''
+        select user_id, chat_id, max(vector_dims(msg_emb))
+        from zib.user_messages
+        group by user_id, chat_id
+        limit %(limit)s;
+    ''', {'limit': limit})
+
+    if not result:
+        raise RuntimeError('zib.user_messages is empty, nothing to search')
+
+    return [(row[0], row[1]) for row in result], result[0][2]
+
+
+def primary_search_ms() -> Optional[float]:
+    """Returns the cumulative primary time spent on similarity searches, None without pg_stat_statements."""
+    x, _, result = PgConnector(**DB_PARAMS).get_data(STATS_SQL, {})
+
+    return float(result[0][0]) if x == 0 else None
+
+
+def worker(args: Tuple[str, List[Tuple[int, int]], int, int, int]) -> List[float]:
+    """Runs the searches of one process and returns their latencies in milliseconds."""
+    mode, targets, dim, n_queries, seed = args
+    conn = PgConnector(**DB_PARAMS)
+    conn.replica_enabled = mode == 'replica'
+    rng = np.random.default_rng(seed)
+    query = LEGACY_SQL.format(emb_type=EMB_STORAGE_OPTIONS['type'])
+    latencies = []
+
+    for _ in range(n_queries):
+        user_id, chat_id = targets[rng.integers(len(targets))]
+        msg_emb = rng.standard_normal(dim).astype(np.float32)
+
+        start = time.perf_counter()
+        if mode == 'legacy':
+            params = {'user_id': user_id, 'chat_id': chat_id, 'msg_emb': str(msg_emb.tolist()), 'top_k': 3}
+            conn.get_data(query, params)
+        else:
+            MsgController._search_sim_messages_db(user_id, chat_id, msg_emb, 3)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return latencies
+
+
+def run(modes: List[str], workers: int, n_queries: int, n_targets: int):
+    """Prints the measurements of every mode."""
+    targets, dim = load_targets(n_targets)
+
+    for mode in modes:
+        cpu_before = primary_search_ms()
+        start = time.perf_counter()
+
+        with Pool(workers) as pool:
+            latencies = sum(pool.map(worker, [(mode, targets, dim, n_queries, seed) for seed in range(workers)]), [])
+
+        elapsed = time.perf_counter() - start
+        cpu_after = primary_search_ms()
+
+        result: Dict[str, float] = {
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'qps': len(latencies) / elapsed
+        }
+
+        if cpu_before is not None and cpu_after is not None:
+            result['primary_ms_per_query'] = (cpu_after - cpu_before) / len(latencies)
+
+        print(f'{mode:<9} ' + '  '.join(f'{k}={v:.3f}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', choices=['legacy', 'prepared', 'replica'], default=['legacy', 'prepared', 'replica'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=500, help='searches per worker')
+    parser.add_argument('--targets', type=int, default=1000, help='number of (user, chat) pairs to sample')
+    args = parser.parse_args()
+
+    run(args.modes, args.workers, args.queries, args.targets)
@@ -0,0 +1,119 @@
+"""
+Load test of the pipeline scheduler with simulated stages, no Telegram, OpenAI or database involved.
+
+One user floods the bot with `--flood` forwarded messages at once. Meanwhile `--users` other users each send a
+message and run `/search` every `--interval` seconds. A message takes an embedding call, a GPT call with
+log-normal latency and a Telegram move; `/search` takes an embedding call and a database query. The resource
+limits are those of `SCHEDULER_OPTIONS`.
+
+The workload is run without the flood for reference, then with the flood without admission control (every
+handler enters the stages at once, as before) and with FairScheduler. Reported are p50/p99 latencies of the
+other users' messages and searches, the flood's completion time and the number of shed messages.
+
+    python -m benchmarks.scheduler_load --flood 2000 --users 20 --duration 20
+"""
+import argparse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List
+import numpy as np
+from src.bot.scheduler import FairScheduler, SchedulerOverloaded
+
+
+class Unscheduled(FairScheduler):
+    """The previous behaviour: resource limits only, every job is admitted immediately."""
+    _instance = None
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, interactive: bool = False, cost: int = 1):
+        yield
+
+
+async def handle_message(scheduler: FairScheduler, user_id: int, rng: np.random.Generator, gpt_ms: float):
+    """A simulated `handle_new_text_message`."""
+    async with scheduler.slot(user_id):
+        async with scheduler.resource('embedder'):
+            await asyncio.sleep(0.005)
+
+        async with scheduler.resource('openai'):
+            await asyncio.sleep(rng.lognormal(np.log(gpt_ms / 1000), 0.5))
+
+        async with scheduler.resource('telegram'):
+            await asyncio.sleep(0.05)
+
+
+async def handle_search(scheduler: FairScheduler, user_id: int):
+    """A simulated `/search`."""
+    async with scheduler.slot(user_id, interactive=True):
+        async with scheduler.resource('embedder'):
+            await asyncio.sleep(0.005)
+
+        await asyncio.sleep(0.01)
+
+
+async def timed(job) -> float:
+    start = time.perf_counter()
+    await job
+    return (time.perf_counter() - start) * 1000
+
+
+async def run_scenario(scheduler: FairScheduler, flood: int, users: int, duration: float, interval: float, gpt_ms: float) -> Dict:
+    rng = np.random.default_rng(0)
+    shed = 0
+
+    async def flood_job():
+        nonlocal shed
+        try:
+            await handle_message(scheduler, 0, rng, gpt_ms)
+        except SchedulerOverloaded:
+            shed += 1
+
+    start = time.perf_counter()
+    flood_tasks = [asyncio.create_task(flood_job()) for _ in range(flood)]
+
+    message_ms: List[float] = []
+    search_ms: List[float] = []
+
+    async def user(user_id: int):
+        await asyncio.sleep(rng.uniform(0, interval))
+        deadline = time.perf_counter() + duration
+
+        while time.perf_counter() < deadline:
+            message_ms.append(await timed(handle_message(scheduler, user_id, rng, gpt_ms)))
+            search_ms.append(await timed(handle_search(scheduler, user_id)))
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*[user(user_id) for user_id in range(1, users + 1)])
+    await asyncio.gather(*flood_tasks)
+
+    return {
+        'msg_p50_ms': np.percentile(message_ms, 50),
+        'msg_p99_ms': np.percentile(message_ms, 99),
+        'search_p50_ms': np.percentile(search_ms, 50),
+        'search_p99_ms': np.percentile(search_ms, 99),
+        'flood_s': time.perf_counter() - start,
+        'shed': shed
+    }
+
+
+def run(flood: int, users: int, duration: float, interval: float, gpt_ms: float):
+    """Prints the measurements with and without the scheduler."""
+    scenarios = (('no_flood', FairScheduler, 0), ('before', Unscheduled, flood), ('after', FairScheduler, flood))
+
+    for name, scheduler_cls, n_flood in scenarios:
+        scheduler_cls._instance = None
+        result = asyncio.run(run_scenario(scheduler_cls(), n_flood, users, duration, interval, gpt_ms))
+        print(f'{name:<9} ' + '  '.join(f'{k}={v:.1f}' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flood', type=int, default=2000, help='messages forwarded at once by one user')
+    parser.add_argument('--users', type=int, default=20, help='interactive users')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--interval', type=float, default=1, help='seconds between actions of an interactive user')
+    parser.add_argument('--gpt-ms', type=float, default=600, help='median GPT latency')
+    args = parser.parse_args()
+
+    run(args.flood, args.users, args.duration, args.interval, args.gpt_ms)
@@ -0,0 +1,185 @@
+"""
+Telegram calls and wall time of /search: one message per hit as before, against one paged results message.
+
+The Bot API is modelled by fake messages answering after a log-normal delay around `--rtt-ms`; the embedder,
+the similarity search and the lookup of a page's messages sleep for `--embed-ms`, `--search-ms` and `--lookup-ms`
+over synthetic messages, so no bot, model or database is needed. The paged path runs the real handlers, and every
+page of the results is then turned once:
+
+    python -m benchmarks.search_results --searches 50 --top-k 10 20 50 --rtt-ms 80
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+import numpy as np
+
+BENCH_USER_ID = -1
+BENCH_CHAT_ID = -1001
+
+
+class FakeBotApi:
+    """Counts Bot API calls; every call takes a random round trip."""
+
+    def __init__(self, rtt_ms: float, seed: int = 0):
+        self.rtt = rtt_ms / 1000
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+        self.sent = []
+
+    async def call(self, text: str = None, reply_markup=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(float(self.rng.lognormal(np.log(self.rtt), 0.3)))
+
+        if text is not None:
+            self.sent.append((text, reply_markup))
+
+    def message(self, text: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            text=text, from_user=SimpleNamespace(id=BENCH_USER_ID), chat=SimpleNamespace(id=BENCH_CHAT_ID),
+            answer=self.call, edit_text=self.call
+        )
+
+
+class FakeIndex:
+    """Synthetic messages searched by exact cosine similarity, with modelled database latencies."""
+
+    def __init__(self, rows: int, search_ms: float, lookup_ms: float, seed: int = 0):
+        from database.msg_data import MsgData
+
+        rng = np.random.default_rng(seed)
+        self.embs = rng.standard_normal((rows, 64)).astype(np.float32)
+        self.embs /= np.linalg.norm(self.embs, axis=1, keepdims=True)
+        self.texts = [f'сообщение {i} ' + 'текст ' * 40 for i in range(rows)]
+        self.search_s, self.lookup_s = search_ms / 1000, lookup_ms / 1000
+        self.searches, self.lookups = 0, 0
+        self.msg_data = MsgData
+
+    def search(self, user_id: int, chat_id: int, msg_emb: np.ndarray, top_k: int = 3):
+        self.searches += 1
+        time.sleep(self.search_s)
+        ids = np.argsort(-(self.embs @ msg_emb[:64]))[:int(top_k)]
+
+        return [self.msg_data(user_id, chat_id, int(i), self.texts[i]) for i in ids]
+
+    def lookup(self, user_id: int, chat_id: int, msg_ids: List[int]):
+        self.lookups += 1
+        time.sleep(self.lookup_s)
+        messages = []
+
+        for msg_id in msg_ids:
+            msg = self.msg_data(user_id, chat_id, msg_id, self.texts[msg_id])
+            msg.topic_id, msg.topic_msg_id, msg.category = 7, 1000 + msg_id, 'тема'
+            messages.append(msg)
+
+        return messages
+
+
+class FakeEmbedder:
+    def __init__(self, embed_ms: float):
+        self.embed_s = embed_ms / 1000
+        self.calls = 0
+        self.model = self
+
+    def encode(self, text: str) -> np.ndarray:
+        self.calls += 1
+        time.sleep(self.embed_s)
+        rng = np.random.default_rng(abs(hash(text)) % 2 ** 32)
+        emb = rng.standard_normal(64).astype(np.float32)
+
+        return emb / np.linalg.norm(emb)
+
+
+async def search_per_hit(api: FakeBotApi, embedder: FakeEmbedder, index: FakeIndex, pattern: str, top_k: int):
+    """The previous handler: the search, then a header and one message per hit, one after another."""
+    message = api.message(f'/search {pattern} {top_k}')
+    msg_emb = await asyncio.to_thread(embedder.model.encode, pattern)
+    results = index.search(message.from_user.id, message.chat.id, msg_emb, top_k)
+
+    if results:
+        await message.answer('Результаты поиска:')
+
+    for r in results:
+        await message.answer(r.msg_text)
+
+
+async def search_paged(api: FakeBotApi, embedder: FakeEmbedder, pattern: str, top_k: int) -> Dict[str, float]:
+    """The paged handler, then a press of the forward button on every page; returns the cost of the two parts."""
+    from src.bot.handlers.topic_commands import search_messages, turn_search_page
+    from src.bot.search import SearchPage
+
+    start, calls = time.perf_counter(), api.calls
+    await search_messages(api.message(f'/search {pattern} {top_k}'), SimpleNamespace(args=f'{pattern} {top_k}'), embedder)
+    first = {'first_s': time.perf_counter() - start, 'first_calls': api.calls - calls}
+
+    turns, turn_s, turn_calls = 0, 0.0, 0
+
+    while api.sent and api.sent[-1][1] is not None:
+        buttons = api.sent[-1][1].inline_keyboard[0]
+
+        if not buttons[-1].text.startswith('Вперёд'):
+            break
+
+        callback_data = SearchPage.unpack(buttons[-1].callback_data)
+        callback = SimpleNamespace(from_user=SimpleNamespace(id=BENCH_USER_ID), message=api.message(''), answer=api.call)
+
+        start, calls = time.perf_counter(), api.calls
+        await turn_search_page(callback, callback_data)
+        turn_s += time.perf_counter() - start
+        turn_calls += api.calls - calls
+        turns += 1
+
+    api.sent.clear()
+
+    return {**first, 'turns': turns, 'turn_s': turn_s / max(turns, 1), 'turn_calls': turn_calls / max(turns, 1)}
+
+
+async def run(searches: int, top_ks: List[int], rows: int, rtt_ms: float, embed_ms: float, search_ms: float, lookup_ms: float):
+    from src.config import SEARCH_OPTIONS
+    from database.msg_controller import MsgController
+
+    index = FakeIndex(rows, search_ms, lookup_ms)
+    MsgController.search_sim_messages = staticmethod(index.search)
+    MsgController.get_messages_by_ids = staticmethod(index.lookup)
+    SEARCH_OPTIONS['max_top_k'] = max(max(top_ks), SEARCH_OPTIONS['max_top_k'])
+
+    for top_k in top_ks:
+        patterns = [f'запрос {i}' for i in range(searches)]
+
+        api, embedder = FakeBotApi(rtt_ms), FakeEmbedder(embed_ms)
+        timings = []
+
+        for pattern in patterns:
+            start = time.perf_counter()
+            await search_per_hit(api, embedder, index, pattern, top_k)
+            timings.append(time.perf_counter() - start)
+
+        print(f'per_hit top_k={top_k}  calls={api.calls / searches:.1f}  p50_s={np.percentile(timings, 50):.3f}  '
+              f'p95_s={np.percentile(timings, 95):.3f}')
+
+        api, embedder = FakeBotApi(rtt_ms), FakeEmbedder(embed_ms)
+        index.searches, index.lookups = 0, 0
+        results = [await search_paged(api, embedder, pattern, top_k) for pattern in patterns]
+        first_s = [r['first_s'] for r in results]
+
+        print(f'paged   top_k={top_k}  calls={np.mean([r["first_calls"] for r in results]):.1f}  '
+              f'p50_s={np.percentile(first_s, 50):.3f}  p95_s={np.percentile(first_s, 95):.3f}  '
+              f'pages={np.mean([r["turns"] for r in results]) + 1:.1f}  '
+              f'turn_calls={np.mean([r["turn_calls"] for r in results]):.1f}  '
+              f'turn_s={np.mean([r["turn_s"] for r in results]):.3f}  '
+              f'encodes={embedder.calls / searches:.1f}  searches={index.searches / searches:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--top-k', type=int, nargs='+', default=[10, 20, 50])
+    parser.add_argument('--rows', type=int, default=5000, help='synthetic messages of the user')
+    parser.add_argument('--rtt-ms', type=float, default=80, help='median round trip of a Bot API call')
+    parser.add_argument('--embed-ms', type=float, default=30, help='time to embed the pattern')
+    parser.add_argument('--search-ms', type=float, default=20, help='time of the similarity search')
+    parser.add_argument('--lookup-ms', type=float, default=2, help='time to read the messages of a page')
+    args = parser.parse_args()
+
+    asyncio.run(run(args.searches, args.top_k, args.rows, args.rtt_ms, args.embed_ms, args.search_ms, args.lookup_ms))
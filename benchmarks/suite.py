@@ -0,0 +1,383 @@
+"""
+Offline microbenchmarks of the pipeline stages with regression tracking against a stored baseline.
+
+Stages:
+
+* `regex`    - the `find_urls` scanner on the corpus and a long token without a match, `is_youtube_url` on URLs;
+* `html`     - paragraph extraction from generated pages of several sizes;
+* `embedder` - `TextEmbedder.encode` at several batch sizes (the model must be in the local cache);
+* `prompt`   - prompt construction by PromptBuilder;
+* `openai`   - `GptClassifier.predict` against a mocked client answering immediately, i.e. the client-side overhead;
+* `postgres` - `save_messages` (one by one and as a MsgBatch) and `search_sim_messages` (database and vector cache)
+  against a local database, under a reserved user id whose rows are deleted afterwards.
+
+Every case is timed for at least `--repeats` calls and `--min-time` seconds after a warm-up call. Stages whose
+dependencies are missing (no model, no database) are reported as skipped. Results are written as JSON to
+`--output`; every case is then compared to the `--baseline` (benchmarks/baseline.json by default, `--baseline ''`
+to skip) by its median and cases slower by more than `--threshold` are flagged, in which case the exit status is 1.
+The committed baseline was recorded offline on the machine described in its `meta` and only has the `regex` and
+`html` stages (see its `skipped`); timings depend on the machine, so re-record it with `--save-baseline` where the
+suite runs. Run as a module from the repository root with the same environment variables as
+`run_bot.sh` (no request leaves the machine, so placeholder tokens are enough):
+
+    python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+    python -m benchmarks.suite --threshold 0.2
+    python -m benchmarks.suite --stages regex html prompt
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+
+# a case is a callable timed as a whole and the number of items it processes per call
+Cases = Dict[str, Tuple[Callable[[], object], int]]
+
+BENCH_USER_ID = -1
+BENCH_CHAT_ID = -1
+BENCH_TOPIC_ID = 1
+
+
+def load_texts(path: str) -> List[str]:
+    """Loads the texts of a JSONL corpus of {"text": ..., "label": ...} records."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line)['text'] for line in f if line.strip()]
+
+
+def load_labels(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return sorted({json.loads(line)['label'] for line in f if line.strip()})
+
+
+def make_page(paragraphs: int) -> str:
+    """A page with navigation, scripts and `paragraphs` paragraphs of text."""
+    body = ''.join(
+        f'<div class="row"><p>Paragraph {i}: <a href="/p/{i}">link</a> with <b>bold</b> and plain text '
+        f'about topic {i % 7}, repeated to a realistic length. {"word " * 40}</p></div>'
+        for i in range(paragraphs)
+    )
+
+    return (
+        '<html><head><title>Page</title><script>var x = 1;</script><style>p {margin: 0}</style></head>'
+        '<body><nav><ul>' + ''.join(f'<li><a href="/{i}">item {i}</a></li>' for i in range(50)) + '</ul></nav>'
+        f'<article>{body}</article><footer>footer</footer></body></html>'
+    )
+
+
+def fake_completion(content: str, prompt_tokens: int) -> SimpleNamespace:
+    """A chat completion response with the fields GptClassifier reads."""
+    return SimpleNamespace(
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=1),
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+
+
+class FakeCompletions:
+    """Answers every request with a fixed class without a network round trip."""
+
+    def __init__(self, answer: str):
+        self.answer = answer
+
+    async def create(self, model: str, messages: List[Dict], **kwargs) -> SimpleNamespace:
+        await asyncio.sleep(0)
+        return fake_completion(self.answer, len(messages[0]['content']) // 4)
+
+
+def regex_cases(args) -> Cases:
+    from src.utils.utils import find_urls, is_youtube_url
+
+    # inputs are repeated so that a call takes long enough to time reliably
+    texts = load_texts(args.corpus) * 20
+    urls = [
+        'https://habr.com/ru/articles/800000/', 'www.example.com/path?query=1#anchor',
+        'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42', 'https://youtu.be/dQw4w9WgXcQ'
+    ] * 100
+    long_tokens = ['a' * 10000] * 10
+
+    def scan_all(inputs):
+        return lambda: [find_urls(text) for text in inputs]
+
+    return {
+        'find_urls/corpus': (scan_all(texts), len(texts)),
+        'find_urls/long_token': (scan_all(long_tokens), len(long_tokens)),
+        'is_youtube_url/urls': (lambda: [is_youtube_url(url) for url in urls], len(urls))
+    }
+
+
+def html_cases(args) -> Cases:
+    from src.utils.utils import extract_text_from_html
+
+    cases = {}
+
+    for paragraphs in (10, 100, 1000):
+        page = make_page(paragraphs)
+        cases[f'extract/{paragraphs}p'] = (lambda page=page: extract_text_from_html(page), 1)
+
+    return cases
+
+
+def embedder_cases(args) -> Cases:
+    from src.config import EMBEDDER_OPTIONS
+    from src.models.embedder import TextEmbedder
+
+    embedder = TextEmbedder(EMBEDDER_OPTIONS['model_name'])
+    texts = (load_texts(args.corpus) * 10)[:256]
+    cases = {}
+
+    for batch_size in (1, 16, 64):
+        cases[f'encode/bs{batch_size}'] = (lambda batch_size=batch_size: embedder.encode(texts, batch_size), len(texts))
+
+    return cases
+
+
+def prompt_cases(args) -> Cases:
+    import yaml
+    from src.config import GPT_VERSION, PROMPT_OPTIONS
+    from src.models.prompt_builder import PromptBuilder
+
+    with open('prompts.yml', 'r', encoding='utf-8') as f:
+        template = yaml.safe_load(f)['msg_classification_prompt']
+
+    builder = PromptBuilder(template, PROMPT_OPTIONS['max_msg_tokens'], GPT_VERSION)
+    texts = load_texts(args.corpus)
+    topics = {name: 1000 + i for i, name in enumerate(load_labels(args.corpus))}
+    long_text = ' '.join(texts) * 5
+
+    return {
+        'build/corpus': (lambda: [builder.build(topics, text) for text in texts], len(texts)),
+        'build/long_text': (lambda: builder.build(topics, long_text), 1)
+    }
+
+
+def openai_cases(args) -> Cases:
+    from src.models.gpt_classifier import GptClassifier
+    from database.msg_data import MsgData, MsgBatch
+
+    texts = load_texts(args.corpus)
+    labels = load_labels(args.corpus)
+    classifier = GptClassifier({name: 1000 + i for i, name in enumerate(labels)})
+    classifier.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(labels[0])))
+    loop = asyncio.new_event_loop()
+
+    def predict_list():
+        messages = [MsgData(BENCH_USER_ID, BENCH_CHAT_ID, i, text) for i, text in enumerate(texts)]
+        return loop.run_until_complete(classifier.predict(messages))
+
+    def predict_batch():
+        batch = MsgBatch([BENCH_USER_ID] * len(texts), [BENCH_CHAT_ID] * len(texts), range(len(texts)), texts)
+        return loop.run_until_complete(classifier.predict(batch))
+
+    return {
+        'predict/list': (predict_list, len(texts)),
+        'predict/batch': (predict_batch, len(texts))
+    }
+
+
+def postgres_cases(args) -> Cases:
+    from src.config import DB_PARAMS
+    from database.pg_connector import PgConnector
+    from database.msg_controller import MsgData, MsgBatch, MsgController
+
+    conn = PgConnector(**DB_PARAMS)
+    x, error, _ = conn.get_data('select 1;', {})
+
+    if x != 0:
+        raise RuntimeError(error)
+
+    cleanup_postgres(conn)
+    conn.save_data('''
+        insert into zib.user_topics(user_id, chat_id, topic_id, topic_name) values(%(user_id)s, %(chat_id)s, %(topic_id)s, 'bench');
+    ''', {'user_id': BENCH_USER_ID, 'chat_id': BENCH_CHAT_ID, 'topic_id': BENCH_TOPIC_ID})
+
+    rng = np.random.default_rng(0)
+    texts = load_texts(args.corpus)
+    next_id = iter(range(1, 2 ** 31))
+
+    def make_messages(n: int) -> List[MsgData]:
+        messages = []
+
+        for i in range(n):
+            msg = MsgData(BENCH_USER_ID, BENCH_CHAT_ID, next(next_id), texts[i % len(texts)])
+            msg.topic_id = BENCH_TOPIC_ID
+            msg.msg_emb = rng.standard_normal(args.dim).astype(np.float32)
+            messages.append(msg)
+
+        return messages
+
+    # the searched history
+    MsgController.save_messages(MsgBatch.from_messages(make_messages(args.rows)))
+    query = rng.standard_normal(args.dim).astype(np.float32)
+
+    def save_batch():
+        return MsgController.save_messages(MsgBatch.from_messages(make_messages(100)))
+
+    return {
+        'save_messages/list': (lambda: MsgController.save_messages(make_messages(100)), 100),
+        'save_messages/batch': (save_batch, 100),
+        'search_sim_messages/db': (lambda: MsgController._search_sim_messages_db(
+            BENCH_USER_ID, BENCH_CHAT_ID, MsgController.storage_emb(query), 3), 1),
+        'search_sim_messages/cached': (lambda: MsgController.search_sim_messages(BENCH_USER_ID, BENCH_CHAT_ID, query, 3), 1)
+    }
+
+
+def cleanup_postgres(conn):
+    """Deletes the rows of the benchmark user."""
+    params = {'user_id': BENCH_USER_ID, 'chat_id': BENCH_CHAT_ID}
+
+    for table in ('user_messages', 'topic_centroids', 'user_topics'):
+        conn.save_data(f'delete from zib.{table} where user_id=%(user_id)s and chat_id=%(chat_id)s;', params)
+
+
+STAGES: Dict[str, Callable] = {
+    'regex': regex_cases,
+    'html': html_cases,
+    'embedder': embedder_cases,
+    'prompt': prompt_cases,
+    'openai': openai_cases,
+    'postgres': postgres_cases
+}
+
+
+def time_case(fn: Callable[[], object], items: int, repeats: int, min_time: float) -> Dict:
+    """Times a case after a warm-up call and returns its latency statistics."""
+    fn()
+    timings = []
+    started = time.perf_counter()
+
+    while len(timings) < repeats or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    median = float(np.median(timings))
+
+    return {
+        'median_ms': median * 1000,
+        'p95_ms': float(np.percentile(timings, 95)) * 1000,
+        'items': items,
+        'us_per_item': median * 1e6 / items,
+        'runs': len(timings)
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_suite(args) -> Dict:
+    """Runs the selected stages and returns the results document."""
+    results, skipped = {}, {}
+
+    for stage in args.stages:
+        try:
+            cases = STAGES[stage](args)
+        except Exception as e:
+            skipped[stage] = f'{type(e).__name__}: {e}'
+            print(f'{stage:<9} skipped: {skipped[stage]}')
+            continue
+
+        try:
+            for case, (fn, items) in cases.items():
+                name = f'{stage}/{case}'
+                results[name] = time_case(fn, items, args.repeats, args.min_time)
+                print(f'{name:<40} ' + '  '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in results[name].items()))
+        finally:
+            if stage == 'postgres':
+                from src.config import DB_PARAMS
+                from database.pg_connector import PgConnector
+                cleanup_postgres(PgConnector(**DB_PARAMS))
+
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()
+        },
+        'results': results,
+        'skipped': skipped
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Prints the change of every case against the baseline and returns the regressed cases."""
+    regressions = []
+
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+
+        if base is None:
+            print(f'{name:<40} new')
+            continue
+
+        change = result['median_ms'] / base['median_ms'] - 1
+        flag = 'REGRESSION' if change > threshold else ''
+
+        if flag:
+            regressions.append(name)
+
+        print(f'{name:<40} {base["median_ms"]:10.3f} -> {result["median_ms"]:10.3f} ms  {change:+7.1%}  {flag}')
+
+    for name in baseline['results'].keys() - current['results'].keys():
+        print(f'{name:<40} missing')
+
+    return regressions
+
+
+def write_json(path: str, document: Dict):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--corpus', default='benchmarks/data/messages.jsonl')
+    parser.add_argument('--repeats', type=int, default=20, help='minimum timed calls per case')
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimum timed seconds per case')
+    parser.add_argument('--dim', type=int, default=312, help='embedding dimension of the postgres stage')
+    parser.add_argument('--rows', type=int, default=5000, help='stored messages searched by the postgres stage')
+    parser.add_argument('--output', default='benchmarks/results/latest.json')
+    parser.add_argument('--baseline', default='benchmarks/baseline.json', help="results file to compare against, '' to skip")
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown of the median flagged as a regression')
+    parser.add_argument('--save-baseline', help='also write the results to this path')
+    args = parser.parse_args()
+
+    # read before a new baseline may replace it
+    baseline = None
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    elif args.baseline:
+        print(f'no baseline at {args.baseline}, nothing to compare against')
+
+    document = run_suite(args)
+    write_json(args.output, document)
+
+    if args.save_baseline:
+        write_json(args.save_baseline, document)
+
+    if baseline is not None:
+        meta = baseline['meta']
+        print(f'baseline {args.baseline}: commit {meta["commit"] or "?"}, {meta["created_at"]}, '
+              f'{meta["processor"] or meta["machine"]} x{meta["cpu_count"]}')
+        regressions = compare(document, baseline, args.threshold)
+
+        if regressions:
+            print(f'{len(regressions)} regression(s) above {args.threshold:.0%}: {", ".join(regressions)}')
+            raise SystemExit(1)
@@ -0,0 +1,100 @@
+"""
+Compares p50/p99 latency of the in-process vector cache against the pgvector search path.
+
+The numpy path runs on synthetic embeddings and needs no database. To benchmark the SQL path as well,
+run with `--db` and the same environment variables as `run_bot.sh`: a synthetic user is inserted into
+`zib.user_messages` and removed afterwards.
+
+    python -m benchmarks.vector_cache --rows 1000 5000 --db
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+import numpy as np
+from database.vector_cache import UserVectors, normalize
+
+BENCH_USER_ID = -1
+BENCH_CHAT_ID = -1
+BENCH_TOPIC_ID = -1
+
+
+def percentiles(fn: Callable, queries: np.ndarray) -> Dict[str, float]:
+    """Runs `fn` for every query and returns p50/p99 latency in milliseconds."""
+    timings = []
+
+    for q in queries:
+        start = time.perf_counter()
+        fn(q)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3)
+    }
+
+
+def make_entry(embs: np.ndarray) -> UserVectors:
+    """Builds a cache entry from raw embeddings."""
+    matrix = np.array([normalize(e) for e in embs], dtype=np.float32)
+    return UserVectors(np.arange(len(embs), dtype=np.int64), [''] * len(embs), matrix)
+
+
+def bench_db(embs: np.ndarray, queries: np.ndarray, top_k: int) -> Dict[str, float]:
+    """Inserts the synthetic user into Postgres and measures `_search_sim_messages_db`."""
+    from psycopg2.extras import execute_values
+    from src.config import DB_PARAMS
+    from database.pg_connector import PgConnector
+    from database.msg_controller import MsgController
+    from database.topic_controller import UserTopicController
+
+    UserTopicController.del_topic(BENCH_USER_ID, BENCH_CHAT_ID, BENCH_TOPIC_ID)
+    UserTopicController.add_topic(BENCH_USER_ID, BENCH_CHAT_ID, BENCH_TOPIC_ID, 'benchmark')
+
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                'insert into zib.user_messages (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb) values %s',
+                [(i, BENCH_USER_ID, BENCH_CHAT_ID, BENCH_TOPIC_ID, '', e.tolist()) for i, e in enumerate(embs)]
+            )
+        conn.commit()
+    finally:
+        pg.disconnect(conn)
+
+    try:
+        return percentiles(lambda q: MsgController._search_sim_messages_db(BENCH_USER_ID, BENCH_CHAT_ID, q, top_k), queries)
+    finally:
+        UserTopicController.del_topic(BENCH_USER_ID, BENCH_CHAT_ID, BENCH_TOPIC_ID)
+
+
+def run(rows: List[int], dim: int, n_queries: int, top_k: int, use_db: bool):
+    """Prints a latency table for every matrix size."""
+    rng = np.random.default_rng(0)
+
+    for n in rows:
+        embs = rng.standard_normal((n, dim)).astype(np.float32)
+        queries = rng.standard_normal((n_queries, dim)).astype(np.float32)
+
+        entry = make_entry(embs)
+        result = {'cache': percentiles(lambda q: entry.search(normalize(q), top_k), queries)}
+
+        if use_db:
+            result['pgvector'] = bench_db(embs, queries, top_k)
+
+        for backend, stats in result.items():
+            print(f'rows={n:<8} dim={dim:<5} {backend:<9} p50={stats["p50_ms"]:.3f} ms  p99={stats["p99_ms"]:.3f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[500, 2000, 10000])
+    parser.add_argument('--dim', type=int, default=312)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--db', action='store_true', help='also benchmark the pgvector path')
+    args = parser.parse_args()
+
+    run(args.rows, args.dim, args.queries, args.top_k, args.db)
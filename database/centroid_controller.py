@@ -0,0 +1,144 @@
+from typing import Dict, Tuple
+import numpy as np
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS
+from database.pg_connector import PgConnector
+
+
+class CentroidController:
+    """
+    A controller class to handle the running mean embeddings of user topics stored in `zib.topic_centroids`.
+    """
+    @staticmethod
+    def get_centroids(user_id: int, chat_id: int) -> Dict[int, Tuple[int, np.ndarray]]:
+        """
+        Retrieves the stored centroids of all topics in a chat computed with the current embedding model version.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+
+        Returns:
+            Dict[int, Tuple[int, np.ndarray]]: A dictionary mapping topic IDs to (message count, centroid),
+            or None in case of an error.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select topic_id, msg_count, centroid::real[]
+            from zib.topic_centroids
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and emb_model_version=%(version)s;
+        '''
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'version': EMBEDDER_OPTIONS['version']
+        }
+
+        x, _, result = conn.get_data(query, params)
+
+        if x != 0:
+            return None
+
+        return {topic_id: (msg_count, np.array(centroid, dtype=np.float32)) for topic_id, msg_count, centroid in result}
+
+    @staticmethod
+    def compute_centroids(user_id: int, chat_id: int) -> Dict[int, Tuple[int, np.ndarray]]:
+        """
+        Computes the centroids of all topics in a chat from the stored messages of the current embedding model version.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+
+        Returns:
+            Dict[int, Tuple[int, np.ndarray]]: A dictionary mapping topic IDs to (message count, centroid),
+            or None in case of an error.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select topic_id, count(*), avg(msg_emb)::real[]
+            from zib.user_messages
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and emb_model_version=%(version)s
+            group by topic_id;
+        '''
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'version': EMBEDDER_OPTIONS['version']
+        }
+
+        x, _, result = conn.get_data(query, params)
+
+        if x != 0:
+            return None
+
+        return {topic_id: (msg_count, np.array(centroid, dtype=np.float32)) for topic_id, msg_count, centroid in result}
+
+    @staticmethod
+    def save_centroid(user_id: int, chat_id: int, topic_id: int, msg_count: int, centroid: np.ndarray) -> int:
+        """
+        Inserts or replaces the centroid of a topic.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+            msg_count (int): The number of messages averaged into the centroid.
+            centroid (np.ndarray): The mean embedding of the topic.
+
+        Returns:
+            int: The result of the upsert operation (0 if successful, error code otherwise).
+        """
+        query = '''
+            insert into zib.topic_centroids(user_id, chat_id, topic_id, msg_count, centroid, emb_model_version)
+            values(%(user_id)s, %(chat_id)s, %(topic_id)s, %(msg_count)s, %(centroid)s, %(version)s)
+            on conflict (user_id, chat_id, topic_id) do update
+                set msg_count=excluded.msg_count, centroid=excluded.centroid, emb_model_version=excluded.emb_model_version;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'topic_id': topic_id,
+            'msg_count': int(msg_count),
+            'centroid': centroid.tolist(),
+            'version': EMBEDDER_OPTIONS['version']
+        }
+
+        result, _ = conn.save_data(query, params)
+
+        return result
+
+    @staticmethod
+    def del_centroid(user_id: int, chat_id: int, topic_id: int) -> int:
+        """
+        Deletes the centroid of a topic.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+
+        Returns:
+            int: The result of the delete operation (0 if successful, error code otherwise).
+        """
+        query = '''
+            delete from zib.topic_centroids where user_id=%(user_id)s and chat_id=%(chat_id)s and topic_id=%(topic_id)s;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'topic_id': topic_id
+        }
+
+        result, _ = conn.save_data(query, params)
+
+        return result
@@ -0,0 +1,284 @@
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import psycopg2
+from loguru import logger
+from src.config import DB_PARAMS, DEDUP_OPTIONS
+from database.pg_connector import PgConnector
+from database.url_content import canonical_url, url_hash
+from src.utils.utils import find_urls, strip_urls
+
+token_pattern = re.compile(r'\w+')
+
+FINGERPRINT_BITS = 64
+BAND_BITS = 8
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def simhash(text: str) -> Optional[int]:
+    """
+    Computes a 64-bit SimHash of the text over word bigrams (single words for one-word texts).
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Optional[int]: The signed 64-bit fingerprint, as stored in Postgres `bigint`, or None for empty texts.
+    """
+    tokens = token_pattern.findall(text.lower())
+
+    if not tokens:
+        return None
+
+    features = [' '.join(tokens[i:i + 2]) for i in range(max(len(tokens) - 1, 1))]
+
+    hashes = np.frombuffer(
+        b''.join(hashlib.blake2b(f.encode('utf-8'), digest_size=8).digest() for f in features),
+        dtype=np.uint8
+    ).reshape(len(features), 8)
+
+    votes = np.unpackbits(hashes, axis=1).sum(axis=0, dtype=np.int32)
+    bits = np.packbits(votes * 2 > len(features))
+
+    return int.from_bytes(bits.tobytes(), 'big', signed=True)
+
+
+def message_fingerprint(text: str) -> Optional[int]:
+    """
+    Fingerprints a message for the duplicate lookup. Links are mostly shared bigrams (`https www`, `youtube com`,
+    `watch v`), so they are removed before the SimHash, and a message that is only links is keyed by the exact hash
+    of its canonical links instead. Other texts need `dedup_min_bigrams` word bigrams to be matched fuzzily; shorter
+    texts are not fingerprinted, as a few words are too little evidence of a repost.
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Optional[int]: The signed 64-bit fingerprint, or None if the message isn't matched.
+    """
+    urls = find_urls(text)
+    tokens = token_pattern.findall(strip_urls(text, urls).lower())
+
+    if len(tokens) - 1 >= DEDUP_OPTIONS['min_bigrams']:
+        return simhash(' '.join(tokens))
+
+    if urls and not tokens:
+        links = set()
+
+        for url in urls:
+            try:
+                links.add(canonical_url(url))
+            except ValueError:
+                links.add(url.lower())
+
+        # a random 64-bit hash is within `max_distance` bits of another one with a negligible probability,
+        # so link-only messages only match messages with the same links
+        return url_hash('\n'.join(sorted(links)))
+
+    return None
+
+
+def hamming(a: int, b: int) -> int:
+    """Returns the number of differing bits between two 64-bit fingerprints."""
+    return bin((a ^ b) & ((1 << FINGERPRINT_BITS) - 1)).count('1')
+
+
+class ChatFingerprints:
+    """
+    Fingerprints of a single (user, chat) pair with a banded index for near-duplicate lookup.
+    The 64 bits are split into 8 bands of 8 bits: two fingerprints within Hamming distance 7
+    always share at least one band, so only the fingerprints in the matching buckets are compared.
+
+    Attributes:
+        fingerprints (List[int]): Fingerprints in insertion order.
+        msg_ids (List[int]): Message identifiers, aligned with the fingerprints.
+        topic_ids (List[int]): Topic identifiers, aligned with the fingerprints.
+    """
+    def __init__(self):
+        self.fingerprints: List[int] = []
+        self.msg_ids: List[int] = []
+        self.topic_ids: List[int] = []
+        self._bands: Dict[Tuple[int, int], List[int]] = {}
+
+    def add(self, fingerprint: int, msg_id: int, topic_id: int):
+        """
+        Adds a fingerprint to the index.
+
+        Args:
+            fingerprint (int): The message fingerprint.
+            msg_id (int): The message identifier.
+            topic_id (int): The topic identifier of the message.
+        """
+        pos = len(self.fingerprints)
+        self.fingerprints.append(fingerprint)
+        self.msg_ids.append(msg_id)
+        self.topic_ids.append(topic_id)
+
+        for band in self._band_keys(fingerprint):
+            self._bands.setdefault(band, []).append(pos)
+
+    def find(self, fingerprint: int, max_distance: int) -> Optional[Tuple[int, int]]:
+        """
+        Finds the closest stored fingerprint within `max_distance` bits.
+
+        Args:
+            fingerprint (int): The fingerprint to look up.
+            max_distance (int): The maximum Hamming distance of a near duplicate.
+
+        Returns:
+            Optional[Tuple[int, int]]: (msg_id, topic_id) of the duplicate, or None if there is no match.
+        """
+        best, best_distance = None, max_distance + 1
+
+        for band in self._band_keys(fingerprint):
+            for pos in self._bands.get(band, ()):
+                distance = hamming(fingerprint, self.fingerprints[pos])
+
+                if distance > max_distance:
+                    continue
+
+                # prefer the most recent copy among equally close ones
+                if distance < best_distance or (distance == best_distance and pos > best):
+                    best, best_distance = pos, distance
+
+        if best is None:
+            return None
+
+        return self.msg_ids[best], self.topic_ids[best]
+
+    @staticmethod
+    def _band_keys(fingerprint: int) -> List[Tuple[int, int]]:
+        return [(i, (fingerprint >> (i * BAND_BITS)) & BAND_MASK) for i in range(FINGERPRINT_BITS // BAND_BITS)]
+
+
+class DuplicateIndex:
+    """
+    A singleton LRU index of message fingerprints per chat used to detect reposts before classification.
+    Chats are loaded lazily from the fingerprints stored in `zib.user_messages` and maintained incrementally as
+    messages are saved. Rows saved before fingerprints were recorded are not indexed: their stored text is enriched
+    and lowercased, so its fingerprint would not match the one of the same message as received.
+
+    Attributes:
+        max_distance (int): The maximum Hamming distance of a near duplicate.
+        max_chats (int): The maximum number of chats kept in memory.
+        lookups (int): The number of lookups since start.
+        hits (int): The number of lookups that found a duplicate.
+    """
+    _instance = None
+
+    def __new__(cls, max_distance: int = DEDUP_OPTIONS['max_distance'], max_chats: int = DEDUP_OPTIONS['max_chats']):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.max_distance = max_distance
+            cls._instance.max_chats = max_chats
+            cls._instance.lookups = 0
+            cls._instance.hits = 0
+            cls._instance._chats: 'OrderedDict[Tuple[int, int], ChatFingerprints]' = OrderedDict()
+            cls._instance._lock = threading.Lock()
+
+        return cls._instance
+
+    def find(self, user_id: int, chat_id: int, fingerprint: int) -> Optional[Tuple[int, int]]:
+        """
+        Looks up a near duplicate of the message in the chat. The first lookup of a chat streams its fingerprints
+        from the database, so it is run off the event loop.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            fingerprint (int): The fingerprint of the new message.
+
+        Returns:
+            Optional[Tuple[int, int]]: (msg_id, topic_id) of the duplicate, or None if there is no match.
+        """
+        chat = self._get(user_id, chat_id)
+        match = chat.find(fingerprint, self.max_distance) if chat is not None else None
+
+        with self._lock:
+            self.lookups += 1
+            self.hits += match is not None
+
+            if self.lookups % DEDUP_OPTIONS['report_every'] == 0:
+                logger.info(f'Duplicate index: {self.hits}/{self.lookups} messages ({self.hit_ratio:.1%}) skipped classification')
+
+        return match
+
+    def add(self, user_id: int, chat_id: int, fingerprint: int, msg_id: int, topic_id: int):
+        """
+        Adds a saved message to the chat's index if the chat is loaded.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            fingerprint (int): The message fingerprint.
+            msg_id (int): The message identifier.
+            topic_id (int): The topic identifier of the message.
+        """
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is not None:
+                chat.add(fingerprint, msg_id, topic_id)
+
+    def invalidate(self, user_id: int, chat_id: int):
+        """
+        Drops the chat's index, e.g. after messages were deleted.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+        """
+        with self._lock:
+            self._chats.pop((user_id, chat_id), None)
+
+    @property
+    def hit_ratio(self) -> float:
+        """The fraction of looked up messages that were served by the index."""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def _get(self, user_id: int, chat_id: int) -> Optional[ChatFingerprints]:
+        key = (user_id, chat_id)
+
+        with self._lock:
+            chat = self._chats.get(key)
+
+            if chat is not None:
+                self._chats.move_to_end(key)
+                return chat
+
+        return self._load(user_id, chat_id)
+
+    def _load(self, user_id: int, chat_id: int) -> Optional[ChatFingerprints]:
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select msg_id, topic_id, msg_fingerprint
+            from zib.user_messages
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and msg_fingerprint is not null
+            order by msg_id;
+        '''
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id
+        }
+
+        chat = ChatFingerprints()
+
+        try:
+            for rows, _ in conn.stream_data(query, params, readonly=True, route_key=(user_id, chat_id)):
+                for msg_id, topic_id, fingerprint in rows:
+                    chat.add(fingerprint, msg_id, topic_id)
+        except psycopg2.Error:
+            return None
+
+        with self._lock:
+            self._chats[(user_id, chat_id)] = chat
+
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+
+        return chat
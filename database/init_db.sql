@@ -19,21 +19,96 @@ create index user_topics_idx on zib.user_topics (user_id, chat_id);
 create unique index user_topics_comp_idx on zib.user_topics (user_id, chat_id, topic_name);
 
 -- user_messages: table
+-- telegram message ids are unique per chat only, hence the chat-scoped key;
+-- hash partitions by user keep every user's rows, indexes and vacuum work small;
+-- the embedding dimension is that of the default model (cointegrated/rubert-tiny2, 312), change `vector(312)` here
+-- and below for another model, `halfvec` storage (emb_storage_type) or a projection (emb_projection_path)
 create table zib.user_messages(
     msg_id integer default 0 not null,
     user_id int default 0 not null,
     chat_id bigint default 0 not null,
     topic_id integer default 0 not null,
     msg_text text default ''::text not null,
-    msg_emb vector not null,
-    constraint user_messages_pkey primary key(msg_id)
-);
+    msg_emb vector(312) not null,
+    emb_model_version smallint default 1 not null,
+    msg_fingerprint bigint,
+    topic_msg_id integer,
+    constraint user_messages_pkey primary key(user_id, chat_id, msg_id)
+) partition by hash(user_id);
+
+-- user_messages: partitions
+do $$
+begin
+    for i in 0..15 loop
+        execute format('create table zib.user_messages_p%s partition of zib.user_messages for values with (modulus 16, remainder %s);', i, i);
+    end loop;
+end $$;
 
 -- user_messages: foreign keys
 alter table zib.user_messages add constraint user_messages_fk
 foreign key(user_id, chat_id, topic_id) references zib.user_topics(user_id, chat_id, topic_id);
 
 -- user_messages: indexes
-create index user_messages_comp_idx1 on zib.user_messages (user_id, chat_id);
-create index user_messages_comp_idx2 on zib.user_messages (user_id, chat_id, topic_id);
-create unique index user_messages_comp_idx3 on zib.user_messages (user_id, chat_id, msg_id);
\ No newline at end of file
+-- (user_id, chat_id) lookups are served by the primary key
+create index user_messages_topic_idx on zib.user_messages (user_id, chat_id, topic_id);
+-- created on every partition, as by database/migrate_partitions.py index
+create index user_messages_emb_idx on zib.user_messages using hnsw (msg_emb vector_cosine_ops);
+
+-- per-user filtered searches must keep scanning the graph until enough rows pass the filter (pgvector >= 0.8)
+do $$
+begin
+    execute format('alter database %I set hnsw.iterative_scan = %L', current_database(), 'relaxed_order');
+end $$;
+
+-- topic_centroids: table
+create table zib.topic_centroids(
+    user_id int default 0 not null,
+    chat_id bigint default 0 not null,
+    topic_id int default 0 not null,
+    msg_count int default 0 not null,
+    centroid vector not null,
+    emb_model_version smallint default 1 not null,
+    constraint topic_centroids_pkey primary key(user_id, chat_id, topic_id)
+);
+
+-- topic_centroids: foreign keys
+alter table zib.topic_centroids add constraint topic_centroids_fk
+foreign key(user_id, chat_id, topic_id) references zib.user_topics(user_id, chat_id, topic_id);
+
+-- job_checkpoints: table
+-- progress of resumable maintenance jobs (migrations, backfills)
+create table zib.job_checkpoints(
+    job_name text not null,
+    checkpoint jsonb not null,
+    updated_at timestamptz default now() not null,
+    constraint job_checkpoints_pkey primary key(job_name)
+);
+
+-- url_content: table
+-- extracted text of links shared by all users, keyed by a hash of the canonical url;
+-- lease_owner/lease_until let a single bot replica fetch a link while the others wait for its row
+create table zib.url_content(
+    url_hash bigint not null,
+    url text not null,
+    content text,
+    emb vector,
+    emb_model_version smallint,
+    fetched_at timestamptz,
+    etag text,
+    last_modified text,
+    lease_owner text,
+    lease_until timestamptz,
+    constraint url_content_pkey primary key(url_hash)
+);
+
+-- usage: table
+-- OpenAI requests, tokens and cost per user and day, written in batches by the usage ledger
+create table zib.usage(
+    user_id int not null,
+    day date not null,
+    requests int default 0 not null,
+    prompt_tokens bigint default 0 not null,
+    completion_tokens bigint default 0 not null,
+    cost_usd double precision default 0 not null,
+    constraint usage_pkey primary key(user_id, day)
+);
\ No newline at end of file
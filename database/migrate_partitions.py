@@ -0,0 +1,201 @@
+"""
+Online migration of `zib.user_messages` to a table hash-partitioned by `user_id` with a (user_id, chat_id, msg_id) key.
+
+    python database/migrate_partitions.py prepare --partitions 16 --dim 312
+    python database/migrate_partitions.py backfill --batch-size 5000
+    python database/migrate_partitions.py index
+    python database/migrate_partitions.py swap
+
+`prepare` adds the columns of later releases that the old table may lack, creates `zib.user_messages_part` and a
+trigger that mirrors every write to the old table into it, so the bot keeps running during the backfill. `backfill` copies existing rows in keyset-ordered batches and
+checkpoints its position in `zib.job_checkpoints`, so it can be interrupted and resumed. `index` builds the
+per-partition HNSW indexes after the data is loaded. `swap` renames the tables in a single transaction and
+keeps the old table, without its foreign key to `zib.user_topics`, as `zib.user_messages_old` until it is
+dropped manually.
+"""
+import argparse
+import json
+from loguru import logger
+from src.config import DB_PARAMS, EMB_STORAGE_OPTIONS
+from database.pg_connector import PgConnector
+
+JOB_NAME = 'partition_user_messages'
+
+PREPARE_SQL = '''
+    -- the trigger and the backfill copy every column of the new table
+    alter table zib.user_messages add column if not exists emb_model_version smallint default 1 not null;
+    alter table zib.user_messages add column if not exists msg_fingerprint bigint;
+    alter table zib.user_messages add column if not exists topic_msg_id integer;
+
+    create table if not exists zib.job_checkpoints(
+        job_name text not null,
+        checkpoint jsonb not null,
+        updated_at timestamptz default now() not null,
+        constraint job_checkpoints_pkey primary key(job_name)
+    );
+
+    create table zib.user_messages_part(
+        msg_id integer default 0 not null,
+        user_id int default 0 not null,
+        chat_id bigint default 0 not null,
+        topic_id integer default 0 not null,
+        msg_text text default ''::text not null,
+        msg_emb {emb_type} not null,
+        emb_model_version smallint default 1 not null,
+        msg_fingerprint bigint,
+        topic_msg_id integer,
+        constraint user_messages_part_pkey primary key(user_id, chat_id, msg_id)
+    ) partition by hash(user_id);
+
+    do $$
+    begin
+        for i in 0..{last_partition} loop
+            execute format('create table zib.user_messages_part_p%s partition of zib.user_messages_part for values with (modulus {partitions}, remainder %s);', i, i);
+        end loop;
+    end $$;
+
+    alter table zib.user_messages_part add constraint user_messages_part_fk
+    foreign key(user_id, chat_id, topic_id) references zib.user_topics(user_id, chat_id, topic_id);
+
+    create index user_messages_part_topic_idx on zib.user_messages_part (user_id, chat_id, topic_id);
+
+    create or replace function zib.mirror_user_messages() returns trigger as $$
+    begin
+        if tg_op = 'DELETE' then
+            delete from zib.user_messages_part
+            where user_id=old.user_id and chat_id=old.chat_id and msg_id=old.msg_id;
+            return old;
+        end if;
+
+        insert into zib.user_messages_part (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint, topic_msg_id)
+        values (new.msg_id, new.user_id, new.chat_id, new.topic_id, new.msg_text, new.msg_emb, new.emb_model_version, new.msg_fingerprint, new.topic_msg_id)
+        on conflict (user_id, chat_id, msg_id) do update
+            set topic_id=excluded.topic_id, msg_text=excluded.msg_text, msg_emb=excluded.msg_emb,
+                emb_model_version=excluded.emb_model_version, msg_fingerprint=excluded.msg_fingerprint,
+                topic_msg_id=excluded.topic_msg_id;
+        return new;
+    end $$ language plpgsql;
+
+    create trigger user_messages_mirror after insert or update or delete on zib.user_messages
+    for each row execute function zib.mirror_user_messages();
+'''
+
+BACKFILL_SQL = '''
+    with batch as (
+        select msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint, topic_msg_id
+        from zib.user_messages
+        where msg_id > %(last_id)s
+        order by msg_id
+        limit %(batch_size)s
+    ), ins as (
+        insert into zib.user_messages_part (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint, topic_msg_id)
+        select msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint, topic_msg_id from batch
+        on conflict (user_id, chat_id, msg_id) do nothing
+    )
+    select max(msg_id), count(*) from batch;
+'''
+
+INDEX_SQL = '''
+    create index if not exists user_messages_part_emb_idx on zib.user_messages_part
+    using hnsw (msg_emb {emb_type}_cosine_ops);
+
+    -- per-user filtered searches must keep scanning the graph until enough rows pass the filter (pgvector >= 0.8)
+    do $$
+    begin
+        execute format('alter database %I set hnsw.iterative_scan = %L', current_database(), 'relaxed_order');
+    end $$;
+'''
+
+SWAP_SQL = '''
+    lock table zib.user_messages in access exclusive mode;
+    drop trigger user_messages_mirror on zib.user_messages;
+    drop function zib.mirror_user_messages();
+    alter table zib.user_messages rename to user_messages_old;
+    -- topics must stay deletable while the old table is kept
+    alter table zib.user_messages_old drop constraint if exists user_messages_fk;
+    alter table zib.user_messages_part rename to user_messages;
+    delete from zib.job_checkpoints where job_name = %(job_name)s;
+'''
+
+
+def execute(query: str, params: dict = None):
+    """Executes a statement in its own transaction."""
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+
+def backfill(batch_size: int):
+    """Copies the old table into the partitioned one, resuming from the last checkpoint."""
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('select checkpoint from zib.job_checkpoints where job_name = %s;', (JOB_NAME,))
+            row = cursor.fetchone()
+
+        last_id = row[0]['last_id'] if row else -1
+        done = 0
+
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute(BACKFILL_SQL, {'last_id': last_id, 'batch_size': batch_size})
+                max_id, count = cursor.fetchone()
+
+                if count == 0:
+                    conn.commit()
+                    break
+
+                last_id = max_id
+                cursor.execute('''
+                    insert into zib.job_checkpoints(job_name, checkpoint) values(%(job_name)s, %(checkpoint)s)
+                    on conflict (job_name) do update set checkpoint=excluded.checkpoint, updated_at=now();
+                ''', {'job_name': JOB_NAME, 'checkpoint': json.dumps({'last_id': last_id})})
+
+            conn.commit()
+            done += count
+            logger.info(f'Copied {done} rows, last msg_id {last_id}')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    prepare_parser = subparsers.add_parser('prepare')
+    prepare_parser.add_argument('--partitions', type=int, default=16)
+    prepare_parser.add_argument('--dim', type=int, required=True, help='embedding dimension, required by the vector index')
+
+    backfill_parser = subparsers.add_parser('backfill')
+    backfill_parser.add_argument('--batch-size', type=int, default=5000)
+
+    subparsers.add_parser('index')
+    subparsers.add_parser('swap')
+
+    args = parser.parse_args()
+    emb_type = EMB_STORAGE_OPTIONS['type']
+
+    if args.command == 'prepare':
+        execute(PREPARE_SQL.format(emb_type=f'{emb_type}({args.dim})', partitions=args.partitions, last_partition=args.partitions - 1))
+    elif args.command == 'backfill':
+        backfill(args.batch_size)
+    elif args.command == 'index':
+        execute(INDEX_SQL.format(emb_type=emb_type))
+    else:
+        execute(SWAP_SQL, {'job_name': JOB_NAME})
+
+    logger.info(f'{args.command} completed')
@@ -1,37 +1,53 @@
-from typing import List
-from src.config import DB_PARAMS
+from typing import Iterator, List, Tuple, Union
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS, VECTOR_CACHE_OPTIONS, EMB_STORAGE_OPTIONS, DEDUP_OPTIONS, CENTROID_OPTIONS
+from src.models.projection import get_projection
+from src.models.centroid_classifier import CentroidClassifier
 from database.pg_connector import PgConnector
-from psycopg2.extensions import AsIs
+from database.vector_cache import VectorCache
+from database.dup_index import DuplicateIndex
+from database.msg_data import MsgData, MsgBatch
 import numpy as np
 
+# hot statements run as prepared statements, searches may be served by the read replica;
+# vectors of other embedding model versions are not comparable and are skipped
+PgConnector.register_statement('search_sim_messages', f'''
+    select msg_id, msg_text, 1 - (msg_emb <=> $3::{EMB_STORAGE_OPTIONS['type']}) as cos_sim
+    from zib.user_messages
+    where user_id=$1 and chat_id=$2 and emb_model_version=$5
+    order by cos_sim desc
+    limit $4
+''')
 
-class MsgData:
-    """
-    A class to represent message data within a chat application.
-
-    Attributes:
-        user_id (int): Unique identifier for the user.
-        chat_id (int): Unique identifier for the chat.
-        topic_id (int): Identifier for the topic within the chat; defaults to 0.
-        msg_id (int): Unique identifier for the message.
-        msg_text (str): Text content of the message.
-        msg_emb (np.ndarray): Embedding vector of the message, initially empty.
-        category (str): Category of the message, initially 'unknown'.
-    """
-    def __init__(self, user_id: int, chat_id: int, msg_id: int, msg_text: str):
-        self.user_id = user_id
-        self.chat_id = chat_id
-        self.topic_id = 0
-        self.msg_id = msg_id
-        self.msg_text = msg_text
-        self.msg_emb = np.empty(0)
-        self.category = 'unknown'
+PgConnector.register_statement('save_message', f'''
+    insert into zib.user_messages (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint)
+    values($1, $2, $3, $4, $5, $6::{EMB_STORAGE_OPTIONS['type']}, $7, $8)
+    on conflict do nothing
+''')
 
 
 class MsgController:
     """
     A controller class to handle message data operations such as searching for similar messages and saving messages to a database.
     """
+    @staticmethod
+    def storage_emb(msg_emb: np.ndarray) -> np.ndarray:
+        """
+        Converts an embedding produced by the embedder to the form stored in `zib.user_messages`.
+        The same conversion is applied on write and at query time.
+
+        Args:
+            msg_emb (np.ndarray): The embedding vector produced by the embedder.
+
+        Returns:
+            np.ndarray: The projected embedding, or the input if no projection is configured.
+        """
+        projection = get_projection(EMB_STORAGE_OPTIONS['projection_path'])
+
+        if projection is None:
+            return msg_emb
+
+        return projection.transform(msg_emb)
+
     @staticmethod
     def search_sim_messages(user_id: int, chat_id: int, msg_emb: np.ndarray, top_k: int = 3) -> List[MsgData]:
         """
@@ -46,24 +62,36 @@ class MsgController:
         Returns:
             List[MsgData]: A list of MsgData instances representing the top_k similar messages.
         """
-        conn = PgConnector(**DB_PARAMS)
+        top_k = int(top_k)
+        msg_emb = MsgController.storage_emb(msg_emb)
 
-        query = '''
-            select msg_id, msg_text, 1 - (msg_emb <=> '%(msg_emb)s') as cos_sim
-            from zib.user_messages
-            where user_id=%(user_id)s and chat_id=%(chat_id)s
-            order by cos_sim desc
-            limit %(top_k)s;
-        '''
+        if VECTOR_CACHE_OPTIONS['enabled']:
+            result = VectorCache().search(user_id, chat_id, msg_emb, top_k)
 
-        params = {
-            'user_id': user_id,
-            'chat_id': chat_id,
-            'msg_emb': AsIs(msg_emb.tolist()),
-            'top_k': top_k
-        }
+            if result is not None:
+                return [MsgData(user_id, chat_id, msg_id, msg_text) for msg_id, msg_text, _ in result]
+
+        return MsgController._search_sim_messages_db(user_id, chat_id, msg_emb, top_k)
+
+    @staticmethod
+    def _search_sim_messages_db(user_id: int, chat_id: int, msg_emb: np.ndarray, top_k: int) -> List[MsgData]:
+        """
+        Searches for similar messages with pgvector, bypassing the in-process cache.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_emb (np.ndarray): The stored form of the query embedding, see `storage_emb`.
+            top_k (int): The number of top similar messages to retrieve.
+
+        Returns:
+            List[MsgData]: A list of MsgData instances representing the top_k similar messages.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        params = (user_id, chat_id, str(msg_emb.tolist()), top_k, EMBEDDER_OPTIONS['version'])
 
-        x, _, result = conn.get_data(query, params)
+        x, _, result = conn.get_prepared('search_sim_messages', params, readonly=True, route_key=(user_id, chat_id))
 
         if x != 0:
             return None
@@ -76,40 +104,310 @@ class MsgController:
 
         return messages
 
-
     @staticmethod
-    def save_messages(messages: List[MsgData]) -> int:
+    def get_messages_by_ids(user_id: int, chat_id: int, msg_ids: List[int]) -> List[MsgData]:
         """
-        Saves a list of message objects to the database.
+        Retrieves messages with their topics by their identifiers, e.g. a page of search results.
 
         Args:
-            messages (List[MsgData]): List of MsgData objects to be saved.
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_ids (List[int]): Identifiers of the messages.
 
         Returns:
-            int: Number of messages that failed to be saved.
+            List[MsgData]: Messages in the order of `msg_ids` with topic_id, topic_msg_id and the topic name as
+            category; deleted messages are left out. None in case of an error.
         """
+        if not msg_ids:
+            return []
+
+        conn = PgConnector(**DB_PARAMS)
+
         query = '''
-            insert into zib.user_messages (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb)
-            values(%(msg_id)s, %(user_id)s, %(chat_id)s, %(topic_id)s, %(msg_text)s, %(msg_emb)s)
-            on conflict do nothing;
+            select m.msg_id, m.msg_text, m.topic_id, m.topic_msg_id, t.topic_name
+            from zib.user_messages m
+            join zib.user_topics t on t.user_id=m.user_id and t.chat_id=m.chat_id and t.topic_id=m.topic_id
+            where m.user_id=%(user_id)s and m.chat_id=%(chat_id)s and m.msg_id=any(%(msg_ids)s);
         '''
 
+        params = {'user_id': user_id, 'chat_id': chat_id, 'msg_ids': list(msg_ids)}
+
+        x, _, result = conn.get_data(query, params, readonly=True, route_key=(user_id, chat_id))
+
+        if x != 0:
+            return None
+
+        found = {}
+
+        for msg_id, msg_text, topic_id, topic_msg_id, topic_name in result:
+            data = MsgData(user_id, chat_id, msg_id, msg_text)
+            data.topic_id, data.topic_msg_id, data.category = topic_id, topic_msg_id, topic_name
+            found[msg_id] = data
+
+        return [found[msg_id] for msg_id in msg_ids if msg_id in found]
+
+
+    @staticmethod
+    def save_messages(messages: Union[List[MsgData], MsgBatch]) -> int:
+        """
+        Saves messages to the database. A MsgBatch is inserted with a single bulk statement.
+
+        Args:
+            messages (Union[List[MsgData], MsgBatch]): List of MsgData objects or a batch to be saved.
+
+        Returns:
+            int: Number of messages that failed to be saved.
+
+        Raises:
+            ValueError: If a MsgBatch is not embedded.
+        """
+        if isinstance(messages, MsgBatch):
+            return MsgController._save_batch(messages)
+
         conn = PgConnector(**DB_PARAMS)
         err_qty = 0
 
         for msg in messages:
-            params = {
-                'msg_id': msg.msg_id,
-                'user_id': msg.user_id,
-                'chat_id': msg.chat_id,
-                'topic_id': msg.topic_id,
-                'msg_text': msg.msg_text,
-                'msg_emb': msg.msg_emb.tolist()
-            }
+            msg_emb = MsgController.storage_emb(msg.msg_emb)
+
+            params = (msg.msg_id, msg.user_id, msg.chat_id, msg.topic_id, msg.msg_text, str(msg_emb.tolist()),
+                      EMBEDDER_OPTIONS['version'], msg.msg_fingerprint)
 
-            result, msg = conn.save_data(query, params)
+            result, _ = conn.save_prepared('save_message', params, route_key=(msg.user_id, msg.chat_id))
 
             if result != 0:
                 err_qty += 1
+                continue
+
+            if VECTOR_CACHE_OPTIONS['enabled']:
+                VectorCache().append(msg.user_id, msg.chat_id, msg.msg_id, msg.msg_text, msg_emb)
+
+            if DEDUP_OPTIONS['enabled'] and msg.msg_fingerprint is not None:
+                DuplicateIndex().add(msg.user_id, msg.chat_id, msg.msg_fingerprint, msg.msg_id, msg.topic_id)
+
+            if CENTROID_OPTIONS['enabled']:
+                CentroidClassifier().add(msg.user_id, msg.chat_id, msg.topic_id, msg_emb)
 
         return err_qty
+
+    @staticmethod
+    def _save_batch(batch: MsgBatch) -> int:
+        if len(batch) == 0:
+            return 0
+
+        query = '''
+            insert into zib.user_messages (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint)
+            values %s
+            on conflict do nothing;
+        '''
+
+        if batch.msg_embs is None:
+            raise ValueError('MsgBatch has no embeddings, encode it with TextEmbedder before saving.')
+
+        conn = PgConnector(**DB_PARAMS)
+        msg_embs = MsgController.storage_emb(batch.msg_embs)
+        fingerprints = [None] * len(batch) if batch.msg_fingerprints is None else batch.msg_fingerprints.tolist()
+        version = EMBEDDER_OPTIONS['version']
+
+        rows = [
+            (msg_id, user_id, chat_id, topic_id, msg_text, str(msg_emb), version, fingerprint)
+            for msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, fingerprint in zip(
+                batch.msg_ids.tolist(), batch.user_ids.tolist(), batch.chat_ids.tolist(), batch.topic_ids.tolist(),
+                batch.msg_texts, msg_embs.tolist(), fingerprints
+            )
+        ]
+
+        keys = set(zip(batch.user_ids.tolist(), batch.chat_ids.tolist()))
+        template = f"(%s, %s, %s, %s, %s, %s::{EMB_STORAGE_OPTIONS['type']}, %s, %s)"
+
+        result, _ = conn.save_values(query, rows, template, route_keys=keys)
+
+        if result != 0:
+            return len(batch)
+
+        if VECTOR_CACHE_OPTIONS['enabled']:
+            for i, (user_id, chat_id, msg_id) in enumerate(zip(batch.user_ids.tolist(), batch.chat_ids.tolist(), batch.msg_ids.tolist())):
+                VectorCache().append(user_id, chat_id, msg_id, batch.msg_texts[i], msg_embs[i])
+
+        if DEDUP_OPTIONS['enabled'] and batch.msg_fingerprints is not None:
+            for user_id, chat_id, fingerprint, msg_id, topic_id in zip(
+                batch.user_ids.tolist(), batch.chat_ids.tolist(), fingerprints, batch.msg_ids.tolist(), batch.topic_ids.tolist()
+            ):
+                DuplicateIndex().add(user_id, chat_id, fingerprint, msg_id, topic_id)
+
+        # one centroid update per topic instead of one per message
+        if CENTROID_OPTIONS['enabled']:
+            groups = {}
+
+            for i, key in enumerate(zip(batch.user_ids.tolist(), batch.chat_ids.tolist(), batch.topic_ids.tolist())):
+                groups.setdefault(key, []).append(i)
+
+            for (user_id, chat_id, topic_id), rows_idx in groups.items():
+                CentroidClassifier().add_many(user_id, chat_id, topic_id, msg_embs[rows_idx])
+
+        return 0
+
+    @staticmethod
+    def save_duplicate(message: MsgData, src_msg_id: int) -> int:
+        """
+        Saves a repost of an already stored message, copying its text and embedding
+        instead of enriching and embedding the new message again.
+
+        Args:
+            message (MsgData): The new message with its topic_id set.
+            src_msg_id (int): The identifier of the stored duplicate.
+
+        Returns:
+            int: The result of the insert operation (0 if successful, error code otherwise).
+        """
+        query = '''
+            insert into zib.user_messages (msg_id, user_id, chat_id, topic_id, msg_text, msg_emb, emb_model_version, msg_fingerprint)
+            select %(msg_id)s, user_id, chat_id, %(topic_id)s, msg_text, msg_emb, emb_model_version, %(msg_fingerprint)s
+            from zib.user_messages
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and msg_id=%(src_msg_id)s
+            on conflict do nothing;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        params = {
+            'msg_id': message.msg_id,
+            'user_id': message.user_id,
+            'chat_id': message.chat_id,
+            'topic_id': message.topic_id,
+            'msg_fingerprint': message.msg_fingerprint,
+            'src_msg_id': src_msg_id
+        }
+
+        result, _ = conn.save_data(query, params, route_key=(message.user_id, message.chat_id))
+
+        if result != 0:
+            return result
+
+        if VECTOR_CACHE_OPTIONS['enabled']:
+            VectorCache().duplicate(message.user_id, message.chat_id, src_msg_id, message.msg_id)
+
+        if DEDUP_OPTIONS['enabled'] and message.msg_fingerprint is not None:
+            DuplicateIndex().add(message.user_id, message.chat_id, message.msg_fingerprint, message.msg_id, message.topic_id)
+
+        return result
+
+    @staticmethod
+    def iter_messages(user_id: int, chat_id: int, topic_id: int = None,
+                      itersize: int = None) -> Iterator[Tuple[List[MsgData], np.ndarray]]:
+        """
+        Streams the stored messages of a chat embedded with the current model version in batches,
+        for scans over the full history.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): Only messages of this topic if set.
+            itersize (int): Messages per batch, `db_stream_itersize` by default.
+
+        Yields:
+            Tuple[List[MsgData], np.ndarray]: The messages of the batch with topic_id and topic_msg_id set, and their stored
+            embeddings as an (n, dim) block that is overwritten by the next batch.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select msg_id, topic_id, topic_msg_id, msg_text, msg_emb::text
+            from zib.user_messages
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and emb_model_version=%(version)s
+                and (%(topic_id)s is null or topic_id=%(topic_id)s)
+            order by msg_id;
+        '''
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'version': EMBEDDER_OPTIONS['version'],
+            'topic_id': topic_id
+        }
+
+        for rows, embs in conn.stream_data(query, params, itersize, emb_column=4, readonly=True, route_key=(user_id, chat_id)):
+            messages = []
+
+            for msg_id, msg_topic_id, topic_msg_id, msg_text in rows:
+                data = MsgData(user_id, chat_id, msg_id, msg_text)
+                data.topic_id = msg_topic_id
+                data.topic_msg_id = topic_msg_id
+                messages.append(data)
+
+            yield messages, embs
+
+    @staticmethod
+    def set_topic_msg_id(user_id: int, chat_id: int, msg_id: int, topic_msg_id: int) -> int:
+        """
+        Records the identifier of the copy of a message forwarded into its topic.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_id (int): The identifier of the original message.
+            topic_msg_id (int): The identifier of the forwarded copy.
+
+        Returns:
+            int: The result of the update operation (0 if successful, error code otherwise).
+        """
+        query = '''
+            update zib.user_messages set topic_msg_id=%(topic_msg_id)s
+            where user_id=%(user_id)s and chat_id=%(chat_id)s and msg_id=%(msg_id)s;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'msg_id': msg_id,
+            'topic_msg_id': topic_msg_id
+        }
+
+        result, _ = conn.save_data(query, params, route_key=(user_id, chat_id))
+
+        return result
+
+    @staticmethod
+    def move_messages(user_id: int, chat_id: int, topic_id: int, msg_ids: List[int], topic_msg_ids: List[int]) -> int:
+        """
+        Reassigns stored messages to another topic in a single statement.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The identifier of the target topic.
+            msg_ids (List[int]): The identifiers of the moved messages.
+            topic_msg_ids (List[int]): The identifiers of their copies in the target topic, aligned with msg_ids;
+                None where unknown.
+
+        Returns:
+            int: The result of the update operation (0 if successful, error code otherwise).
+        """
+        query = '''
+            update zib.user_messages m set topic_id=%(topic_id)s, topic_msg_id=v.topic_msg_id
+            from unnest(%(msg_ids)s::integer[], %(topic_msg_ids)s::integer[]) as v(msg_id, topic_msg_id)
+            where m.user_id=%(user_id)s and m.chat_id=%(chat_id)s and m.msg_id=v.msg_id;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'topic_id': topic_id,
+            'msg_ids': list(msg_ids),
+            'topic_msg_ids': list(topic_msg_ids)
+        }
+
+        result, _ = conn.save_data(query, params, route_key=(user_id, chat_id))
+
+        if result != 0:
+            return result
+
+        # the fingerprint index stores topic ids
+        if DEDUP_OPTIONS['enabled']:
+            DuplicateIndex().invalidate(user_id, chat_id)
+
+        return result
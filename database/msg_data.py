@@ -0,0 +1,141 @@
+from typing import List, Optional, Sequence
+import numpy as np
+
+# shared placeholder of messages that are not embedded yet, instead of an array per instance
+EMPTY_EMB = np.empty(0, dtype=np.float32)
+EMPTY_EMB.flags.writeable = False
+
+
+class MsgData:
+    """
+    A class to represent message data within a chat application.
+
+    Attributes:
+        user_id (int): Unique identifier for the user.
+        chat_id (int): Unique identifier for the chat.
+        topic_id (int): Identifier for the topic within the chat; defaults to 0.
+        msg_id (int): Unique identifier for the message.
+        msg_text (str): Text content of the message.
+        msg_emb (np.ndarray): Embedding vector of the message, initially empty.
+        msg_fingerprint (int): SimHash of the message as received, before enrichment; None if not computed.
+        topic_msg_id (int): Identifier of the copy of the message forwarded into its topic; None if not known.
+        category (str): Category of the message, initially 'unknown'.
+    """
+    __slots__ = ('user_id', 'chat_id', 'topic_id', 'msg_id', 'msg_text', 'msg_emb', 'msg_fingerprint', 'topic_msg_id', 'category')
+
+    def __init__(self, user_id: int, chat_id: int, msg_id: int, msg_text: str):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.topic_id = 0
+        self.msg_id = msg_id
+        self.msg_text = msg_text
+        self.msg_emb = EMPTY_EMB
+        self.msg_fingerprint = None
+        self.topic_msg_id = None
+        self.category = 'unknown'
+
+
+class MsgBatch:
+    """
+    A columnar batch of messages for bulk paths (imports, re-embedding, batch classification): parallel identifier
+    arrays, a list of texts and one contiguous embedding matrix instead of a MsgData object and an array per message.
+
+    Attributes:
+        user_ids (np.ndarray): int64 user identifiers.
+        chat_ids (np.ndarray): int64 chat identifiers.
+        msg_ids (np.ndarray): int64 message identifiers.
+        topic_ids (np.ndarray): int64 topic identifiers, 0 until assigned.
+        msg_texts (List[str]): Message texts.
+        msg_embs (np.ndarray): (n, dim) float32 embeddings, None until the batch is embedded.
+        msg_fingerprints (np.ndarray): int64 SimHash fingerprints, None if not computed.
+        categories (List[str]): Predicted categories, None where not classified.
+    """
+    __slots__ = ('user_ids', 'chat_ids', 'msg_ids', 'topic_ids', 'msg_texts', 'msg_embs', 'msg_fingerprints', 'categories')
+
+    def __init__(self, user_ids: Sequence[int], chat_ids: Sequence[int], msg_ids: Sequence[int], msg_texts: List[str],
+                 topic_ids: Sequence[int] = None, msg_embs: np.ndarray = None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.chat_ids = np.asarray(chat_ids, dtype=np.int64)
+        self.msg_ids = np.asarray(msg_ids, dtype=np.int64)
+        self.topic_ids = np.zeros(len(msg_texts), dtype=np.int64) if topic_ids is None else np.asarray(topic_ids, dtype=np.int64)
+        self.msg_texts = list(msg_texts)
+        self.msg_embs = None if msg_embs is None else np.ascontiguousarray(msg_embs, dtype=np.float32)
+        self.msg_fingerprints = None
+        self.categories: List[Optional[str]] = [None] * len(msg_texts)
+
+    def __len__(self) -> int:
+        return len(self.msg_texts)
+
+    @classmethod
+    def from_messages(cls, messages: List[MsgData]) -> 'MsgBatch':
+        """
+        Builds a batch from message objects; embeddings are stacked if all messages are embedded.
+
+        Args:
+            messages (List[MsgData]): The messages.
+
+        Returns:
+            MsgBatch: The batch.
+        """
+        batch = cls(
+            [msg.user_id for msg in messages], [msg.chat_id for msg in messages], [msg.msg_id for msg in messages],
+            [msg.msg_text for msg in messages], [msg.topic_id for msg in messages]
+        )
+
+        if messages and all(len(msg.msg_emb) for msg in messages):
+            batch.msg_embs = np.stack([msg.msg_emb for msg in messages]).astype(np.float32, copy=False)
+
+        if messages and all(msg.msg_fingerprint is not None for msg in messages):
+            batch.msg_fingerprints = np.array([msg.msg_fingerprint for msg in messages], dtype=np.int64)
+
+        batch.categories = [msg.category for msg in messages]
+
+        return batch
+
+    def row(self, i: int) -> MsgData:
+        """
+        Returns a message object for one row; its embedding is a view into the batch matrix.
+
+        Args:
+            i (int): The row index.
+
+        Returns:
+            MsgData: The message.
+        """
+        msg = MsgData(int(self.user_ids[i]), int(self.chat_ids[i]), int(self.msg_ids[i]), self.msg_texts[i])
+        msg.topic_id = int(self.topic_ids[i])
+
+        if self.msg_embs is not None:
+            msg.msg_emb = self.msg_embs[i]
+
+        if self.msg_fingerprints is not None:
+            msg.msg_fingerprint = int(self.msg_fingerprints[i])
+
+        if self.categories[i] is not None:
+            msg.category = self.categories[i]
+
+        return msg
+
+    def take(self, rows: Sequence[int]) -> 'MsgBatch':
+        """
+        Returns a new batch with the given rows.
+
+        Args:
+            rows (Sequence[int]): Row indices or a boolean mask.
+
+        Returns:
+            MsgBatch: The selected rows.
+        """
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows, dtype=np.int64)
+
+        batch = MsgBatch(
+            self.user_ids[rows], self.chat_ids[rows], self.msg_ids[rows], [self.msg_texts[i] for i in rows],
+            self.topic_ids[rows], None if self.msg_embs is None else self.msg_embs[rows]
+        )
+
+        if self.msg_fingerprints is not None:
+            batch.msg_fingerprints = self.msg_fingerprints[rows]
+
+        batch.categories = [self.categories[i] for i in rows]
+
+        return batch
@@ -1,19 +1,39 @@
+import itertools
+import time
 import psycopg2
 from psycopg2 import pool
-from typing import Tuple, Dict, List
+from psycopg2.extras import execute_values
+from typing import Tuple, Dict, List, Optional, Sequence, Iterator
+import numpy as np
 from loguru import logger
+from src.config import DB_REPLICA_PARAMS, DB_ROUTING_OPTIONS, DB_STREAM_OPTIONS
 
 
 class PgConnector:
     """
     A singleton class to manage connections to a PostgreSQL database.
 
+    Read-only queries can be routed to an optional replica. The replica is used only while its replay lag
+    is below `max_replica_lag_s` and the user has not written within the last `sticky_s` seconds;
+    otherwise, and on replica errors, reads go to the primary.
+
+    Hot queries are registered once with `register_statement` and executed as named server-side
+    prepared statements, prepared lazily on every pooled connection.
+
+    Large result sets are read with `stream_data`, which fetches them through a named server-side cursor
+    in batches of `itersize` rows instead of materialising the whole result.
+
     Attributes:
         _instance (PgConnector): Singleton instance of PgConnector.
         _connection_pool (psycopg2.pool.SimpleConnectionPool): Connection pool for managing database connections.
+        _replica_pool (psycopg2.pool.SimpleConnectionPool): Connection pool of the read replica, None if not configured.
+        _statements (Dict[str, str]): Registered statements by name.
     """
     _instance = None
     _connection_pool = None
+    _replica_pool = None
+    _statements: Dict[str, str] = {}
+    _cursor_ids = itertools.count()
 
     def __new__(cls, host, database, port, user, password):
         """
@@ -42,76 +62,308 @@ class PgConnector:
                 password=password
             )
 
+            if DB_REPLICA_PARAMS:
+                cls._replica_pool = pool.SimpleConnectionPool(minconn=1, maxconn=10, **DB_REPLICA_PARAMS)
+
+            cls._instance.replica_enabled = cls._replica_pool is not None
+            cls._instance._replica_ok = True
+            cls._instance._lag_checked_at = 0.0
+            cls._instance._last_writes: Dict[Tuple, float] = {}
+            cls._instance._prepared: Dict[object, set] = {}
+
         return cls._instance
 
-    def connect(self):
+    @classmethod
+    def register_statement(cls, name: str, query: str):
+        """
+        Registers a statement to be executed as a named prepared statement.
+
+        Args:
+            name (str): Statement name, a valid SQL identifier.
+            query (str): SQL query with `$1`, `$2`, ... placeholders.
+        """
+        cls._statements[name] = query
+
+    def connect(self, readonly: bool = False):
         """
         Get a connection from the connection pool.
 
+        Args:
+            readonly (bool): Take the connection from the replica pool.
+
         Returns:
             psycopg2.extensions.connection: A database connection.
         """
+        if readonly:
+            return self._replica_pool.getconn()
+
         return self._connection_pool.getconn()
 
-    def disconnect(self, conn):
+    def disconnect(self, conn, readonly: bool = False):
         """
         Return a connection to the connection pool.
 
         Args:
             conn (psycopg2.extensions.connection): Connection to be returned.
+            readonly (bool): Whether the connection was taken from the replica pool.
         """
-        self._connection_pool.putconn(conn)
+        if readonly:
+            self._replica_pool.putconn(conn)
+        else:
+            self._connection_pool.putconn(conn)
 
-    def save_data(self, query: str, params: Dict) -> Tuple[int, str]:
+    def save_data(self, query: str, params: Dict, route_key: Optional[Tuple] = None) -> Tuple[int, str]:
         """
         Execute a query to save data into the database.
 
         Args:
             query (str): SQL query.
             params (Dict): Parameters to be used in the query.
+            route_key (Optional[Tuple]): Key of the written data, e.g. (user_id, chat_id); subsequent reads
+                with the same key are served by the primary for `sticky_s` seconds.
 
         Returns:
             Tuple[int, str]: A tuple containing a status code (0 for success, 1 for failure) and a message.
         """
-        conn = self.connect()
-        cursor = conn.cursor()
+        return self._save(lambda cursor: cursor.execute(query, params), route_key)
 
-        try:
-            cursor.execute(query, params)
-            conn.commit()
-            return 0, 'OK'
-        except psycopg2.Error as e:
-            logger.exception(f'psycopg2.Error: {e}')
-            conn.rollback()
-            return 1, e.args[0]
-        finally:
-            cursor.close()
-            self.disconnect(conn)
+    def save_values(self, query: str, rows: List[Sequence], template: Optional[str] = None,
+                    route_keys: Sequence[Tuple] = ()) -> Tuple[int, str]:
+        """
+        Execute a bulk statement with a `values %s` placeholder for many rows in one transaction.
 
-    def get_data(self, query: str, params: Dict) -> Tuple[int, str, List]:
+        Args:
+            query (str): SQL query with a single `%s` placeholder for the VALUES list.
+            rows (List[Sequence]): Rows of parameters.
+            template (Optional[str]): Template of a single row, e.g. '(%s, %s::vector)'.
+            route_keys (Sequence[Tuple]): Keys of the written data, see `save_data`.
+
+        Returns:
+            Tuple[int, str]: A tuple containing a status code (0 for success, 1 for failure) and a message.
+        """
+        result = self._save(lambda cursor: execute_values(cursor, query, rows, template=template, page_size=1000), None)
+
+        if result[0] == 0:
+            for route_key in route_keys:
+                self._remember_write(route_key)
+
+        return result
+
+    def get_data(self, query: str, params: Dict, readonly: bool = False, route_key: Optional[Tuple] = None) -> Tuple[int, str, List]:
         """
         Execute a query to retrieve data from the database.
 
         Args:
             query (str): SQL query.
             params (Dict): Parameters to be used in the query.
+            readonly (bool): Allow the query to be served by the read replica.
+            route_key (Optional[Tuple]): Key of the read data, see `save_data`.
 
         Returns:
             Tuple[int, str, List]: A tuple containing a status code (0 for success, 1 for failure),
             a message and a list of fetched data.
         """
+        return self._get(lambda cursor: cursor.execute(query, params), readonly, route_key)
+
+    def save_prepared(self, name: str, params: Sequence, route_key: Optional[Tuple] = None) -> Tuple[int, str]:
+        """
+        Execute a registered statement to save data into the database.
+
+        Args:
+            name (str): Name of the registered statement.
+            params (Sequence): Positional parameters of the statement.
+            route_key (Optional[Tuple]): Key of the written data, see `save_data`.
+
+        Returns:
+            Tuple[int, str]: A tuple containing a status code (0 for success, 1 for failure) and a message.
+        """
+        return self._save(lambda cursor: self._execute_prepared(cursor, name, params), route_key)
+
+    def get_prepared(self, name: str, params: Sequence, readonly: bool = False, route_key: Optional[Tuple] = None) -> Tuple[int, str, List]:
+        """
+        Execute a registered statement to retrieve data from the database.
+
+        Args:
+            name (str): Name of the registered statement.
+            params (Sequence): Positional parameters of the statement.
+            readonly (bool): Allow the query to be served by the read replica.
+            route_key (Optional[Tuple]): Key of the read data, see `save_data`.
+
+        Returns:
+            Tuple[int, str, List]: A tuple containing a status code (0 for success, 1 for failure),
+            a message and a list of fetched data.
+        """
+        return self._get(lambda cursor: self._execute_prepared(cursor, name, params), readonly, route_key)
+
+    def stream_data(self, query: str, params: Dict, itersize: Optional[int] = None, emb_column: Optional[int] = None,
+                    readonly: bool = False, route_key: Optional[Tuple] = None) -> Iterator[Tuple[List, Optional[np.ndarray]]]:
+        """
+        Execute a query with a named server-side cursor and yield the result in batches.
+
+        If `emb_column` is set, the column must hold a pgvector value selected as text (`msg_emb::text`).
+        It is removed from the rows and decoded into a float32 block preallocated once for the whole scan,
+        so memory stays flat regardless of the result size. The block is overwritten by the next batch:
+        copy it if the vectors must outlive the iteration.
+
+        Args:
+            query (str): SQL query.
+            params (Dict): Parameters to be used in the query.
+            itersize (Optional[int]): Rows per batch, `db_stream_itersize` by default.
+            emb_column (Optional[int]): Index of the embedding column to decode.
+            readonly (bool): Allow the query to be served by the read replica.
+            route_key (Optional[Tuple]): Key of the read data, see `save_data`.
+
+        Yields:
+            Tuple[List, Optional[np.ndarray]]: Rows of the batch and their (n, dim) embeddings, or None
+            if `emb_column` is not set.
+
+        Raises:
+            psycopg2.Error: If the query fails; the connection is returned to the pool.
+        """
+        itersize = itersize or DB_STREAM_OPTIONS['itersize']
+        readonly = readonly and self._use_replica(route_key)
+        conn = self.connect(readonly)
+        cursor = conn.cursor(name=f'zib_stream_{next(self._cursor_ids)}')
+        cursor.itersize = itersize
+        block = None
+
+        try:
+            cursor.execute(query, params)
+
+            while True:
+                rows = cursor.fetchmany(itersize)
+
+                if not rows:
+                    break
+
+                if emb_column is None:
+                    yield rows, None
+                    continue
+
+                # one parse per batch: '[1,2]', '[3,4]' -> '1,2,3,4'
+                values = np.fromstring(','.join(row[emb_column][1:-1] for row in rows), dtype=np.float32, sep=',')
+
+                if block is None:
+                    block = np.empty((itersize, len(values) // len(rows)), dtype=np.float32)
+
+                block[:len(rows)] = values.reshape(len(rows), -1)
+                rows = [row[:emb_column] + row[emb_column + 1:] for row in rows]
+
+                yield rows, block[:len(rows)]
+        except psycopg2.Error as e:
+            logger.exception(f'psycopg2.Error during `stream_data`: {e}')
+            raise
+        finally:
+            cursor.close()
+            conn.rollback()
+            self.disconnect(conn, readonly)
+
+    def _save(self, execute, route_key: Optional[Tuple]) -> Tuple[int, str]:
         conn = self.connect()
         cursor = conn.cursor()
 
         try:
-            cursor.execute(query, params)
-            return 0, 'OK', cursor.fetchall()
+            execute(cursor)
+            conn.commit()
+
+            if route_key is not None:
+                self._remember_write(route_key)
+
+            return 0, 'OK'
+        except psycopg2.Error as e:
+            logger.exception(f'psycopg2.Error: {e}')
+            conn.rollback()
+            return 1, e.args[0]
+        finally:
+            cursor.close()
+            self.disconnect(conn)
+
+    def _get(self, execute, readonly: bool, route_key: Optional[Tuple]) -> Tuple[int, str, List]:
+        use_replica = readonly and self._use_replica(route_key)
+
+        if use_replica:
+            try:
+                return self._fetch(execute, readonly=True)
+            except psycopg2.OperationalError as e:
+                logger.warning(f'Replica unavailable, falling back to primary: {e}')
+                self._replica_ok = False
+            except psycopg2.Error as e:
+                logger.warning(f'Replica query failed, retrying on primary: {e}')
+
+        try:
+            return self._fetch(execute, readonly=False)
         except KeyError as e:
             logger.exception('Query params error: {e}')
             return 1, f'Query params error: {e}', []
         except Exception as e:
-            logger.exception(f'Exception during `save_data`: {e}')
+            logger.exception(f'Exception during `get_data`: {e}')
             return 2, e.args[0], []
+
+    def _fetch(self, execute, readonly: bool) -> Tuple[int, str, List]:
+        conn = self.connect(readonly)
+        cursor = conn.cursor()
+
+        try:
+            execute(cursor)
+            result = cursor.fetchall()
+            # end the read transaction so pooled connections don't hold snapshots
+            conn.rollback()
+            return 0, 'OK', result
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             cursor.close()
-            self.disconnect(conn)
+            self.disconnect(conn, readonly)
+
+    def _execute_prepared(self, cursor, name: str, params: Sequence):
+        prepared = self._prepared.setdefault(cursor.connection, set())
+
+        if name not in prepared:
+            cursor.execute(f'prepare {name} as {self._statements[name]}')
+            prepared.add(name)
+
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f'execute {name}({placeholders})', tuple(params))
+
+    def _remember_write(self, route_key: Tuple):
+        now = time.monotonic()
+        self._last_writes[route_key] = now
+
+        if len(self._last_writes) > 10000:
+            self._last_writes = {k: t for k, t in self._last_writes.items() if now - t < DB_ROUTING_OPTIONS['sticky_s']}
+
+    def _use_replica(self, route_key: Optional[Tuple]) -> bool:
+        if not self.replica_enabled:
+            return False
+
+        now = time.monotonic()
+
+        if route_key is not None and now - self._last_writes.get(route_key, -float('inf')) < DB_ROUTING_OPTIONS['sticky_s']:
+            return False
+
+        if now - self._lag_checked_at >= DB_ROUTING_OPTIONS['lag_check_interval_s']:
+            self._lag_checked_at = now
+            self._replica_ok = self._check_lag()
+
+        return self._replica_ok
+
+    def _check_lag(self) -> bool:
+        query = '''
+            select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                        else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0) end;
+        '''
+
+        try:
+            _, _, result = self._fetch(lambda cursor: cursor.execute(query), readonly=True)
+        except psycopg2.Error as e:
+            logger.warning(f'Replica lag check failed: {e}')
+            return False
+
+        lag = float(result[0][0])
+
+        if lag > DB_ROUTING_OPTIONS['max_replica_lag_s']:
+            logger.warning(f'Replica lag {lag:.1f}s exceeds the limit, reading from primary')
+            return False
+
+        return True
@@ -0,0 +1,252 @@
+"""
+Offline tooling for reduced embedding storage.
+
+    # compare storage settings on a sample of stored rows
+    python database/reduce_embeddings.py report --sample 20000 --dims 312 256 128 64
+
+    # fit a projection and save it (point `emb_projection_path` at the file)
+    python database/reduce_embeddings.py fit --dim 128 --method pca --out projection.npz
+
+    # rewrite stored embeddings with the projection as `halfvec` (set `emb_storage_type=halfvec`)
+    python database/reduce_embeddings.py migrate --projection projection.npz --type halfvec
+
+The report measures, for every (storage type, dimension) pair, recall@k against exact float32 search over
+the full-dimensional vectors, bytes per stored vector and brute-force search latency. `int8` is evaluated
+with per-vector scalar quantisation for reference only: pgvector has no int8 distance type, so it can't be
+selected as a storage option.
+"""
+import argparse
+import time
+from typing import Dict, List
+import numpy as np
+from loguru import logger
+from psycopg2.extras import execute_values
+from src.config import DB_PARAMS
+from src.models.projection import EmbeddingProjection
+from database.pg_connector import PgConnector
+
+# pgvector stores a 4 byte header and 4 bytes of dims/unused per vector
+BYTES_PER_ELEMENT = {'vector': 4, 'halfvec': 2, 'int8': 1}
+HEADER_BYTES = {'vector': 8, 'halfvec': 8, 'int8': 12}
+
+
+def load_sample(size: int) -> np.ndarray:
+    """
+    Loads a random sample of stored embeddings.
+
+    Args:
+        size (int): The number of rows to sample.
+
+    Returns:
+        np.ndarray: (n, dim) float32 matrix.
+    """
+    conn = PgConnector(**DB_PARAMS)
+
+    query = '''
+        select msg_emb::text
+        from zib.user_messages
+        order by random()
+        limit %(size)s;
+    '''
+
+    sample, n = None, 0
+
+    for _, embs in conn.stream_data(query, {'size': size}, emb_column=0, readonly=True):
+        if sample is None:
+            sample = np.empty((size, embs.shape[1]), dtype=np.float32)
+
+        sample[n:n + len(embs)] = embs
+        n += len(embs)
+
+    if sample is None:
+        raise RuntimeError('No stored embeddings to sample')
+
+    return sample[:n]
+
+
+def quantize(matrix: np.ndarray, storage: str) -> np.ndarray:
+    """
+    Simulates the precision loss of a storage type and returns float32 vectors.
+
+    Args:
+        matrix (np.ndarray): (n, dim) float32 matrix.
+        storage (str): 'vector', 'halfvec' or 'int8'.
+
+    Returns:
+        np.ndarray: The dequantised matrix.
+    """
+    if storage == 'vector':
+        return matrix
+
+    if storage == 'halfvec':
+        return matrix.astype(np.float16).astype(np.float32)
+
+    scale = np.abs(matrix).max(axis=1, keepdims=True) / 127
+    scale[scale == 0] = 1
+
+    return np.round(matrix / scale).astype(np.int8).astype(np.float32) * scale
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Returns a copy of the matrix with L2-normalised rows."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+
+def report(sample: np.ndarray, dims: List[int], method: str, top_k: int, n_queries: int) -> List[Dict]:
+    """
+    Evaluates recall@k, bytes per row and search latency for every storage setting.
+
+    Args:
+        sample (np.ndarray): (n, dim) float32 matrix of stored embeddings.
+        dims (List[int]): Output dimensions to evaluate.
+        method (str): Projection method, 'pca' or 'truncate'.
+        top_k (int): k for recall@k.
+        n_queries (int): The number of sample rows used as queries.
+
+    Returns:
+        List[Dict]: One result dictionary per setting.
+    """
+    rng = np.random.default_rng(0)
+    queries_idx = rng.choice(len(sample), size=min(n_queries, len(sample)), replace=False)
+
+    base = normalize_rows(sample)
+    exact = np.argsort(-(base[queries_idx] @ base.T), axis=1)[:, 1:top_k + 1]
+
+    rows = []
+
+    for dim in dims:
+        projection = EmbeddingProjection.fit(sample, dim, method)
+        projected = projection.transform(sample)
+
+        for storage in ('vector', 'halfvec', 'int8'):
+            stored = normalize_rows(quantize(projected, storage))
+            queries = stored[queries_idx]
+
+            start = time.perf_counter()
+            scores = queries @ stored.T
+            latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+            approx = np.argsort(-scores, axis=1)[:, 1:top_k + 1]
+            recall = np.mean([len(set(a) & set(e)) / top_k for a, e in zip(approx, exact)])
+
+            rows.append({
+                'storage': storage,
+                'dim': dim,
+                f'recall@{top_k}': round(float(recall), 4),
+                'bytes_per_row': BYTES_PER_ELEMENT[storage] * dim + HEADER_BYTES[storage],
+                'latency_ms': round(latency, 4)
+            })
+
+    return rows
+
+
+def migrate(projection: EmbeddingProjection, storage: str, batch_size: int):
+    """
+    Rewrites all stored embeddings with the projection into a column of the given type.
+    A new column is backfilled in keyset-ordered batches and swapped in at the end,
+    so the migration can be restarted after a failure. Dropping the old column drops its HNSW index,
+    which is then rebuilt for the new type and dimension; searches scan sequentially until it is built.
+
+    Args:
+        projection (EmbeddingProjection): The projection to apply.
+        storage (str): 'vector' or 'halfvec'.
+        batch_size (int): The number of rows updated per transaction.
+    """
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f'alter table zib.user_messages add column if not exists msg_emb_new {storage}({projection.dim});')
+        conn.commit()
+
+        last_key, done = (-2 ** 31, -2 ** 63, -2 ** 31), 0
+
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    select user_id, chat_id, msg_id, msg_emb::real[]
+                    from zib.user_messages
+                    where (user_id, chat_id, msg_id) > (%(user_id)s, %(chat_id)s, %(msg_id)s) and msg_emb_new is null
+                    order by user_id, chat_id, msg_id
+                    limit %(batch_size)s;
+                ''', {'user_id': last_key[0], 'chat_id': last_key[1], 'msg_id': last_key[2], 'batch_size': batch_size})
+                rows = cursor.fetchall()
+
+                if not rows:
+                    break
+
+                embs = projection.transform(np.array([row[3] for row in rows], dtype=np.float32))
+
+                execute_values(
+                    cursor,
+                    f'''
+                        update zib.user_messages m set msg_emb_new = v.emb::{storage}
+                        from (values %s) as v(user_id, chat_id, msg_id, emb)
+                        where m.user_id = v.user_id and m.chat_id = v.chat_id and m.msg_id = v.msg_id;
+                    ''',
+                    [(row[0], row[1], row[2], emb.tolist()) for row, emb in zip(rows, embs)]
+                )
+
+            conn.commit()
+            last_key = rows[-1][:3]
+            done += len(rows)
+            logger.info(f'Projected {done} rows')
+
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                alter table zib.user_messages drop column msg_emb;
+                alter table zib.user_messages rename column msg_emb_new to msg_emb;
+                alter table zib.user_messages alter column msg_emb set not null;
+            ''')
+        conn.commit()
+
+        # concurrent builds are not supported on partitioned tables, writes wait for the build
+        index_sql = f'create index if not exists user_messages_emb_idx on zib.user_messages using hnsw (msg_emb {storage}_cosine_ops);'
+        logger.info(f'Building the vector index, rerun it after a failure: {index_sql}')
+
+        with conn.cursor() as cursor:
+            cursor.execute(index_sql)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    report_parser = subparsers.add_parser('report')
+    report_parser.add_argument('--sample', type=int, default=20000)
+    report_parser.add_argument('--dims', type=int, nargs='+', default=[312, 256, 128, 64])
+    report_parser.add_argument('--method', choices=['pca', 'truncate'], default='pca')
+    report_parser.add_argument('--top-k', type=int, default=10)
+    report_parser.add_argument('--queries', type=int, default=500)
+
+    fit_parser = subparsers.add_parser('fit')
+    fit_parser.add_argument('--sample', type=int, default=20000)
+    fit_parser.add_argument('--dim', type=int, required=True)
+    fit_parser.add_argument('--method', choices=['pca', 'truncate'], default='pca')
+    fit_parser.add_argument('--out', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate')
+    migrate_parser.add_argument('--projection', required=True)
+    migrate_parser.add_argument('--type', choices=['vector', 'halfvec'], default='halfvec')
+    migrate_parser.add_argument('--batch-size', type=int, default=1000)
+
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        for row in report(load_sample(args.sample), args.dims, args.method, args.top_k, args.queries):
+            print('  '.join(f'{k}={v}' for k, v in row.items()))
+    elif args.command == 'fit':
+        EmbeddingProjection.fit(load_sample(args.sample), args.dim, args.method).save(args.out)
+        logger.info(f'Saved projection to {args.out}')
+    else:
+        migrate(EmbeddingProjection.load(args.projection), args.type, args.batch_size)
@@ -0,0 +1,238 @@
+"""
+Resumable background re-embedding of stored messages with a new embedding model.
+
+    # before every rollout; --dim is the dimension of the new model as stored (after any projection)
+    python database/reembed.py prepare --dim 312
+
+    # re-embed every row whose version differs from `emb_model_version`
+    emb_model_name=<new model> emb_model_version=2 python database/reembed.py run --batch-size 256 --max-cpu 0.5 --max-db 0.2
+
+    # only after a change of dimension, once the job completed
+    python database/reembed.py index --dim 768
+
+Rolling out a model:
+1. After `prepare`, restart the bot with the new `emb_model_name` and `emb_model_version` (and
+   `emb_projection_path`, if any). New messages are stored with the new version, and searches only compare
+   vectors of the new version, so results cover the re-embedded part of the history while the job is running.
+2. Run the job with the same environment. It walks `zib.user_messages` in (user_id, chat_id, msg_id) keyset
+   order, embeds the stored texts in batches and bulk-updates vectors and versions. The position is
+   checkpointed in `zib.job_checkpoints` after every batch, so the job can be stopped and resumed at any time.
+3. The job sleeps between batches to keep its own CPU time and the time spent in the database below the given
+   fractions of wall time, so it can run next to the bot.
+
+`prepare` adds the version columns to databases created before embeddings were versioned. `msg_emb` is created
+with the dimension of the default model and its HNSW index requires a fixed dimension, so vectors of another
+dimension can't be stored next to the old ones: if `--dim` differs from the column's dimension, `prepare` drops
+the index and makes the column dimensionless. Searches scan sequentially during the rollout. `index` restores the
+dimension and rebuilds the index once every row has the new dimension.
+"""
+import argparse
+import json
+import time
+from typing import Optional
+from loguru import logger
+from psycopg2.extras import execute_values
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS, EMB_STORAGE_OPTIONS
+from src.models.embedder import TextEmbedder
+from database.pg_connector import PgConnector
+from database.msg_controller import MsgController
+
+PREPARE_SQL = '''
+    alter table zib.user_messages add column if not exists emb_model_version smallint default 1 not null;
+    alter table zib.topic_centroids add column if not exists emb_model_version smallint default 1 not null;
+'''
+
+# a dimensionless column holds the vectors of both models during the rollout
+UNFIX_DIM_SQL = '''
+    drop index if exists zib.user_messages_emb_idx;
+    alter table zib.user_messages alter column msg_emb type {emb_type};
+'''
+
+INDEX_SQL = '''
+    alter table zib.user_messages alter column msg_emb type {emb_type}({dim});
+    create index if not exists user_messages_emb_idx on zib.user_messages using hnsw (msg_emb {emb_type}_cosine_ops);
+'''
+
+SELECT_SQL = '''
+    select user_id, chat_id, msg_id, msg_text
+    from zib.user_messages
+    where (user_id, chat_id, msg_id) > (%(user_id)s, %(chat_id)s, %(msg_id)s) and emb_model_version <> %(version)s
+    order by user_id, chat_id, msg_id
+    limit %(batch_size)s;
+'''
+
+# the version guard keeps rows written by the bot with the new model in the meantime
+UPDATE_SQL = '''
+    update zib.user_messages m set msg_emb = v.emb::{emb_type}, emb_model_version = {version}
+    from (values %s) as v(user_id, chat_id, msg_id, emb)
+    where m.user_id = v.user_id and m.chat_id = v.chat_id and m.msg_id = v.msg_id and m.emb_model_version <> {version};
+'''
+
+CHECKPOINT_SQL = '''
+    insert into zib.job_checkpoints(job_name, checkpoint) values(%(job_name)s, %(checkpoint)s)
+    on conflict (job_name) do update set checkpoint=excluded.checkpoint, updated_at=now();
+'''
+
+
+def prepare(dim: int):
+    """
+    Adds the version columns to databases created before embeddings were versioned and makes `msg_emb`
+    dimensionless if the new model stores vectors of another dimension.
+
+    Args:
+        dim (int): The dimension of the stored vectors of the new model.
+    """
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(PREPARE_SQL)
+            # the type modifier of a pgvector column is its dimension, -1 if it has none
+            cursor.execute('''
+                select atttypmod from pg_attribute
+                where attrelid = 'zib.user_messages'::regclass and attname = 'msg_emb';
+            ''')
+            column_dim = cursor.fetchone()[0]
+
+            if column_dim not in (-1, dim):
+                cursor.execute(UNFIX_DIM_SQL.format(emb_type=EMB_STORAGE_OPTIONS['type']))
+                logger.info(f'msg_emb holds {column_dim} dimensions, dropped its index until `index --dim {dim}`')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+
+def build_index(dim: int):
+    """
+    Restores the dimension of `msg_emb` and rebuilds its HNSW index after a change of dimension. Fails while rows
+    of the old model are left; writes wait while the index builds.
+
+    Args:
+        dim (int): The dimension of the stored vectors of the new model.
+    """
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(INDEX_SQL.format(emb_type=EMB_STORAGE_OPTIONS['type'], dim=dim))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+
+def run(batch_size: int, encode_batch_size: Optional[int], max_cpu: float, max_db: float):
+    """
+    Re-embeds all rows of other versions with the configured model, resuming from the last checkpoint.
+
+    Args:
+        batch_size (int): The number of rows read, embedded and updated per transaction.
+        encode_batch_size (int): Batch size of the embedding model; the embedder profile's if None.
+        max_cpu (float): Upper bound of the job's CPU time as a fraction of wall time (1.0 is one core).
+        max_db (float): Upper bound of the time spent in database calls as a fraction of wall time.
+    """
+    version = EMBEDDER_OPTIONS['version']
+    job_name = f'reembed_v{version}'
+    embedder = TextEmbedder(EMBEDDER_OPTIONS['model_name'])
+    update_sql = UPDATE_SQL.format(emb_type=EMB_STORAGE_OPTIONS['type'], version=int(version))
+
+    pg = PgConnector(**DB_PARAMS)
+    conn = pg.connect()
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('select checkpoint from zib.job_checkpoints where job_name = %s;', (job_name,))
+            row = cursor.fetchone()
+        conn.rollback()
+
+        last_key = tuple(row[0]['last_key']) if row else (-2 ** 31, -2 ** 63, -2 ** 31)
+        done = row[0]['done'] if row else 0
+        started = time.perf_counter()
+
+        while True:
+            batch_start, cpu_start = time.perf_counter(), time.process_time()
+
+            with conn.cursor() as cursor:
+                cursor.execute(SELECT_SQL, {
+                    'user_id': last_key[0], 'chat_id': last_key[1], 'msg_id': last_key[2],
+                    'version': version, 'batch_size': batch_size
+                })
+                rows = cursor.fetchall()
+            db_time = time.perf_counter() - batch_start
+
+            if not rows:
+                # a later run starts over and only picks up rows that are still behind
+                with conn.cursor() as cursor:
+                    cursor.execute('delete from zib.job_checkpoints where job_name = %s;', (job_name,))
+                conn.commit()
+                break
+
+            embs = MsgController.storage_emb(embedder.encode([row[3] for row in rows], encode_batch_size))
+            last_key = tuple(rows[-1][:3])
+
+            db_start = time.perf_counter()
+            with conn.cursor() as cursor:
+                execute_values(
+                    cursor, update_sql,
+                    [(row[0], row[1], row[2], str(emb.tolist())) for row, emb in zip(rows, embs)],
+                    page_size=len(rows)
+                )
+                cursor.execute(CHECKPOINT_SQL, {
+                    'job_name': job_name,
+                    'checkpoint': json.dumps({'last_key': last_key, 'done': done + len(rows)})
+                })
+            conn.commit()
+            db_time += time.perf_counter() - db_start
+
+            done += len(rows)
+            elapsed = time.perf_counter() - batch_start
+            cpu_time = time.process_time() - cpu_start
+
+            # stretch the batch so that both budgets hold
+            pause = max(cpu_time / max_cpu, db_time / max_db) - elapsed
+
+            if pause > 0:
+                time.sleep(pause)
+
+            rate = done / (time.perf_counter() - started)
+            logger.info(f'Re-embedded {done} rows ({rate:.0f} rows/s), last key {last_key}')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pg.disconnect(conn)
+
+    logger.info(f'All rows are embedded with version {version}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    prepare_parser = subparsers.add_parser('prepare')
+    prepare_parser.add_argument('--dim', type=int, required=True, help='dimension of the stored vectors of the new model')
+
+    index_parser = subparsers.add_parser('index')
+    index_parser.add_argument('--dim', type=int, required=True, help='dimension of the stored vectors of the new model')
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--batch-size', type=int, default=256)
+    run_parser.add_argument('--encode-batch-size', type=int, default=None, help='defaults to the embedder profile')
+    run_parser.add_argument('--max-cpu', type=float, default=0.5, help='fraction of wall time the job may spend on CPU')
+    run_parser.add_argument('--max-db', type=float, default=0.2, help='fraction of wall time the job may spend in the database')
+
+    args = parser.parse_args()
+
+    if args.command == 'prepare':
+        prepare(args.dim)
+    elif args.command == 'index':
+        build_index(args.dim)
+    else:
+        run(args.batch_size, args.encode_batch_size, args.max_cpu, args.max_db)
@@ -1,7 +1,22 @@
 from typing import Dict
 from src.config import DB_PARAMS
 from database.pg_connector import PgConnector
-
+from database.vector_cache import VectorCache
+from database.dup_index import DuplicateIndex
+from src.models.centroid_classifier import CentroidClassifier
+
+# hot lookups run as prepared statements and may be served by the read replica
+PgConnector.register_statement('get_topic_id', '''
+    select topic_id
+    from zib.user_topics
+    where user_id=$1 and chat_id=$2 and lower(topic_name)=lower($3)
+''')
+
+PgConnector.register_statement('get_user_topics', '''
+    select topic_id, lower(topic_name) as topic_name
+    from zib.user_topics
+    where user_id=$1 and chat_id=$2
+''')
 
 class UserTopicController:
     """
@@ -23,19 +38,9 @@ class UserTopicController:
         """
         conn = PgConnector(**DB_PARAMS)
 
-        query = '''
-            select topic_id
-            from zib.user_topics
-            where user_id=%(user_id)s and chat_id=%(chat_id)s and lower(topic_name)=lower(%(topic_name)s);
-        '''
-
-        params = {
-            'user_id': user_id,
-            'chat_id': chat_id,
-            'topic_name': topic_name
-        }
+        params = (user_id, chat_id, topic_name)
 
-        x, _, result = conn.get_data(query, params)
+        x, _, result = conn.get_prepared('get_topic_id', params, readonly=True, route_key=(user_id, chat_id))
 
         if x != 0:
             return None
@@ -60,18 +65,9 @@ class UserTopicController:
         """
         conn = PgConnector(**DB_PARAMS)
 
-        query = '''
-            select topic_id, lower(topic_name) as topic_name
-            from zib.user_topics
-            where user_id=%(user_id)s and chat_id=%(chat_id)s;
-        '''
+        params = (user_id, chat_id)
 
-        params = {
-            'user_id': user_id,
-            'chat_id': chat_id,
-        }
-
-        x, _, result = conn.get_data(query, params)
+        x, _, result = conn.get_prepared('get_user_topics', params, readonly=True, route_key=(user_id, chat_id))
 
         topics = {}
 
@@ -112,7 +108,7 @@ class UserTopicController:
             'topic_name': topic_name
         }
 
-        result, _ = conn.save_data(query, params)
+        result, _ = conn.save_data(query, params, route_key=(user_id, chat_id))
 
         return result
 
@@ -145,7 +141,10 @@ class UserTopicController:
             'new_topic_name': new_topic_name
         }
 
-        result, _ = conn.save_data(query, params)
+        result, _ = conn.save_data(query, params, route_key=(user_id, chat_id))
+
+        if result == 0:
+            CentroidClassifier().reset_topic(user_id, chat_id, topic_id)
 
         return result
 
@@ -165,6 +164,7 @@ class UserTopicController:
         """
         query = '''
             delete from zib.user_messages where user_id=%(user_id)s and chat_id=%(chat_id)s and topic_id=%(topic_id)s;
+            delete from zib.topic_centroids where user_id=%(user_id)s and chat_id=%(chat_id)s and topic_id=%(topic_id)s;
             delete from zib.user_topics where user_id=%(user_id)s and chat_id=%(chat_id)s and topic_id=%(topic_id)s;
         '''
 
@@ -176,7 +176,12 @@ class UserTopicController:
             'topic_id': topic_id
         }
 
-        result, _ = conn.save_data(query, params)
+        result, _ = conn.save_data(query, params, route_key=(user_id, chat_id))
+
+        if result == 0:
+            VectorCache().invalidate(user_id, chat_id)
+            DuplicateIndex().invalidate(user_id, chat_id)
+            CentroidClassifier().remove_topic(user_id, chat_id, topic_id)
 
         return result
 
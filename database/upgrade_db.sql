@@ -0,0 +1,8 @@
+-- Brings a database created by an earlier init_db.sql up to date with the current schema.
+-- Every statement is idempotent, run the script after every upgrade of the bot: >>> \i path/to/upgrade_db.sql;
+
+-- user_messages: SimHash of the message as received, used by the per-chat duplicate index
+alter table zib.user_messages add column if not exists msg_fingerprint bigint;
+
+-- user_messages: id of the copy forwarded into the topic, used to move messages out of 'unknown'
+alter table zib.user_messages add column if not exists topic_msg_id integer;
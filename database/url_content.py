@@ -0,0 +1,289 @@
+import hashlib
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import numpy as np
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS
+from database.pg_connector import PgConnector
+
+# query parameters that only track the click and don't change the page
+TRACKING_PARAMS = {'fbclid', 'gclid', 'yclid', 'igshid', 'mc_cid', 'mc_eid', 'ref', 'ref_src', 'si'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonical_url(url: str) -> str:
+    """
+    Normalizes a link so that the variants of one page share a cache entry: the scheme (https if missing)
+    and host are lowercased, default ports, fragments, tracking parameters and trailing slashes are dropped,
+    and the remaining query parameters are sorted.
+
+    Args:
+        url (str): The link as sent by the user.
+
+    Returns:
+        str: The canonical form of the link.
+    """
+    url = url.strip()
+
+    if '://' not in url:
+        url = 'https://' + url
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith('utm_')
+    )
+    path = parts.path.rstrip('/') or '/'
+
+    return urlunsplit((scheme, host, path, urlencode(query), ''))
+
+
+def url_hash(url: str) -> int:
+    """Returns a signed 64-bit hash of the canonical url, the key of `zib.url_content`."""
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class UrlContent:
+    """
+    A row of `zib.url_content`.
+
+    Attributes:
+        url (str): The canonical url.
+        content (str): The extracted text, None until the link is fetched successfully.
+        emb (np.ndarray): The embedding of the text by the current embedding model version, None if not computed.
+        age_s (float): Seconds since the text was fetched or revalidated.
+        etag (str): The ETag header of the fetched page.
+        last_modified (str): The Last-Modified header of the fetched page.
+        leased (bool): Whether a bot replica is fetching the link right now.
+    """
+    __slots__ = ('url', 'content', 'emb', 'age_s', 'etag', 'last_modified', 'leased')
+
+    def __init__(self, url: str, content: Optional[str], emb: Optional[np.ndarray], age_s: Optional[float],
+                 etag: Optional[str], last_modified: Optional[str], leased: bool):
+        self.url = url
+        self.content = content
+        self.emb = emb
+        self.age_s = age_s
+        self.etag = etag
+        self.last_modified = last_modified
+        self.leased = leased
+
+
+class UrlContentController:
+    """
+    A controller class to handle the shared extracted text of links stored in `zib.url_content`.
+
+    A replica fetching a link holds a lease on its row, so a link sent by many users at once is fetched once:
+    the other replicas see the lease and wait for the row to be filled.
+    """
+    @staticmethod
+    def get_content(key: int) -> Optional[UrlContent]:
+        """
+        Retrieves the stored content of a link.
+
+        Args:
+            key (int): The hash of the canonical url, see `url_hash`.
+
+        Returns:
+            UrlContent: The row, or None if the link isn't stored or in case of an error.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select url, content,
+                   case when emb_model_version=%(version)s then emb::real[] end,
+                   extract(epoch from now() - fetched_at),
+                   etag, last_modified,
+                   coalesce(lease_until > now(), false)
+            from zib.url_content
+            where url_hash=%(url_hash)s;
+        '''
+
+        params = {
+            'url_hash': key,
+            'version': EMBEDDER_OPTIONS['version']
+        }
+
+        x, _, result = conn.get_data(query, params)
+
+        if x != 0 or not result:
+            return None
+
+        url, content, emb, age_s, etag, last_modified, leased = result[0]
+
+        return UrlContent(
+            url=url,
+            content=content,
+            emb=np.array(emb, dtype=np.float32) if emb is not None else None,
+            age_s=float(age_s) if age_s is not None else None,
+            etag=etag,
+            last_modified=last_modified,
+            leased=leased
+        )
+
+    @staticmethod
+    def claim(key: int, url: str, owner: str, lease_s: float) -> bool:
+        """
+        Takes the lease on a link's row, creating the row if needed. Only one replica gets the lease
+        until it is released or expires.
+
+        Args:
+            key (int): The hash of the canonical url.
+            url (str): The canonical url.
+            owner (str): The identifier of this bot replica.
+            lease_s (float): Seconds after which the lease expires if it isn't released.
+
+        Returns:
+            bool: True if this replica holds the lease.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            insert into zib.url_content(url_hash, url, lease_owner, lease_until)
+            values(%(url_hash)s, %(url)s, %(owner)s, now() + make_interval(secs => %(lease_s)s))
+            on conflict (url_hash) do update
+                set lease_owner=excluded.lease_owner, lease_until=excluded.lease_until
+                where zib.url_content.lease_until is null or zib.url_content.lease_until < now();
+        '''
+
+        params = {
+            'url_hash': key,
+            'url': url,
+            'owner': owner,
+            'lease_s': lease_s
+        }
+
+        result, _ = conn.save_data(query, params)
+
+        if result != 0:
+            return False
+
+        x, _, rows = conn.get_data(
+            'select lease_owner from zib.url_content where url_hash=%(url_hash)s;', {'url_hash': key}
+        )
+
+        return x == 0 and bool(rows) and rows[0][0] == owner
+
+    @staticmethod
+    def save_content(key: int, url: str, content: str, etag: Optional[str], last_modified: Optional[str]) -> int:
+        """
+        Inserts or replaces the text of a link and releases the lease. The stored embedding is kept
+        only if the text hasn't changed.
+
+        Args:
+            key (int): The hash of the canonical url.
+            url (str): The canonical url.
+            content (str): The extracted text.
+            etag (Optional[str]): The ETag header of the page.
+            last_modified (Optional[str]): The Last-Modified header of the page.
+
+        Returns:
+            int: The result of the upsert operation (0 if successful, error code otherwise).
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            insert into zib.url_content(url_hash, url, content, fetched_at, etag, last_modified)
+            values(%(url_hash)s, %(url)s, %(content)s, now(), %(etag)s, %(last_modified)s)
+            on conflict (url_hash) do update
+                set content=excluded.content, fetched_at=excluded.fetched_at,
+                    etag=excluded.etag, last_modified=excluded.last_modified,
+                    emb=case when zib.url_content.content is distinct from excluded.content then null else zib.url_content.emb end,
+                    lease_owner=null, lease_until=null;
+        '''
+
+        params = {
+            'url_hash': key,
+            'url': url,
+            'content': content,
+            'etag': etag,
+            'last_modified': last_modified
+        }
+
+        result, _ = conn.save_data(query, params)
+
+        return result
+
+    @staticmethod
+    def revalidate(key: int) -> int:
+        """
+        Marks the stored text of a link as fresh after the page answered 304 Not Modified and releases the lease.
+
+        Args:
+            key (int): The hash of the canonical url.
+
+        Returns:
+            int: The result of the update operation (0 if successful, error code otherwise).
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            update zib.url_content
+            set fetched_at=now(), lease_owner=null, lease_until=null
+            where url_hash=%(url_hash)s;
+        '''
+
+        result, _ = conn.save_data(query, {'url_hash': key})
+
+        return result
+
+    @staticmethod
+    def release(key: int, owner: str) -> int:
+        """
+        Releases the lease after a failed fetch, letting another replica retry.
+
+        Args:
+            key (int): The hash of the canonical url.
+            owner (str): The identifier of this bot replica.
+
+        Returns:
+            int: The result of the update operation (0 if successful, error code otherwise).
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            update zib.url_content
+            set lease_owner=null, lease_until=null
+            where url_hash=%(url_hash)s and lease_owner=%(owner)s;
+        '''
+
+        result, _ = conn.save_data(query, {'url_hash': key, 'owner': owner})
+
+        return result
+
+    @staticmethod
+    def save_embedding(key: int, emb: np.ndarray) -> int:
+        """
+        Stores the embedding of a link's text computed with the current embedding model version.
+
+        Args:
+            key (int): The hash of the canonical url.
+            emb (np.ndarray): The embedding produced by the embedder.
+
+        Returns:
+            int: The result of the update operation (0 if successful, error code otherwise).
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            update zib.url_content
+            set emb=%(emb)s, emb_model_version=%(version)s
+            where url_hash=%(url_hash)s and content is not null;
+        '''
+
+        params = {
+            'url_hash': key,
+            'emb': str(emb.tolist()),
+            'version': EMBEDDER_OPTIONS['version']
+        }
+
+        result, _ = conn.save_data(query, params)
+
+        return result
@@ -0,0 +1,96 @@
+from datetime import date
+from typing import Dict, List, Sequence, Tuple
+from src.config import DB_PARAMS
+from database.pg_connector import PgConnector
+
+
+class UsageController:
+    """
+    A controller class to handle the daily OpenAI usage of users stored in `zib.usage`.
+    """
+    @staticmethod
+    def add_usage(rows: Sequence[Tuple[int, date, int, int, int, float]]) -> int:
+        """
+        Adds the usage accumulated since the previous write to the daily totals, one statement for all users.
+
+        Args:
+            rows (Sequence[Tuple]): (user_id, day, requests, prompt_tokens, completion_tokens, cost_usd) rows,
+                at most one per user and day.
+
+        Returns:
+            int: The result of the upsert operation (0 if successful, error code otherwise).
+        """
+        if not rows:
+            return 0
+
+        query = '''
+            insert into zib.usage(user_id, day, requests, prompt_tokens, completion_tokens, cost_usd)
+            values %s
+            on conflict (user_id, day) do update
+                set requests=zib.usage.requests + excluded.requests,
+                    prompt_tokens=zib.usage.prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens=zib.usage.completion_tokens + excluded.completion_tokens,
+                    cost_usd=zib.usage.cost_usd + excluded.cost_usd;
+        '''
+
+        conn = PgConnector(**DB_PARAMS)
+
+        result, _ = conn.save_values(query, list(rows))
+
+        return result
+
+    @staticmethod
+    def get_daily_tokens(day: date) -> Dict[int, int]:
+        """
+        Retrieves the tokens used by every user on a day, as written by all bot replicas.
+
+        Args:
+            day (date): The day.
+
+        Returns:
+            Dict[int, int]: A dictionary mapping user IDs to prompt and completion tokens, or None in case of an error.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select user_id, prompt_tokens + completion_tokens
+            from zib.usage
+            where day=%(day)s;
+        '''
+
+        x, _, result = conn.get_data(query, {'day': day})
+
+        if x != 0:
+            return None
+
+        return {user_id: int(tokens) for user_id, tokens in result}
+
+    @staticmethod
+    def get_top_users(day: date, limit: int = 10) -> List[Tuple[int, int, int, int, float]]:
+        """
+        Retrieves the users with the highest OpenAI cost on a day.
+
+        Args:
+            day (date): The day.
+            limit (int): The number of users to return.
+
+        Returns:
+            List[Tuple[int, int, int, int, float]]: (user_id, requests, prompt_tokens, completion_tokens, cost_usd)
+            rows, most expensive first, or None in case of an error.
+        """
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select user_id, requests, prompt_tokens, completion_tokens, cost_usd
+            from zib.usage
+            where day=%(day)s
+            order by cost_usd desc
+            limit %(limit)s;
+        '''
+
+        x, _, result = conn.get_data(query, {'day': day, 'limit': limit})
+
+        if x != 0:
+            return None
+
+        return result
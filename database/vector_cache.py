@@ -0,0 +1,332 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import psycopg2
+from loguru import logger
+from src.config import DB_PARAMS, EMBEDDER_OPTIONS, VECTOR_CACHE_OPTIONS
+from database.pg_connector import PgConnector
+
+
+class UserVectors:
+    """
+    Embeddings of a single (user, chat) pair kept as a contiguous L2-normalised float32 matrix.
+
+    Attributes:
+        msg_ids (np.ndarray): Message identifiers, aligned with the matrix rows.
+        msg_texts (List[str]): Message texts, aligned with the matrix rows.
+        matrix (np.ndarray): Preallocated (capacity, dim) float32 matrix; only the first `size` rows are valid.
+        size (int): Number of valid rows.
+    """
+    def __init__(self, msg_ids: np.ndarray, msg_texts: List[str], matrix: np.ndarray):
+        self.msg_ids = msg_ids
+        self.msg_texts = msg_texts
+        self.matrix = matrix
+        self.size = len(msg_texts)
+        self._rows = {msg_id: i for i, msg_id in enumerate(msg_ids[:self.size].tolist())}
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the arrays of this entry (texts are not counted)."""
+        return self.matrix.nbytes + self.msg_ids.nbytes
+
+    def append(self, msg_id: int, msg_text: str, msg_emb: np.ndarray):
+        """
+        Appends a single normalised row, doubling the capacity when the matrix is full.
+
+        Args:
+            msg_id (int): The message identifier.
+            msg_text (str): The message text.
+            msg_emb (np.ndarray): The message embedding.
+        """
+        if msg_id in self._rows:
+            return
+
+        if self.size == len(self.matrix):
+            capacity = max(2 * len(self.matrix), 16)
+            matrix = np.empty((capacity, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            msg_ids = np.empty(capacity, dtype=np.int64)
+            msg_ids[:self.size] = self.msg_ids[:self.size]
+            self.matrix, self.msg_ids = matrix, msg_ids
+
+        self.matrix[self.size] = normalize(msg_emb)
+        self.msg_ids[self.size] = msg_id
+        self.msg_texts.append(msg_text)
+        self._rows[msg_id] = self.size
+        self.size += 1
+
+    def extend(self, msg_ids: List[int], msg_texts: List[str], embs: np.ndarray):
+        """
+        Appends a batch of rows, growing the matrix geometrically. Used when loading from the database,
+        so identifiers are assumed to be unique.
+
+        Args:
+            msg_ids (List[int]): The message identifiers.
+            msg_texts (List[str]): The message texts.
+            embs (np.ndarray): (n, dim) embeddings of the messages.
+        """
+        end = self.size + len(msg_ids)
+
+        if end > len(self.matrix):
+            capacity = max(2 * len(self.matrix), end, 16)
+            matrix = np.empty((capacity, embs.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:self.size] = self.msg_ids[:self.size]
+            self.matrix, self.msg_ids = matrix, ids
+
+        block = self.matrix[self.size:end]
+        block[:] = embs
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        np.divide(block, norms, out=block, where=norms > 0)
+
+        self.msg_ids[self.size:end] = msg_ids
+        self.msg_texts.extend(msg_texts)
+        self._rows.update((msg_id, self.size + i) for i, msg_id in enumerate(msg_ids))
+        self.size = end
+
+    def get(self, msg_id: int) -> Optional[Tuple[str, np.ndarray]]:
+        """
+        Returns the cached text and normalised embedding of a message.
+
+        Args:
+            msg_id (int): The message identifier.
+
+        Returns:
+            Optional[Tuple[str, np.ndarray]]: The message text and embedding, or None if the message is not cached.
+        """
+        row = self._rows.get(msg_id)
+
+        if row is None:
+            return None
+
+        return self.msg_texts[row], self.matrix[row]
+
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, str, float]]:
+        """
+        Exact cosine search over the cached rows.
+
+        Args:
+            query (np.ndarray): L2-normalised query embedding.
+            top_k (int): The number of top similar messages to retrieve.
+
+        Returns:
+            List[Tuple[int, str, float]]: (msg_id, msg_text, cos_sim) tuples ordered by similarity.
+        """
+        if self.size == 0 or top_k <= 0:
+            return []
+
+        scores = self.matrix[:self.size] @ query
+
+        if top_k < self.size:
+            idx = np.argpartition(scores, -top_k)[-top_k:]
+        else:
+            idx = np.arange(self.size)
+
+        idx = idx[np.argsort(-scores[idx])]
+
+        return [(int(self.msg_ids[i]), self.msg_texts[i], float(scores[i])) for i in idx]
+
+
+def normalize(emb: np.ndarray) -> np.ndarray:
+    """
+    Converts an embedding to a float32 unit vector.
+
+    Args:
+        emb (np.ndarray): The embedding vector.
+
+    Returns:
+        np.ndarray: The L2-normalised float32 vector.
+    """
+    emb = np.asarray(emb, dtype=np.float32).ravel()
+    norm = np.linalg.norm(emb)
+
+    return emb / norm if norm > 0 else emb
+
+
+class VectorCache:
+    """
+    A singleton LRU cache of per-user embedding matrices used for exact in-process similarity search.
+    Users are loaded lazily from `zib.user_messages` on their first search. Users with more than `max_rows`
+    messages, or with vectors of another embedding model version, are not cached and stay on the pgvector path.
+
+    Attributes:
+        max_bytes (int): Memory budget for all cached matrices.
+        max_rows (int): Maximum number of messages per user that is served from the cache.
+    """
+    _instance = None
+
+    def __new__(cls, max_bytes: int = VECTOR_CACHE_OPTIONS['max_bytes'], max_rows: int = VECTOR_CACHE_OPTIONS['max_rows']):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.max_bytes = max_bytes
+            cls._instance.max_rows = max_rows
+            cls._instance._entries: 'OrderedDict[Tuple[int, int], UserVectors]' = OrderedDict()
+            cls._instance._huge: Dict[Tuple[int, int], bool] = {}
+            cls._instance._nbytes = 0
+            cls._instance._lock = threading.Lock()
+
+        return cls._instance
+
+    def search(self, user_id: int, chat_id: int, msg_emb: np.ndarray, top_k: int) -> Optional[List[Tuple[int, str, float]]]:
+        """
+        Searches for similar messages in the cache, loading the user on a miss.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_emb (np.ndarray): The embedding vector of the message to compare against.
+            top_k (int): The number of top similar messages to retrieve.
+
+        Returns:
+            Optional[List[Tuple[int, str, float]]]: (msg_id, msg_text, cos_sim) tuples,
+            or None if the user must be served by the database.
+        """
+        key = (user_id, chat_id)
+        entry = self._get(key)
+
+        if entry is None:
+            if key in self._huge:
+                return None
+
+            entry = self._load(user_id, chat_id)
+
+            if entry is None:
+                return None
+
+        return entry.search(normalize(msg_emb), top_k)
+
+    def append(self, user_id: int, chat_id: int, msg_id: int, msg_text: str, msg_emb: np.ndarray):
+        """
+        Adds a saved message to the user's matrix if the user is cached.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_id (int): The message identifier.
+            msg_text (str): The message text.
+            msg_emb (np.ndarray): The message embedding.
+        """
+        key = (user_id, chat_id)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or len(msg_emb) != entry.matrix.shape[1]:
+                return
+
+            if entry.size >= self.max_rows:
+                self._drop(key)
+                self._huge[key] = True
+                return
+
+            before = entry.nbytes
+            entry.append(msg_id, msg_text, msg_emb)
+            self._nbytes += entry.nbytes - before
+            self._evict()
+
+    def duplicate(self, user_id: int, chat_id: int, src_msg_id: int, msg_id: int):
+        """
+        Adds a copy of a cached message under a new identifier. Drops the user's matrix
+        if the source message is not cached, so the next search reloads it.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            src_msg_id (int): The identifier of the copied message.
+            msg_id (int): The identifier of the new message.
+        """
+        with self._lock:
+            entry = self._entries.get((user_id, chat_id))
+
+            if entry is None:
+                return
+
+            src = entry.get(src_msg_id)
+
+        if src is None:
+            self.invalidate(user_id, chat_id)
+        else:
+            self.append(user_id, chat_id, msg_id, src[0], src[1].copy())
+
+    def invalidate(self, user_id: int, chat_id: int):
+        """
+        Drops the cached matrix of a user, e.g. after messages were deleted.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+        """
+        with self._lock:
+            self._drop((user_id, chat_id))
+            self._huge.pop((user_id, chat_id), None)
+
+    def _get(self, key: Tuple[int, int]) -> Optional[UserVectors]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def _load(self, user_id: int, chat_id: int) -> Optional[UserVectors]:
+        conn = PgConnector(**DB_PARAMS)
+
+        query = '''
+            select msg_id, msg_text, emb_model_version, msg_emb::text
+            from zib.user_messages
+            where user_id=%(user_id)s and chat_id=%(chat_id)s
+            limit %(limit)s;
+        '''
+
+        params = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'limit': self.max_rows + 1
+        }
+
+        entry = None
+
+        try:
+            for rows, embs in conn.stream_data(query, params, emb_column=3, readonly=True, route_key=(user_id, chat_id)):
+                if entry is None:
+                    entry = UserVectors(np.empty(0, dtype=np.int64), [], np.empty((0, embs.shape[1]), dtype=np.float32))
+
+                # chats in the middle of a re-embedding are searched in the database, so rows converted
+                # by the background job are never missing from a cached matrix
+                if entry.size + len(rows) > self.max_rows or any(row[2] != EMBEDDER_OPTIONS['version'] for row in rows):
+                    with self._lock:
+                        self._huge[(user_id, chat_id)] = True
+                    return None
+
+                entry.extend([row[0] for row in rows], [row[1] for row in rows], embs)
+        except psycopg2.Error:
+            return None
+
+        if entry is None:
+            # nothing to cache yet: rows will be appended once the dimension is known
+            return None
+
+        with self._lock:
+            self._drop((user_id, chat_id))
+            self._entries[(user_id, chat_id)] = entry
+            self._nbytes += entry.nbytes
+            self._evict()
+
+        logger.debug(f'Loaded {entry.size} vectors for user {user_id} chat {chat_id} into cache')
+
+        return entry
+
+    def _drop(self, key: Tuple[int, int]):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._nbytes -= entry.nbytes
+
+    def _evict(self):
+        # keep at least the most recently used entry
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry.nbytes
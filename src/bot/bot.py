@@ -1,10 +1,14 @@
+import signal
 import logging
 import asyncio
 from aiogram import Bot, Dispatcher
 from src.models.gpt_classifier import GptClassifier
 from src.models.embedder import TextEmbedder
-from src.bot.handlers import topic_commands, msg_commands
-from src.config import BOT_TOKEN, DB_PARAMS
+from src.bot.handlers import topic_commands, msg_commands, admin_commands
+from src.bot.profiling import SamplingProfiler, LoopWatchdog
+from src.bot.usage import UsageLedger
+from src.utils.tracing import TraceWriter
+from src.config import BOT_TOKEN, DB_PARAMS, EMBEDDER_OPTIONS, PROFILING_OPTIONS
 from database.pg_connector import PgConnector
 
 class CatBot:
@@ -32,7 +36,7 @@ class CatBot:
         self.bot = Bot(token=BOT_TOKEN)
         self.dp = Dispatcher()
         self.classifier = GptClassifier([])
-        self.embedder = TextEmbedder()
+        self.embedder = TextEmbedder(EMBEDDER_OPTIONS['model_name'])
 
         try:
             self.db_conn = PgConnector(**DB_PARAMS)
@@ -45,8 +49,34 @@ class CatBot:
         Initializes the bot's command routers and starts polling for updates. This method sets up the environment
         for the bot to begin receiving and responding to messages.
         """
-        self.dp.include_routers(topic_commands.router, msg_commands.router)
-        await self.dp.start_polling(self.bot, embedder = self.embedder, classifier = self.classifier)
+        self.dp.include_routers(admin_commands.router, topic_commands.router, msg_commands.router)
+
+        loop = asyncio.get_running_loop()
+
+        if PROFILING_OPTIONS['loop_watchdog']:
+            LoopWatchdog().start(loop)
+
+        # `kill -USR1 <pid>` starts a sampling profile of `profile_default_seconds`, a second signal stops it early
+        loop.add_signal_handler(signal.SIGUSR1, self._toggle_profiler)
+
+        # per-user OpenAI usage is written in batches; cancelling the task writes what is left
+        usage_task = asyncio.create_task(UsageLedger().run())
+
+        try:
+            await self.dp.start_polling(self.bot, embedder = self.embedder, classifier = self.classifier)
+        finally:
+            usage_task.cancel()
+            await asyncio.gather(usage_task, return_exceptions=True)
+            # traces still queued are written before exiting
+            await asyncio.to_thread(TraceWriter().close)
+
+    def _toggle_profiler(self):
+        profiler = SamplingProfiler()
+
+        if profiler.running:
+            profiler.stop()
+        else:
+            self._profile_task = asyncio.create_task(profiler.profile(PROFILING_OPTIONS['default_seconds']))
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
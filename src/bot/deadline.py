@@ -0,0 +1,150 @@
+import time
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+from typing import Awaitable, Dict, TypeVar
+from loguru import logger
+from src.config import DEADLINE_OPTIONS
+from src.utils.tracing import trace_span, trace_add
+
+T = TypeVar('T')
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a stage doesn't complete within the remaining budget of its message."""
+
+
+class Deadline:
+    """
+    The time budget of one message from the start of its processing until it is sorted.
+
+    Created by the message handlers once the message is admitted by the scheduler and passed through every stage.
+    Awaitable stages run with `run`, which cancels them once the remaining budget (minus the time reserved for later
+    stages) is spent; the Telegram calls of the move run with `complete`, which lets them finish. Synchronous
+    database calls can't be interrupted; they are wrapped in `track`, which counts them if they overrun the
+    deadline. Misses are counted per stage for all messages. All three record a span of the stage in the message's
+    trace, if it is traced.
+
+    Attributes:
+        budget (float): The budget in seconds.
+        expires (float): The monotonic time of the deadline.
+    """
+    misses: Counter = Counter()
+    _reported = 0
+
+    def __init__(self, budget: float = None):
+        self.budget = DEADLINE_OPTIONS['budget_s'] if budget is None else budget
+        self.expires = time.monotonic() + self.budget
+
+    def remaining(self, reserve: float = 0.0) -> float:
+        """
+        Returns the seconds left, minus the time reserved for later stages.
+
+        Args:
+            reserve (float): Seconds kept for later stages.
+        """
+        return self.expires - time.monotonic() - reserve
+
+    def allows(self, stage: str, min_s: float, reserve: float = 0.0) -> bool:
+        """
+        Checks whether enough budget is left to start an optional stage; a skipped stage counts as a miss.
+
+        Args:
+            stage (str): The stage name.
+            min_s (float): The budget the stage needs to be worth starting.
+            reserve (float): Seconds kept for later stages.
+        """
+        if self.remaining(reserve) >= min_s:
+            return True
+
+        self.miss(stage)
+
+        return False
+
+    async def run(self, stage: str, awaitable: Awaitable[T], reserve: float = 0.0, limit: float = None) -> T:
+        """
+        Awaits a stage within the remaining budget.
+
+        Args:
+            stage (str): The stage name.
+            awaitable (Awaitable): The stage.
+            reserve (float): Seconds kept for later stages.
+            limit (float): An upper bound of the stage's own time, if any.
+
+        Returns:
+            The result of the stage.
+
+        Raises:
+            DeadlineExceeded: If the stage is cancelled for lack of budget.
+        """
+        timeout = self.remaining(reserve)
+
+        if limit is not None:
+            timeout = min(timeout, limit)
+
+        call = getattr(awaitable, '__qualname__', None)
+
+        with trace_span(stage, **({'call': call.replace('.<locals>', '')} if call else {})):
+            try:
+                return await asyncio.wait_for(awaitable, timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                self.miss(stage)
+                raise DeadlineExceeded(f'{stage} exceeded its budget of {max(timeout, 0):.1f} s')
+
+    async def complete(self, stage: str, awaitable: Awaitable[T]) -> T:
+        """
+        Awaits a stage that must not be cut short by the budget, such as the Telegram calls of the move once the
+        classification is saved: cancelling a forward or delete half-way would leave the message unsorted or in
+        two places. The stage is only bounded by `msg_deadline_move_call_timeout_s`; running past the deadline
+        counts as a miss.
+
+        Args:
+            stage (str): The stage name.
+            awaitable (Awaitable): The stage.
+
+        Returns:
+            The result of the stage.
+
+        Raises:
+            asyncio.TimeoutError: If the stage takes longer than the fixed timeout.
+        """
+        expired_before = self.remaining() <= 0
+        call = getattr(awaitable, '__qualname__', None)
+
+        with trace_span(stage, **({'call': call.replace('.<locals>', '')} if call else {})):
+            try:
+                return await asyncio.wait_for(awaitable, timeout=DEADLINE_OPTIONS['move_call_timeout_s'])
+            finally:
+                if not expired_before and self.remaining() <= 0:
+                    self.miss(stage)
+
+    @contextmanager
+    def track(self, stage: str):
+        """
+        Counts a synchronous stage that runs past the deadline.
+
+        Args:
+            stage (str): The stage name.
+        """
+        expired_before = self.remaining() <= 0
+
+        with trace_span(stage):
+            yield
+
+        if not expired_before and self.remaining() <= 0:
+            self.miss(stage)
+
+    def miss(self, stage: str):
+        Deadline.misses[stage] += 1
+        trace_add(f'deadline_miss:{stage}')
+        total = sum(Deadline.misses.values())
+        logger.debug(f'Deadline miss at {stage}, {self.remaining():.1f} s left')
+
+        if total - Deadline._reported >= DEADLINE_OPTIONS['report_every']:
+            Deadline._reported = total
+            logger.info(f'Deadline misses per stage: {dict(Deadline.misses)}')
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """Returns the number of misses per stage."""
+        return dict(Deadline.misses)
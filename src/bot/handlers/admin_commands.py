@@ -0,0 +1,94 @@
+import os
+from datetime import datetime, timezone
+from aiogram import Router
+from aiogram.types import Message, FSInputFile
+from aiogram.filters.command import Command, CommandObject
+from loguru import logger
+from src.bot.profiling import SamplingProfiler, HandlerProfiler
+from src.bot.usage import UsageLedger
+from src.config import PROFILING_OPTIONS
+from database.usage_controller import UsageController
+
+router = Router()
+
+
+@router.message(Command('profile'))
+async def cmd_profile(message: Message, command: CommandObject):
+    """
+    Handles the admin-only '/profile' command. Commands of other users are ignored.
+
+        /profile [seconds]  samples all threads for the given number of seconds and replies with the folded stacks
+        /profile stop       stops a running profile early
+        /profile slow       lists the kept cProfile captures of the slowest handler calls
+
+    Args:
+        message (Message): The message object from Telegram.
+        command (CommandObject): The command object containing arguments.
+    """
+    if message.from_user.id not in PROFILING_OPTIONS['admin_ids']:
+        return
+
+    args = (command.args or '').strip()
+    profiler = SamplingProfiler()
+
+    if args == 'stop':
+        profiler.stop()
+        return
+
+    if args == 'slow':
+        captures = HandlerProfiler().slowest()
+
+        if not captures:
+            await message.answer('Нет сохраненных профилей медленных обработчиков')
+            return
+
+        await message.answer('\n'.join(f'{ms:.0f} ms {name}: {path}' for ms, name, path in captures))
+        return
+
+    try:
+        seconds = float(args) if args else PROFILING_OPTIONS['default_seconds']
+    except ValueError:
+        await message.answer('Ошибка: укажите длительность в секундах, stop или slow')
+        return
+
+    if profiler.running:
+        await message.answer('Профилирование уже запущено')
+        return
+
+    await message.answer(f'Профилирование запущено на {min(seconds, PROFILING_OPTIONS["max_seconds"]):.0f} с')
+    path = await profiler.profile(seconds)
+
+    try:
+        await message.answer_document(FSInputFile(path, filename=os.path.basename(path)))
+    except Exception as e:
+        logger.warning(f'Failed to send the profile {path}: {e}')
+        await message.answer(f'Профиль сохранен: {path}')
+
+
+@router.message(Command('usage'))
+async def cmd_usage(message: Message):
+    """
+    Handles the admin-only '/usage' command: lists today's (UTC) users with the highest OpenAI cost.
+
+    Args:
+        message (Message): The message object from Telegram.
+    """
+    if message.from_user.id not in PROFILING_OPTIONS['admin_ids']:
+        return
+
+    # counters not written yet are included
+    await UsageLedger().flush()
+    rows = UsageController.get_top_users(datetime.now(timezone.utc).date())
+
+    if rows is None:
+        await message.answer('Ошибка получения статистики использования OpenAI')
+        return
+
+    if not rows:
+        await message.answer('Сегодня запросов к OpenAI не было')
+        return
+
+    await message.answer('\n'.join(
+        f'{user_id}: {requests} запросов, {prompt_tokens + completion_tokens} токенов, ${cost_usd:.4f}'
+        for user_id, requests, prompt_tokens, completion_tokens, cost_usd in rows
+    ))
@@ -1,44 +1,92 @@
-from typing import List
-from aiogram import Router, F, types
+import time
+from aiogram import Router, F
 from aiogram.types import Message
-from aiogram_media_group import media_group_handler
 from src.models.gpt_classifier import GptClassifier
 from src.bot.tg_controller import TgController as tg_controller
+from src.bot.profiling import HandlerProfiler
+from src.bot.deadline import Deadline
+from src.bot.scheduler import FairScheduler, SchedulerOverloaded
+from src.utils.document_sandbox import DocumentSandbox
+from src.utils.tracing import trace_message, trace_set
+from src.bot.media_group import MediaGroupAggregator, text_part, content_category
 from sentence_transformers import SentenceTransformer
 
 router = Router()
+router.message.middleware(HandlerProfiler())
+# completes waiting albums once a later message of their chat arrives
+router.message.outer_middleware(MediaGroupAggregator())
 
 @router.message(F.text)
 async def handle_new_text_message(message: Message, embedder: SentenceTransformer, classifier: GptClassifier):
     """
     Handles new text messages in a chat. If the message is not a topic message, it classifies the message using
     the provided embedder and classifier, and if successfully classified, moves the message to the appropriate category.
+    Messages wait for the user's turn in the scheduler and are dropped with a notice when the user's queue is full.
+    Once admitted, the message has `msg_deadline_s` to be sorted.
     """
     if not message.is_topic_message:
-        result, category = await tg_controller.classify_message(message, embedder, classifier)
+        scheduler = FairScheduler()
 
-        if result:
-            await tg_controller.move_message(message, category)
+        with trace_message('text', message.from_user.id, message.chat.id, [message.message_id]):
+            try:
+                async with scheduler.slot(message.from_user.id):
+                    deadline = Deadline()
 
+                    result, category = await tg_controller.classify_message(message, embedder, classifier, deadline)
 
-@router.message(F.media_group_id, F.content_type.in_({'photo'}))
-@media_group_handler
-async def handle_new_media_group_message(messages: List[types.Message], embedder: SentenceTransformer, classifier: GptClassifier):
+                    if not result:
+                        trace_set(outcome='not_classified')
+                    else:
+                        async with scheduler.resource('telegram'):
+                            await tg_controller.move_message(message, category, deadline)
+            except SchedulerOverloaded:
+                trace_set(outcome='shed')
+                await scheduler.notify_shed(message)
+
+
+@router.message(F.media_group_id)
+async def handle_new_media_group_message(message: Message, embedder: SentenceTransformer, classifier: GptClassifier):
     """
-    Handles new text messages containing photo media group in a chat.
-    If the message is not a topic message, it classifies the message using the provided embedder and classifier,
-    and if successfully classified, moves the message to the appropriate category.
-    If there is no caption or text, the message is assumed to have 'photo' category.
+    Handles new albums of photos, videos, documents or audio in a chat.
+    The handler of the first part collects the album (see MediaGroupAggregator), the other parts return at once.
+    If the album is not a topic message, it is classified by the part carrying the caption, or else by a document
+    whose text can be extracted, and if successfully classified, the album is moved to the appropriate category.
+    An album without text is assumed to have the category of its content type.
     """
-    if not messages[0].is_topic_message:
-        if not (messages[0].caption or messages[0].text):
-            await tg_controller.move_media_group_message(messages, messages[0].content_type)
-            return
-        else:
-            result, category = await tg_controller.classify_message(messages[0], embedder, classifier)
+    if message.is_topic_message:
+        return
+
+    group = await MediaGroupAggregator().collect(message)
+
+    if group is None:
+        return
 
-        if result:
-            await tg_controller.move_media_group_message(messages, category)
+    messages = group.parts
+    scheduler = FairScheduler()
+
+    with trace_message('media_group', message.from_user.id, message.chat.id,
+                       [part.message_id for part in messages], content_type=content_category(messages),
+                       parts=len(messages), completed_by=group.reason,
+                       album_wait_ms=round((time.monotonic() - group.first) * 1000, 2)):
+        try:
+            async with scheduler.slot(message.from_user.id):
+                deadline = Deadline()
+                text_message = text_part(messages)
+
+                if text_message is None:
+                    result, category = True, content_category(messages)
+                    trace_set(classified_by='content_type')
+                else:
+                    result, category = await tg_controller.classify_message(text_message, embedder, classifier, deadline)
+
+                if not result:
+                    trace_set(outcome='not_classified')
+                else:
+                    async with scheduler.resource('telegram'):
+                        await tg_controller.move_media_group_message(messages, category, deadline)
+        except SchedulerOverloaded:
+            trace_set(outcome='shed')
+            await scheduler.notify_shed(message)
 
 
 @router.message(F.content_type.in_({'photo', 'video', 'document'}))
@@ -47,14 +95,29 @@ async def handle_new_photo_message(message: Message, embedder: SentenceTransform
     Handles new messages containing photo, video or document (not media groups) in a chat.
     If the message is not a topic message, it classifies the message using the provided embedder and classifier,
     and if successfully classified, moves the message to the appropriate category.
-    If there is no caption or text, the message is assumed to have category corresponding to the content type.
+    Documents in PDF, txt, md or docx format are classified by their text even without a caption.
+    Otherwise, if there is no caption or text, the message is assumed to have category corresponding to the content type.
     """
     if not message.is_topic_message:
-        if not (message.caption or message.text):
-            await tg_controller.move_message(message, message.content_type)
-            return
-        else:
-            result, category = await tg_controller.classify_message(message, embedder, classifier)
-
-        if result:
-            await tg_controller.move_message(message, category)
+        scheduler = FairScheduler()
+
+        with trace_message('media', message.from_user.id, message.chat.id, [message.message_id],
+                           content_type=message.content_type):
+            try:
+                async with scheduler.slot(message.from_user.id):
+                    deadline = Deadline()
+
+                    if not (message.caption or message.text or DocumentSandbox.supports(message.document)):
+                        result, category = True, message.content_type
+                        trace_set(classified_by='content_type')
+                    else:
+                        result, category = await tg_controller.classify_message(message, embedder, classifier, deadline)
+
+                    if not result:
+                        trace_set(outcome='not_classified')
+                    else:
+                        async with scheduler.resource('telegram'):
+                            await tg_controller.move_message(message, category, deadline)
+            except SchedulerOverloaded:
+                trace_set(outcome='shed')
+                await scheduler.notify_shed(message)
@@ -1,11 +1,23 @@
 from sys import argv
+from loguru import logger
 from aiogram import Router
-from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, LinkPreviewOptions
 from aiogram.filters.command import Command, CommandObject
 from src.bot.tg_controller import TgController as tg_controller
+from src.bot.profiling import HandlerProfiler
+from src.bot.scheduler import FairScheduler
+from src.bot.search import SearchPage, SearchCache
+from src.config import SEARCH_OPTIONS
+from src.models.gpt_classifier import GptClassifier
 from sentence_transformers import SentenceTransformer
 
 router = Router()
+router.message.middleware(HandlerProfiler())
+router.callback_query.middleware(HandlerProfiler())
+
+# links in search results would otherwise expand into a preview of the first one
+NO_PREVIEW = LinkPreviewOptions(is_disabled=True)
 
 @router.message(Command('start'))
 async def cmd_start(message: Message):
@@ -15,7 +27,7 @@ async def cmd_start(message: Message):
         '/add_topic <topic_name>: Создание новой темы',
         '/edit_topic <current topic name> <new topic name>: Переименование темы',
         '/del_topic <topic_name>: Удаление темы вместе сообщениями',
-        '/search <message> <top_k>: Поиск top k семантически близких сообщений согласно указанного шаблона',
+        '/search <message> [top_k]: Поиск top k семантически близких сообщений согласно указанного шаблона',
     ]
 
     await tg_controller.add_topic(message, 'unknown')
@@ -24,13 +36,16 @@ async def cmd_start(message: Message):
 
 
 @router.message(Command('add_topic'))
-async def create_topic(message: Message, command: CommandObject):
+async def create_topic(message: Message, command: CommandObject, embedder: SentenceTransformer, classifier: GptClassifier):
     """
     Handles the '/add_topic' command to create a new topic. It requires a topic name as an argument.
+    Messages of the 'unknown' topic that belong to the new topic are moved into it.
 
     Args:
         message (Message): The message object from Telegram.
         command (CommandObject): The command object containing arguments.
+        embedder (SentenceTransformer): The SentenceTransformer model used for message embedding.
+        classifier (GptClassifier): The classifier used to check borderline messages.
 
     Raises:
         Sends an error message if no topic name is provided.
@@ -45,16 +60,20 @@ async def create_topic(message: Message, command: CommandObject):
         await message.answer("Укажите наименование темы после текста команды.")
         return
 
-    await tg_controller.add_topic(message, topic_name)
+    async with FairScheduler().slot(message.from_user.id, interactive=True):
+        await tg_controller.add_topic(message, topic_name, embedder, classifier)
 
 
 @router.message(Command('edit_topic'))
-async def rename_topic(message: Message, command: CommandObject):
+async def rename_topic(message: Message, command: CommandObject, embedder: SentenceTransformer, classifier: GptClassifier):
     """Handles the '/edit_topic' command to rename an existing topic. It requires two arguments: the current topic name and the new topic name.
+    Messages of the 'unknown' topic that belong to the renamed topic are moved into it.
 
     Args:
         message (Message): The message object from Telegram.
         command (CommandObject): The command object containing arguments.
+        embedder (SentenceTransformer): The SentenceTransformer model used for message embedding.
+        classifier (GptClassifier): The classifier used to check borderline messages.
 
     Raises:
         Sends an error message if the required two topic names are not provided."""
@@ -70,7 +89,8 @@ async def rename_topic(message: Message, command: CommandObject):
     curr_topic_name = cmd_list[0]
     new_topic_name = cmd_list[1]
 
-    await tg_controller.edit_topic(message, curr_topic_name, new_topic_name)
+    async with FairScheduler().slot(message.from_user.id, interactive=True):
+        await tg_controller.edit_topic(message, curr_topic_name, new_topic_name, embedder, classifier)
 
 
 @router.message(Command('del_topic'))
@@ -95,13 +115,16 @@ async def delete_topic(message: Message, command: CommandObject):
         await message.answer("Укажите наименование темы для удаления.")
         return
 
-    await tg_controller.del_topic(message, topic_name)
+    async with FairScheduler().slot(message.from_user.id, interactive=True):
+        await tg_controller.del_topic(message, topic_name)
 
 
 @router.message(Command('search'))
 async def search_messages(message: Message, command: CommandObject, embedder: SentenceTransformer):
     """
-    Handles the '/search' command to find top k semantically similar messages according to a specified pattern. Requires a message pattern and a number 'k' as arguments.
+    Handles the '/search' command to find top k semantically similar messages according to a specified pattern.
+    Requires a message pattern and optionally a number 'k' as arguments (`search_default_top_k` by default).
+    The results are sent as one message, paged with inline buttons and linking to the messages in their topics.
 
     Args:
         message (Message): The message object from Telegram.
@@ -116,17 +139,55 @@ async def search_messages(message: Message, command: CommandObject, embedder: Se
         return
 
     cmd_list = command.args.split()
+    top_k = SEARCH_OPTIONS['default_top_k']
 
-    if len(cmd_list) < 2:
-        await message.answer('Ошибка: Укажите 2 параметра, разделенные пробелом')
+    if len(cmd_list) > 1 and cmd_list[-1].isdigit():
+        top_k = int(cmd_list.pop())
+
+    if not cmd_list or top_k < 1:
+        await message.answer('Ошибка: Укажите шаблон поиска и, через пробел, число сообщений')
+        return
 
-    msg_patern = " ".join(cmd_list[0:-1])
-    top_k = cmd_list[-1]
+    msg_patern = " ".join(cmd_list)
+    top_k = min(top_k, SEARCH_OPTIONS['max_top_k'])
 
-    results = await tg_controller.search_messages(message, msg_patern, embedder, top_k)
+    async with FairScheduler().slot(message.from_user.id, interactive=True):
+        text, markup = await tg_controller.search_messages(message, msg_patern, embedder, top_k)
+
+    if text:
+        try:
+            await message.answer(text, parse_mode='HTML', reply_markup=markup, link_preview_options=NO_PREVIEW)
+        except TelegramBadRequest as e:
+            logger.warning(f'Search results not sent: {e}')
+            await message.answer('Ошибка отправки результатов поиска')
+
+
+@router.callback_query(SearchPage.filter())
+async def turn_search_page(callback: CallbackQuery, callback_data: SearchPage):
+    """
+    Handles the paging buttons of search results by editing the results message in place. Pages are rendered
+    from the cached ranking, so the pattern is neither embedded nor searched again.
+
+    Args:
+        callback (CallbackQuery): The callback query of the pressed button.
+        callback_data (SearchPage): The token of the cached results and the requested page.
+    """
+    entry = SearchCache().get(callback_data.token)
+
+    if entry is None or entry.user_id != callback.from_user.id:
+        await callback.answer('Результаты поиска устарели, повторите поиск')
+        return
+
+    text, markup = tg_controller.search_page(callback_data.token, entry, callback_data.page)
+
+    if text is None:
+        await callback.answer('Ошибка определения похожих сообщений')
+        return
 
-    if results:
-        await message.answer('Результаты поиска:')
+    try:
+        await callback.message.edit_text(text, parse_mode='HTML', reply_markup=markup, link_preview_options=NO_PREVIEW)
+    except TelegramBadRequest as e:
+        # a button pressed twice before the first edit arrived shows the same page again
+        logger.debug(f'Search page not edited: {e}')
 
-    for r in results:
-        await message.answer(r.msg_text)
+    await callback.answer()
@@ -0,0 +1,162 @@
+import time
+import asyncio
+from collections import Counter, OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+from src.config import MEDIA_GROUP_OPTIONS
+from src.utils.document_sandbox import DocumentSandbox
+
+
+class MediaGroup:
+    """
+    The parts of an album received so far.
+
+    Attributes:
+        messages (List[Message]): The parts in their arrival order.
+        first (float): Monotonic arrival time of the first part.
+        last (float): Monotonic arrival time of the latest part.
+        reason (str): Why the album was considered complete: 'full', 'next_message', 'wait' or 'late'.
+        done (asyncio.Event): Set once the album is complete before its wait ran out.
+    """
+    __slots__ = ('messages', 'first', 'last', 'reason', 'done')
+
+    def __init__(self, message: Message, now: float):
+        self.messages = [message]
+        self.first = now
+        self.last = now
+        self.reason = 'wait'
+        self.done = asyncio.Event()
+
+    def finish(self, reason: str):
+        if not self.done.is_set():
+            self.reason = reason
+            self.done.set()
+
+    @property
+    def parts(self) -> List[Message]:
+        """The parts in the order they were sent."""
+        return sorted(self.messages, key=lambda message: message.message_id)
+
+
+class MediaGroupAggregator(BaseMiddleware):
+    """
+    A singleton collector of album parts, also the router middleware that watches the chats for later messages.
+
+    Telegram delivers an album as separate messages with a shared `media_group_id` and doesn't tell how many parts
+    it has. The handler of the first part waits while the others only add themselves; the album is complete once
+    it has `max_parts` parts, once a later message of the chat arrives (updates of a chat arrive in order), or
+    once no part arrived for the wait. The wait follows the observed gaps between consecutive parts (see
+    MEDIA_GROUP_OPTIONS), so albums aren't held for a fixed worst-case interval. A part arriving after its album
+    was handed over is handled as an album of its own, and its gap makes later waits longer.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._groups: Dict[Tuple[int, str], MediaGroup] = {}
+            cls._instance._closed: 'OrderedDict[Tuple[int, str], float]' = OrderedDict()
+            cls._instance._gaps: deque = deque(maxlen=MEDIA_GROUP_OPTIONS['window'])
+            cls._instance.counters: Counter = Counter()
+
+        return cls._instance
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if isinstance(event, Message):
+            self.observe(event)
+
+        return await handler(event, data)
+
+    def wait_s(self) -> float:
+        """Returns how long an album waits for its next part."""
+        if len(self._gaps) < MEDIA_GROUP_OPTIONS['min_samples']:
+            return MEDIA_GROUP_OPTIONS['initial_wait_s']
+
+        wait = float(np.quantile(self._gaps, MEDIA_GROUP_OPTIONS['gap_quantile'])) * MEDIA_GROUP_OPTIONS['gap_factor']
+
+        return min(max(wait, MEDIA_GROUP_OPTIONS['min_wait_s']), MEDIA_GROUP_OPTIONS['max_wait_s'])
+
+    def observe(self, message: Message):
+        """Completes the albums of the message's chat that the message doesn't belong to."""
+        for (chat_id, media_group_id), group in self._groups.items():
+            if chat_id == message.chat.id and media_group_id != message.media_group_id:
+                group.finish('next_message')
+
+    async def collect(self, message: Message) -> Optional[MediaGroup]:
+        """
+        Adds a part to its album and, for the first part, waits until the album is complete.
+
+        Args:
+            message (Message): A message with a `media_group_id`.
+
+        Returns:
+            Optional[MediaGroup]: The complete album for the first part, None for the other parts.
+        """
+        key = (message.chat.id, message.media_group_id)
+        now = time.monotonic()
+        group = self._groups.get(key)
+
+        if group is not None:
+            self._gaps.append(now - group.last)
+            group.last = now
+            group.messages.append(message)
+
+            if len(group.messages) >= MEDIA_GROUP_OPTIONS['max_parts']:
+                group.finish('full')
+
+            return None
+
+        if key in self._closed:
+            self.counters['late'] += 1
+            self._gaps.append(now - self._closed[key])
+            group = MediaGroup(message, now)
+            group.reason = 'late'
+            return group
+
+        group = self._groups[key] = MediaGroup(message, now)
+
+        try:
+            while not group.done.is_set():
+                # every new part pushes the end of the wait
+                remaining = group.last + self.wait_s() - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    await asyncio.wait_for(group.done.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self._groups[key]
+            self._closed[key] = group.last
+
+            while len(self._closed) > MEDIA_GROUP_OPTIONS['closed_size']:
+                self._closed.popitem(last=False)
+
+        self.counters[group.reason] += 1
+
+        return group
+
+
+def text_part(messages: List[Message]) -> Optional[Message]:
+    """Returns the part of an album carrying its caption, or else a document whose text can be extracted."""
+    for message in messages:
+        if message.caption or message.text:
+            return message
+
+    for message in messages:
+        if DocumentSandbox.supports(message.document):
+            return message
+
+    return None
+
+
+def content_category(messages: List[Message]) -> str:
+    """The category of an album without text: its content type, 'media' for an album of photos and videos."""
+    content_types = {message.content_type for message in messages}
+
+    return content_types.pop() if len(content_types) == 1 else 'media'
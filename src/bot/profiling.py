@@ -0,0 +1,308 @@
+import os
+import sys
+import time
+import heapq
+import random
+import asyncio
+import cProfile
+import threading
+import functools
+import contextvars
+from collections import Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from src.config import PROFILING_OPTIONS
+from src.utils.tracing import trace_span
+
+# durations of the TgController stages run by the current handler call, see `profiled_stage`
+_stage_times: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar('stage_times', default=None)
+
+
+def _timestamp() -> str:
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def _output_path(prefix: str, suffix: str) -> str:
+    os.makedirs(PROFILING_OPTIONS['output_dir'], exist_ok=True)
+
+    return os.path.join(PROFILING_OPTIONS['output_dir'], f'{prefix}-{_timestamp()}{suffix}')
+
+
+def _frame_name(frame) -> str:
+    return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}'
+
+
+def _format_stack(frame, limit: int = 8) -> str:
+    frames = []
+
+    while frame is not None and len(frames) < limit:
+        frames.append(f'{_frame_name(frame)}:{frame.f_lineno}')
+        frame = frame.f_back
+
+    return ' <- '.join(frames)
+
+
+class SamplingProfiler:
+    """
+    A singleton in-process sampling profiler for production use.
+
+    While running, a daemon thread records the stacks of all other threads every `sample_interval_ms` and counts
+    identical stacks. The result is written in the folded format ("thread;file:func;file:func count" per line)
+    read by flamegraph.pl, speedscope and inferno. The sampled threads only pay for the GIL handoff of each sample.
+    Coroutines show up with the frames of the task running at the moment of the sample; the embedding model and
+    other `asyncio.to_thread` work appear under their worker threads.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._stop = threading.Event()
+            cls._instance._thread: Optional[threading.Thread] = None
+            cls._instance._stacks: Counter = Counter()
+            cls._instance._samples = 0
+
+        return cls._instance
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    async def profile(self, seconds: float) -> str:
+        """
+        Samples for `seconds` or until `stop` is called and writes the folded stacks.
+
+        Args:
+            seconds (float): Sampling duration, capped at `max_seconds`.
+
+        Returns:
+            str: Path of the written file.
+
+        Raises:
+            RuntimeError: If the profiler is already running.
+        """
+        if self.running:
+            raise RuntimeError('The profiler is already running')
+
+        seconds = min(seconds, PROFILING_OPTIONS['max_seconds'])
+        self._stop.clear()
+        self._stacks = Counter()
+        self._samples = 0
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f'Sampling profiler started for {seconds} s')
+
+        started = time.monotonic()
+
+        while self.running and time.monotonic() - started < seconds:
+            await asyncio.sleep(0.2)
+
+        self._stop.set()
+        await asyncio.to_thread(self._thread.join)
+
+        return self._write()
+
+    def stop(self):
+        """Stops a running profile early; `profile` then writes what was sampled so far."""
+        self._stop.set()
+
+    def _sample(self):
+        interval = PROFILING_OPTIONS['sample_interval_ms'] / 1000
+        own_id = threading.get_ident()
+
+        while not self._stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+            self._samples += 1
+
+    def _write(self) -> str:
+        path = _output_path('sample', '.folded')
+
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        logger.info(f'Sampling profiler wrote {self._samples} samples of {len(self._stacks)} distinct stacks to {path}')
+
+        return path
+
+
+class HandlerProfiler(BaseMiddleware):
+    """
+    A singleton router middleware keeping cProfile captures of the slowest handler calls.
+
+    When `profile_handlers` is enabled, a `handler_rate` share of handler calls runs under cProfile, one call at
+    a time since the profiler hooks the whole interpreter. Calls slower than `handler_threshold_ms` are kept: the
+    `handler_keep` slowest are written as pstats files (`python -m pstats <file>`, snakeviz) and older, faster
+    captures are deleted. A capture also contains whatever other coroutines ran on the loop while the handler
+    awaited, so it is read together with the stage timings logged with it.
+
+    Every call, profiled or not, is timed per TgController stage (see `profiled_stage`) and slow calls are
+    logged with their stage breakdown.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._active = False
+            cls._instance._captures: List[Tuple[float, str, str]] = []
+
+        return cls._instance
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'handler')
+        stage_times: Dict[str, float] = {}
+        token = _stage_times.set(stage_times)
+
+        profile = None
+
+        if PROFILING_OPTIONS['handlers_enabled'] and not self._active and random.random() < PROFILING_OPTIONS['handler_rate']:
+            self._active = True
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _stage_times.reset(token)
+
+            if profile is not None:
+                profile.disable()
+                self._active = False
+
+            if elapsed_ms >= PROFILING_OPTIONS['handler_threshold_ms']:
+                stages = ', '.join(f'{stage} {ms:.0f} ms' for stage, ms in stage_times.items())
+                logger.warning(f'Slow handler {name}: {elapsed_ms:.0f} ms ({stages or "no stages"})')
+
+                if profile is not None:
+                    self._keep(profile, name, elapsed_ms)
+
+    def slowest(self) -> List[Tuple[float, str, str]]:
+        """Returns (duration in ms, handler, pstats file) of the kept captures, slowest first."""
+        return sorted(self._captures, reverse=True)
+
+    def _keep(self, profile: cProfile.Profile, name: str, elapsed_ms: float):
+        if len(self._captures) >= PROFILING_OPTIONS['handler_keep'] and elapsed_ms <= self._captures[0][0]:
+            return
+
+        path = _output_path(f'handler-{name}-{elapsed_ms:.0f}ms', '.prof')
+        profile.dump_stats(path)
+        heapq.heappush(self._captures, (elapsed_ms, name, path))
+
+        while len(self._captures) > PROFILING_OPTIONS['handler_keep']:
+            _, _, evicted = heapq.heappop(self._captures)
+
+            try:
+                os.remove(evicted)
+            except OSError:
+                pass
+
+
+def profiled_stage(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """
+    Times a pipeline stage coroutine into the breakdown of the handler call running it, and into the trace of
+    the message if it is traced (see src/utils/tracing.py).
+
+    Args:
+        func: The coroutine function, e.g. a TgController method.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        stage_times = _stage_times.get()
+
+        with trace_span(func.__name__):
+            if stage_times is None:
+                return await func(*args, **kwargs)
+
+            start = time.perf_counter()
+
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stage_times[func.__name__] = stage_times.get(func.__name__, 0) + (time.perf_counter() - start) * 1000
+
+    return wrapper
+
+
+class LoopWatchdog:
+    """
+    Detects callbacks blocking the event loop without asyncio debug mode.
+
+    A heartbeat callback is scheduled on the loop every `threshold / 4`. A watcher thread checks that it keeps
+    running; once it is late by more than `loop_threshold_ms`, the watcher logs the task that holds the loop and
+    the loop thread's stack at that moment, and the heartbeat logs the total blocked time when the loop is back.
+    """
+
+    def __init__(self, threshold_ms: float = PROFILING_OPTIONS['loop_threshold_ms']):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._blocked: Optional[str] = None
+        self._stop = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Starts watching the loop; must be called from the loop's thread.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The running loop.
+        """
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        loop.call_soon(self._beat)
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _beat(self):
+        now = time.monotonic()
+
+        if self._blocked is not None:
+            logger.warning(f'Event loop was blocked for {(now - self._last_beat - self.interval) * 1000:.0f} ms by {self._blocked}')
+            self._blocked = None
+
+        self._last_beat = now
+
+        if not self._stop.is_set():
+            self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            late = time.monotonic() - self._last_beat - self.interval
+
+            if late < self.threshold or self._blocked is not None:
+                continue
+
+            # the loop thread is stuck in a callback, so reading its current task is safe here
+            task = asyncio.tasks._current_tasks.get(self._loop)
+            coro = task.get_coro() if task is not None else None
+            frame = sys._current_frames().get(self._loop_thread_id)
+            self._blocked = getattr(coro, '__qualname__', 'a callback outside of tasks')
+
+            logger.warning(f'Event loop blocked for {late * 1000:.0f} ms so far by {self._blocked} at {_format_stack(frame)}')
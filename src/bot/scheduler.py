@@ -0,0 +1,215 @@
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Tuple
+from loguru import logger
+from aiogram.types import Message
+from src.config import SCHEDULER_OPTIONS
+from src.utils.tracing import trace_span
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a job is rejected because the user's or the global queue is full."""
+
+
+class FairScheduler:
+    """
+    A singleton admission scheduler in front of the classification pipeline.
+
+    Every job takes one of `max_in_flight` pipeline slots. Interactive commands (/search, topic commands) are served
+    first and may additionally use `interactive_reserve` slots, so they never wait behind bulk traffic for long.
+    Bulk jobs (incoming messages) wait in per-user queues served by deficit round robin: every active user receives
+    `quantum` units of credit per round and a job is started once the user's credit covers its cost, so a user
+    forwarding thousands of messages gets the same share of the pipeline as a user sending one.
+
+    Independently of admission, `resource` bounds the number of concurrent calls to each external resource
+    (OpenAI, the embedding model, the Telegram API).
+
+    Jobs that would exceed `max_user_queue` queued jobs of one user or `max_queue` queued jobs in total are rejected
+    with SchedulerOverloaded.
+
+    Attributes:
+        max_in_flight (int): Pipeline slots shared by all jobs.
+        interactive_reserve (int): Extra slots only interactive jobs may use.
+        quantum (int): Credit added to a user's deficit per round.
+        max_user_queue (int): Maximum number of queued bulk jobs per user.
+        max_queue (int): Maximum number of queued jobs in total.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.max_in_flight = SCHEDULER_OPTIONS['max_in_flight']
+            cls._instance.interactive_reserve = SCHEDULER_OPTIONS['interactive_reserve']
+            cls._instance.quantum = SCHEDULER_OPTIONS['quantum']
+            cls._instance.max_user_queue = SCHEDULER_OPTIONS['max_user_queue']
+            cls._instance.max_queue = SCHEDULER_OPTIONS['max_queue']
+            cls._instance._interactive: Deque[asyncio.Future] = deque()
+            cls._instance._queues: 'OrderedDict[int, Deque[Tuple[int, asyncio.Future]]]' = OrderedDict()
+            cls._instance._deficits: Dict[int, int] = {}
+            cls._instance._queued = 0
+            cls._instance._in_flight = 0
+            cls._instance._resources: Dict[str, asyncio.Semaphore] = {}
+            cls._instance._notified: Dict[int, float] = {}
+            cls._instance.shed_count = 0
+
+        return cls._instance
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, interactive: bool = False, cost: int = 1):
+        """
+        Waits for a pipeline slot and holds it for the duration of the block.
+
+        Args:
+            user_id (int): The user the job belongs to.
+            interactive (bool): Serve the job ahead of bulk traffic.
+            cost (int): Credit consumed by a bulk job, e.g. the number of messages in it.
+
+        Raises:
+            SchedulerOverloaded: If the queue limits are exceeded.
+        """
+        future = self._enqueue(user_id, interactive, cost)
+
+        try:
+            with trace_span('queue'):
+                await future
+        except asyncio.CancelledError:
+            # a slot granted concurrently with the cancellation must be given back
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._discard(user_id, future)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def resource(self, name: str):
+        """
+        Bounds the number of concurrent calls to an external resource.
+
+        Args:
+            name (str): A key of `scheduler_resources`, e.g. 'openai', 'embedder' or 'telegram'.
+        """
+        semaphore = self._resources.get(name)
+
+        if semaphore is None:
+            semaphore = self._resources[name] = asyncio.Semaphore(SCHEDULER_OPTIONS['resources'][name])
+
+        with trace_span(f'wait:{name}'):
+            await semaphore.acquire()
+
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def notify_shed(self, message: Message):
+        """
+        Tells the user that their message was not processed, at most once per `notice_interval_s`.
+
+        Args:
+            message (Message): The rejected message.
+        """
+        user_id = message.from_user.id
+        now = time.monotonic()
+
+        if now - self._notified.get(user_id, -float('inf')) < SCHEDULER_OPTIONS['notice_interval_s']:
+            return
+
+        self._notified[user_id] = now
+
+        try:
+            await message.answer('Слишком много сообщений в обработке. Часть сообщений не отсортирована, перешлите их позже')
+        except Exception as e:
+            logger.warning(f'Failed to send the overload notice: {e}')
+
+    def stats(self) -> Dict:
+        """Returns queue and slot counters."""
+        return {
+            'in_flight': self._in_flight,
+            'queued': self._queued,
+            'interactive_queued': len(self._interactive),
+            'active_users': len(self._queues),
+            'shed': self.shed_count
+        }
+
+    def _enqueue(self, user_id: int, interactive: bool, cost: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+
+        if interactive:
+            self._interactive.append(future)
+        else:
+            queue = self._queues.get(user_id)
+
+            if self._queued >= self.max_queue or (queue is not None and len(queue) >= self.max_user_queue):
+                self.shed_count += 1
+                raise SchedulerOverloaded(f'Queue limit exceeded for user {user_id}')
+
+            if queue is None:
+                queue = self._queues[user_id] = deque()
+                self._deficits[user_id] = 0
+
+            queue.append((cost, future))
+            self._queued += 1
+
+        self._dispatch()
+
+        return future
+
+    def _discard(self, user_id: int, future: asyncio.Future):
+        if future in self._interactive:
+            self._interactive.remove(future)
+            return
+
+        queue = self._queues.get(user_id)
+
+        for item in list(queue or ()):
+            if item[1] is future:
+                queue.remove(item)
+                self._queued -= 1
+
+        if queue is not None and not queue:
+            del self._queues[user_id]
+            del self._deficits[user_id]
+
+    def _release(self):
+        self._in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._interactive and self._in_flight < self.max_in_flight + self.interactive_reserve:
+            self._start(self._interactive.popleft())
+
+        while self._queues and self._in_flight < self.max_in_flight:
+            # the user at the head of the round either runs a job or receives a quantum and moves to the tail
+            user_id, queue = next(iter(self._queues.items()))
+            cost, future = queue[0]
+
+            if self._deficits[user_id] < cost:
+                self._deficits[user_id] += self.quantum
+                self._queues.move_to_end(user_id)
+                continue
+
+            queue.popleft()
+            self._queued -= 1
+            self._deficits[user_id] -= cost
+
+            if not queue:
+                # idle users don't accumulate credit
+                del self._queues[user_id]
+                del self._deficits[user_id]
+
+            self._start(future)
+
+    def _start(self, future: asyncio.Future):
+        if future.done():
+            return
+
+        self._in_flight += 1
+        future.set_result(None)
@@ -0,0 +1,153 @@
+import math
+import time
+import secrets
+from html import escape
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from src.config import SEARCH_OPTIONS
+from database.msg_data import MsgData
+
+
+class SearchPage(CallbackData, prefix='search'):
+    """Callback data of the paging buttons; the token fits the 64 bytes Telegram allows for callback data."""
+    token: str
+    page: int
+
+
+class SearchEntry:
+    """
+    Ranked results of a /search command.
+
+    Attributes:
+        user_id (int): The user who searched.
+        chat_id (int): The chat searched.
+        pattern (str): The search pattern.
+        msg_ids (List[int]): Identifiers of the similar messages, most similar first.
+        created (float): Monotonic time the results were ranked.
+    """
+    __slots__ = ('user_id', 'chat_id', 'pattern', 'msg_ids', 'created')
+
+    def __init__(self, user_id: int, chat_id: int, pattern: str, msg_ids: List[int]):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.pattern = pattern
+        self.msg_ids = msg_ids
+        self.created = time.monotonic()
+
+    @property
+    def pages(self) -> int:
+        return max(1, math.ceil(len(self.msg_ids) / SEARCH_OPTIONS['page_size']))
+
+    def page_ids(self, page: int) -> List[int]:
+        size = SEARCH_OPTIONS['page_size']
+        return self.msg_ids[page * size:(page + 1) * size]
+
+
+class SearchCache:
+    """
+    A singleton LRU cache of ranked search results, keyed by a random token sent in the paging buttons.
+
+    A page is rendered from the cached ids and one primary key lookup of the page's messages, so turning a page
+    neither embeds the pattern nor searches again. Entries expire after `search_cache_ttl_s`; a button of an
+    expired or evicted search, or one from before a restart, asks the user to search again.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._entries: OrderedDict = OrderedDict()
+            cls._instance.counters: Counter = Counter()
+
+        return cls._instance
+
+    def put(self, entry: SearchEntry) -> str:
+        """Caches the results of a search and returns their token."""
+        token = secrets.token_urlsafe(6)
+        self._entries[token] = entry
+
+        while len(self._entries) > SEARCH_OPTIONS['cache_size']:
+            self._entries.popitem(last=False)
+
+        return token
+
+    def get(self, token: str) -> Optional[SearchEntry]:
+        """Returns the cached results of a search, None if they expired or were evicted."""
+        entry = self._entries.get(token)
+
+        if entry is None or time.monotonic() - entry.created > SEARCH_OPTIONS['cache_ttl_s']:
+            self._entries.pop(token, None)
+            self.counters['misses'] += 1
+            return None
+
+        self._entries.move_to_end(token)
+        self.counters['hits'] += 1
+
+        return entry
+
+
+def message_link(chat_id: int, topic_id: int, msg_id: int) -> str:
+    """Builds a link opening a message in its topic; only members of the chat can follow it."""
+    internal_id = str(chat_id)[4:] if str(chat_id).startswith('-100') else str(abs(chat_id))
+
+    return f'https://t.me/c/{internal_id}/{topic_id}/{msg_id}'
+
+
+def shorten(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:max(limit - 1, 0)].rstrip() + '…'
+
+
+def render_page(token: str, entry: SearchEntry, messages: List[MsgData], page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Renders a page of search results as HTML text with links to the messages in their topics. The pattern in the
+    header is cut to `pattern_chars` and the snippets are shortened so that the visible text stays within
+    Telegram's message limit.
+
+    Args:
+        token (str): The token of the cached results.
+        entry (SearchEntry): The cached results.
+        messages (List[MsgData]): Messages of the page, see `MsgController.get_messages_by_ids`.
+        page (int): Zero-based page number.
+
+    Returns:
+        Tuple[str, Optional[InlineKeyboardMarkup]]: The text and the paging buttons, None for a single page.
+    """
+    first = page * SEARCH_OPTIONS['page_size']
+    header = (
+        f'Результаты поиска «{shorten(entry.pattern, SEARCH_OPTIONS["pattern_chars"])}»: '
+        f'{first + 1}–{first + len(entry.page_ids(page))} из {len(entry.msg_ids)}'
+    )
+    footer = '\nЧасть сообщений страницы удалена' if len(messages) < len(entry.page_ids(page)) else ''
+    prefixes = [f'\n\n{i}. {msg.category}: ' for i, msg in enumerate(messages, first + 1)]
+
+    # Telegram counts the text without the HTML markup
+    available = SEARCH_OPTIONS['max_text_chars'] - len(header) - len('\n' + footer if footer else '') - sum(map(len, prefixes))
+    limit = min(SEARCH_OPTIONS['snippet_chars'], available // max(len(messages), 1))
+    lines = [escape(header)]
+
+    for i, msg in enumerate(messages, first + 1):
+        topic = escape(msg.category)
+
+        # messages sorted before topic_msg_id was stored have no known copy to link to
+        if msg.topic_msg_id is not None:
+            topic = f'<a href="{message_link(msg.chat_id, msg.topic_id, msg.topic_msg_id)}">{topic}</a>'
+
+        lines.append(f'\n{i}. {topic}: {escape(shorten(msg.msg_text, limit))}')
+
+    if footer:
+        lines.append(footer)
+
+    if entry.pages == 1:
+        return '\n'.join(lines), None
+
+    buttons = []
+
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text='« Назад', callback_data=SearchPage(token=token, page=page - 1).pack()))
+
+    if page < entry.pages - 1:
+        buttons.append(InlineKeyboardButton(text='Вперёд »', callback_data=SearchPage(token=token, page=page + 1).pack()))
+
+    return '\n'.join(lines), InlineKeyboardMarkup(inline_keyboard=[buttons])
@@ -1,15 +1,31 @@
-import re
-from typing import Tuple, List
+import copy
+import asyncio
+from typing import Tuple, List, Optional
+import numpy as np
+from loguru import logger
 from aiogram.types import Message
 from aiogram import types
 from src.models.gpt_classifier import GptClassifier
-from src.utils.utils import extract_text_from_url, extract_description_from_yt
+from src.utils.utils import extract_urls, strip_urls, merge_enriched_text
+from src.utils.url_store import UrlStore
+from src.utils.document_sandbox import DocumentSandbox
 from database.topic_controller import UserTopicController as db_controller
 from database.msg_controller import MsgData, MsgController as msg_controller
+from database.dup_index import DuplicateIndex, message_fingerprint
+from src.models.centroid_classifier import CentroidClassifier
+from src.bot.scheduler import FairScheduler
+from src.bot.profiling import profiled_stage
+from src.bot.deadline import Deadline, DeadlineExceeded
+from src.bot.usage import UsageLedger
+from src.bot.search import SearchEntry, SearchCache, render_page
+from src.utils.tracing import trace_span, trace_set, trace_add
+from src.bot.media_group import text_part
+from src.config import DEDUP_OPTIONS, CENTROID_OPTIONS, REROUTE_OPTIONS, DEADLINE_OPTIONS, ENRICH_OPTIONS, DOCUMENT_OPTIONS
 from sentence_transformers import SentenceTransformer
 
-link_pattern = re.compile(r"((http|https)\:\/\/)?[а-яА-Яa-zA-Z0-9\.\/\?\:@\-_=#]+\.([а-яА-Яa-zA-Z]){2,6}([а-яА-Яa-zA-Z0-9\.\&\/\?\:@\-_=#])*")
-yt_pattern = re.compile(r"http(?:s?):\/\/(?:www\.)?youtu(?:be\.com\/watch\?v=|\.be\/)([\w\-\_]*)(&(amp;)?‌​[\w\?‌​=]*)?")
+# chats with a running re-sorting of 'unknown' messages and the background tasks running it
+rerouting_chats = set()
+reroute_tasks = set()
 
 
 class TgController:
@@ -17,13 +33,17 @@ class TgController:
     Handles Telegram group chat topics by adding, editing, and deleting topics.
     """
     @staticmethod
-    async def add_topic(message: Message, topic_name: str):
+    @profiled_stage
+    async def add_topic(message: Message, topic_name: str, embedder: SentenceTransformer = None, classifier: GptClassifier = None):
         """
-        Adds a new topic to a Telegram group chat and stores it in the database.
+        Adds a new topic to a Telegram group chat and stores it in the database. If the embedder and the classifier
+        are given, messages of the 'unknown' topic that belong to the new topic are moved into it.
 
         Args:
             message (Message): The Telegram message object, containing user and chat IDs.
             topic_name (str): The name of the topic to be added.
+            embedder (SentenceTransformer): The model used to embed the topic name.
+            classifier (GptClassifier): The classifier used to check borderline messages.
 
         Responds with an error message if the topic already exists or if there are issues in creating or saving the topic.
         """
@@ -56,18 +76,28 @@ class TgController:
                 await message.answer(f"Тема '{topic_name}' успешно создана")
             else:
                 await message.answer(f'Ошибка сохранения в БД темы "{topic_name}"')
+                return
         except Exception as e:
             await message.answer(f"Ошибка создания новой темы: {str(e)}")
+            return
+
+        if embedder is not None and classifier is not None:
+            TgController.start_reroute(message, topic_name, topic.message_thread_id, embedder, classifier)
 
     @staticmethod
-    async def edit_topic(message: Message, curr_topic_name: str, new_topic_name: str):
+    @profiled_stage
+    async def edit_topic(message: Message, curr_topic_name: str, new_topic_name: str,
+                         embedder: SentenceTransformer = None, classifier: GptClassifier = None):
         """
-        Edits the name of an existing topic in a Telegram group chat.
+        Edits the name of an existing topic in a Telegram group chat. If the embedder and the classifier are given,
+        messages of the 'unknown' topic that belong to the renamed topic are moved into it.
 
         Args:
             message (Message): The Telegram message object.
             curr_topic_name (str): The current name of the topic.
             new_topic_name (str): The new name to replace the current topic name.
+            embedder (SentenceTransformer): The model used to embed the topic name.
+            classifier (GptClassifier): The classifier used to check borderline messages.
 
         Notifies the user if the topic does not exist, if the new name is already in use, or if there are issues in renaming the topic.
         """
@@ -107,12 +137,19 @@ class TgController:
                     await message.answer(f'Тема "{curr_topic_name}" успешно переименована в "{new_topic_name}"')
                 else:
                     await message.answer(f'Ошибка переименование темы "{curr_topic_name}" в БД')
+                    return
             else:
                 await message.answer(f'Ошибка переименование темы "{curr_topic_name}"')
+                return
         except Exception as e:
             await message.answer(f"Ошибка переименования темы: {str(e)}")
+            return
+
+        if embedder is not None and classifier is not None:
+            TgController.start_reroute(message, new_topic_name, curr_topic_id, embedder, classifier)
 
     @staticmethod
+    @profiled_stage
     async def del_topic(message: Message, topic_name: str):
         """
         Deletes a topic from a Telegram group chat and removes it from the database.
@@ -153,7 +190,181 @@ class TgController:
             await message.answer(f"Ошибка удаления темы: {str(e)}")
 
     @staticmethod
-    async def move_message(message: Message, topic_name: str):
+    def start_reroute(message: Message, topic_name: str, topic_id: int, embedder: SentenceTransformer, classifier: GptClassifier):
+        """
+        Starts `reroute_unknown` as a background task, so that the topic command releases its interactive scheduler
+        slot instead of holding it for the scan and the GPT checks.
+
+        Args:
+            message (Message): The Telegram message object of the topic command.
+            topic_name (str): The name of the target topic.
+            topic_id (int): The identifier of the target topic.
+            embedder (SentenceTransformer): The model used to embed the topic name.
+            classifier (GptClassifier): The classifier used to check borderline messages.
+        """
+        task = asyncio.create_task(TgController.reroute_unknown(message, topic_name, topic_id, embedder, classifier))
+        reroute_tasks.add(task)
+        task.add_done_callback(reroute_tasks.discard)
+
+    @staticmethod
+    @profiled_stage
+    async def reroute_unknown(message: Message, topic_name: str, topic_id: int, embedder: SentenceTransformer, classifier: GptClassifier):
+        """
+        Moves messages of the 'unknown' topic that belong to a new or renamed topic. Stored embeddings of up to
+        `reroute_max_messages` messages are scored against the embedded topic name in one pass per batch, off the event
+        loop; clear matches are accepted, up to `reroute_max_gpt` borderline ones are checked by GPT in batches. The
+        winners are moved with batched forward and delete calls and a single update per batch, and their embeddings are
+        moved from the 'unknown' centroid to the topic's. Progress is reported in one edited message.
+
+        Only messages whose copy in the 'unknown' topic is known (`topic_msg_id`) can be moved: messages stored before
+        the copies were recorded, or whose copy could not be matched, stay in 'unknown' and are reported as unmovable.
+
+        Args:
+            message (Message): The Telegram message object of the topic command.
+            topic_name (str): The name of the target topic.
+            topic_id (int): The identifier of the target topic.
+            embedder (SentenceTransformer): The model used to embed the topic name.
+            classifier (GptClassifier): The classifier used to check borderline messages.
+        """
+        user_id = message.from_user.id
+        chat_id = message.chat.id
+
+        if not REROUTE_OPTIONS['enabled'] or (user_id, chat_id) in rerouting_chats:
+            return
+
+        unknown_id = db_controller.get_topic_id(user_id, chat_id, 'unknown')
+
+        if not unknown_id or unknown_id == topic_id:
+            return
+
+        rerouting_chats.add((user_id, chat_id))
+        status = None
+
+        try:
+            accepted, borderline, scanned, unmovable = await asyncio.to_thread(
+                TgController._score_unknown, user_id, chat_id, unknown_id, topic_name, embedder
+            )
+
+            if unmovable:
+                logger.info(f'{unmovable} unknown messages of user {user_id} chat {chat_id} have no known copy and stay in place')
+
+            if not accepted and not borderline:
+                return
+
+            status = await message.answer(
+                f'Проверено {scanned} сообщений темы "unknown": {len(accepted)} подходят теме "{topic_name}", '
+                f'{len(borderline)} требуют проверки' + (f', {unmovable} нельзя переместить' if unmovable else '')
+            )
+
+            # the most similar borderline messages are checked first, none for users over the daily OpenAI budget
+            borderline.sort(key=lambda item: -item[0])
+            borderline = borderline[:REROUTE_OPTIONS['max_gpt']] if not UsageLedger().over_budget(user_id) else []
+
+            gpt = copy.copy(classifier)
+            gpt.msg_classes = {topic_name: topic_id, 'unknown': unknown_id}
+
+            for i in range(0, len(borderline), REROUTE_OPTIONS['gpt_batch']):
+                batch = borderline[i:i + REROUTE_OPTIONS['gpt_batch']]
+                usage = {}
+
+                try:
+                    async with FairScheduler().resource('openai'):
+                        responses = await gpt.predict([msgData for _, msgData, _ in batch], usage=usage)
+                finally:
+                    UsageLedger().record(user_id, usage)
+
+                accepted.extend(
+                    (msgData, msg_emb) for (_, msgData, msg_emb), response in zip(batch, responses)
+                    if response['msg_class'] == topic_name
+                )
+
+                await TgController._edit_status(status, f'Проверено GPT {i + len(batch)} из {len(borderline)}, к перемещению {len(accepted)}')
+
+            # forwardMessages requires increasing identifiers
+            accepted.sort(key=lambda item: item[0].topic_msg_id)
+            moved = 0
+
+            for i in range(0, len(accepted), REROUTE_OPTIONS['tg_batch']):
+                batch = accepted[i:i + REROUTE_OPTIONS['tg_batch']]
+                src_ids = [msgData.topic_msg_id for msgData, _ in batch]
+
+                copies = await message.bot.forward_messages(chat_id=chat_id, from_chat_id=chat_id, message_ids=src_ids, message_thread_id=topic_id)
+
+                # messages deleted by the user are skipped by Telegram, then the copies can't be matched
+                topic_msg_ids = [msg.message_id for msg in copies] if len(copies) == len(src_ids) else [None] * len(src_ids)
+
+                await message.bot.delete_messages(chat_id=chat_id, message_ids=src_ids)
+
+                if msg_controller.move_messages(user_id, chat_id, topic_id, [msgData.msg_id for msgData, _ in batch], topic_msg_ids) != 0:
+                    await TgController._edit_status(status, f'Ошибка сохранения в БД, перемещено {moved} сообщений')
+                    return
+
+                if CENTROID_OPTIONS['enabled']:
+                    msg_embs = np.stack([msg_emb for _, msg_emb in batch])
+                    CentroidClassifier().add_many(user_id, chat_id, topic_id, msg_embs)
+                    CentroidClassifier().remove_many(user_id, chat_id, unknown_id, msg_embs)
+
+                moved += len(batch)
+                await TgController._edit_status(status, f'Перемещено {moved} из {len(accepted)} сообщений в тему "{topic_name}"')
+
+            logger.info(f'Rerouted {moved} of {scanned} unknown messages of user {user_id} chat {chat_id} to topic {topic_id}')
+        except Exception as e:
+            logger.exception(f'Rerouting of unknown messages failed: {e}')
+
+            if status is not None:
+                await TgController._edit_status(status, f'Ошибка перемещения сообщений из темы "unknown": {str(e)}')
+        finally:
+            rerouting_chats.discard((user_id, chat_id))
+
+    @staticmethod
+    def _score_unknown(user_id: int, chat_id: int, unknown_id: int, topic_name: str,
+                       embedder: SentenceTransformer) -> Tuple[List, List, int, int]:
+        """
+        Scores up to `reroute_max_messages` stored messages of the 'unknown' topic against the embedded topic name.
+
+        Returns:
+            Tuple[List, List, int, int]: The accepted (msgData, msg_emb) pairs, the borderline (score, msgData, msg_emb)
+            triples, the number of scanned messages and the number of matching messages without a known copy.
+        """
+        topic_emb = msg_controller.storage_emb(embedder.model.encode(topic_name))
+        topic_emb = topic_emb / (np.linalg.norm(topic_emb) or 1)
+
+        accepted, borderline, scanned, unmovable = [], [], 0, 0
+
+        for messages, embs in msg_controller.iter_messages(user_id, chat_id, unknown_id):
+            norms = np.linalg.norm(embs, axis=1)
+            norms[norms == 0] = 1
+            scores = embs @ topic_emb / norms
+
+            # only messages whose copy in the topic is known can be moved
+            for msgData, msg_emb, score in zip(messages, embs, scores):
+                if score < REROUTE_OPTIONS['min_similarity']:
+                    continue
+
+                if msgData.topic_msg_id is None:
+                    unmovable += 1
+                elif score >= REROUTE_OPTIONS['accept_similarity']:
+                    accepted.append((msgData, msg_emb.copy()))
+                else:
+                    borderline.append((score, msgData, msg_emb.copy()))
+
+            scanned += len(messages)
+
+            if scanned >= REROUTE_OPTIONS['max_messages']:
+                break
+
+        return accepted, borderline, scanned, unmovable
+
+    @staticmethod
+    async def _edit_status(status: Message, text: str):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.warning(f'Failed to update the status message: {e}')
+
+    @staticmethod
+    @profiled_stage
+    async def move_message(message: Message, topic_name: str, deadline: Deadline = None):
         """
         Moves a message to a specified topic within a Telegram group chat. If the topic does not exist,
         it creates a new topic and adds the message to it. It also handles the deletion of the original message
@@ -162,6 +373,7 @@ class TgController:
         Args:
             message (Message): The Telegram message object that needs to be moved.
             topic_name (str): The name of the topic to which the message should be moved.
+            deadline (Deadline): The message's time budget; overruns are counted, the Telegram calls aren't cancelled.
 
         Responds with error messages if there are issues with topic verification, topic creation, message copying, or message deletion.
         """
@@ -169,8 +381,10 @@ class TgController:
         chat_id = message.chat.id
         message_id = message.message_id
         topic_name = topic_name.strip().lower()
+        deadline = deadline or Deadline()
 
-        topic_id = db_controller.get_topic_id(user_id, chat_id, topic_name)
+        with deadline.track('move'):
+            topic_id = db_controller.get_topic_id(user_id, chat_id, topic_name)
 
         if topic_id is None:
             await message.answer(f'Ошибка проверки идентификатора темы "{topic_name}"')
@@ -178,7 +392,7 @@ class TgController:
 
         if topic_id == 0:
             try:
-                topic = await message.bot.create_forum_topic(chat_id=chat_id, name=topic_name)
+                topic = await deadline.complete('move', message.bot.create_forum_topic(chat_id=chat_id, name=topic_name))
 
                 if not topic:
                     await message.answer(f'Ошибка добавления в чат темы "{topic_name}"')
@@ -197,36 +411,48 @@ class TgController:
 
         # copy & delete source message
         try:
-            msg = await message.bot.forward_message(chat_id=chat_id, from_chat_id=chat_id, message_thread_id=topic_id, message_id=message_id)
+            msg = await deadline.complete('move', message.bot.forward_message(
+                chat_id=chat_id, from_chat_id=chat_id, message_thread_id=topic_id, message_id=message_id
+            ))
 
             if msg:
-                del_result = await message.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                # the copy is what later re-sorting moves between topics
+                with deadline.track('move'):
+                    msg_controller.set_topic_msg_id(user_id, chat_id, message_id, msg.message_id)
+
+                del_result = await deadline.complete('move', message.bot.delete_message(chat_id=chat_id, message_id=message_id))
 
                 if not del_result:
                     message.answer('Ошибка удаления исходного сообщения')
+                else:
+                    trace_set(outcome='sorted')
             else:
                 message.answer(f'Ошибка копирования сообщения в тему "{topic_name}"')
         except Exception as e:
             await message.reply(f'Ошибка перемещения сообщения: {str(e)}')
 
     @staticmethod
-    async def move_media_group_message(messages: Message, topic_name: str):
+    @profiled_stage
+    async def move_media_group_message(messages: List[Message], topic_name: str, deadline: Deadline = None):
         """
-        Moves a message containing media group to a specified topic within a Telegram group chat. If the topic does not exist,
-        it creates a new topic and adds the message to it. It also handles the deletion of the original message
-        after it's successfully moved.
+        Moves an album to a specified topic within a Telegram group chat. If the topic does not exist,
+        it creates a new topic and adds the album to it. The parts are copied and the originals deleted
+        with one Bot API call each.
 
         Args:
-            message (Message): The Telegram message object that needs to be moved.
+            messages (List[Message]): The parts of the album in the order they were sent.
             topic_name (str): The name of the topic to which the message should be moved.
+            deadline (Deadline): The message's time budget; overruns are counted, the Telegram calls aren't cancelled.
 
         Responds with error messages if there are issues with topic verification, topic creation, message copying, or message deletion.
         """
         user_id = messages[-1].from_user.id
         chat_id = messages[-1].chat.id
         topic_name = topic_name.strip().lower()
+        deadline = deadline or Deadline()
 
-        topic_id = db_controller.get_topic_id(user_id, chat_id, topic_name)
+        with deadline.track('move'):
+            topic_id = db_controller.get_topic_id(user_id, chat_id, topic_name)
 
         if topic_id is None:
             await messages[-1].answer(f'Ошибка проверки идентификатора темы "{topic_name}"')
@@ -234,7 +460,7 @@ class TgController:
 
         if topic_id == 0:
             try:
-                topic = await messages[-1].bot.create_forum_topic(chat_id=chat_id, name=topic_name)
+                topic = await deadline.complete('move', messages[-1].bot.create_forum_topic(chat_id=chat_id, name=topic_name))
 
                 if not topic:
                     await messages[-1].answer(f'Ошибка добавления в чат темы "{topic_name}"')
@@ -251,42 +477,56 @@ class TgController:
                 await messages[-1].answer(f"Ошибка создания новой темы: {str(e)}")
                 return
 
-        # copy & delete source message
+        # copy & delete the album with one call each, keeping every part's media type and the caption
+        msg_ids = [message.message_id for message in messages]
+
         try:
-            msg = await messages[-1].bot.send_media_group(
-                media=[
-                    types.InputMediaPhoto(
-                        media=message.photo[-1].file_id,
-                        caption=message.caption,
-                        caption_entities=message.caption_entities,
-                    )
-                    for message in messages
-                ],
-                chat_id=messages[-1].chat.id,
-                message_thread_id=topic_id,
-            )
+            copies = await deadline.complete('move', messages[-1].bot.copy_messages(
+                chat_id=chat_id, from_chat_id=chat_id, message_ids=msg_ids, message_thread_id=topic_id
+            ))
 
-            if msg:
-                del_result = all([await message.bot.delete_message(chat_id=chat_id, message_id=message.message_id) for message in messages])
+            if copies:
+                text_message = text_part(messages)
+
+                # only the part carrying the text is stored
+                if text_message is not None and len(copies) == len(msg_ids):
+                    with deadline.track('move'):
+                        msg_controller.set_topic_msg_id(
+                            user_id, chat_id, text_message.message_id, copies[msg_ids.index(text_message.message_id)].message_id
+                        )
+
+                del_result = await deadline.complete('move', messages[-1].bot.delete_messages(chat_id=chat_id, message_ids=msg_ids))
 
                 if not del_result:
                     messages[-1].answer('Ошибка удаления исходного сообщения')
+                else:
+                    trace_set(outcome='sorted')
             else:
                 messages[-1].answer(f'Ошибка копирования сообщения в тему "{topic_name}"')
         except Exception as e:
             await messages[-1].reply(f'Ошибка перемещения сообщения: {str(e)}')
 
     @staticmethod
-    async def classify_message(message: Message, embedder: SentenceTransformer, classifier: GptClassifier) -> Tuple[bool, str]:
+    @profiled_stage
+    async def classify_message(message: Message, embedder: SentenceTransformer, classifier: GptClassifier,
+                               deadline: Deadline = None) -> Tuple[bool, str]:
         """
         Classifies the content of a message using a SentenceTransformer model for embedding and a GPT classifier
-        for determining the category. It also checks if the classified category is valid and exists within the user's
+        for determining the category. Reposts of stored messages and messages close enough to a single topic centroid
+        are classified without calling GPT. It also checks if the classified category is valid and exists within the user's
         current topics and saves the classification result.
 
+        Every stage runs within the message's deadline, keeping `msg_deadline_move_reserve_s` for the move: link
+        enrichment is skipped when the budget is short, and the centroid guess (or 'unknown') is used instead of
+        a GPT answer that would come too late. Users over their daily OpenAI token budget are classified the same way.
+        The text of links and of PDF, txt, md and docx documents is merged with the message's own text; a document
+        without a caption whose text can't be extracted is sorted by its content type.
+
         Args:
             message (Message): The Telegram message object containing the text to be classified.
             embedder (SentenceTransformer): The SentenceTransformer model used to encode the message text into embeddings.
             classifier (GptClassifier): The GPT-based classifier used to predict the category of the message.
+            deadline (Deadline): The message's time budget, a new one if not given.
 
         Returns:
             Tuple[bool, str]: A tuple containing a boolean indicating the success of the classification and the classified category.
@@ -297,19 +537,17 @@ class TgController:
         user_id = message.from_user.id
         chat_id = message.chat.id
         msg_id = message.message_id
+        msg_text, entities = '', None
         if message.text:
-            msg_text = message.text
+            msg_text, entities = message.text, message.entities
         if message.caption:
-            msg_text = message.caption
+            msg_text, entities = message.caption, message.caption_entities
 
-        if yt_pattern.match(msg_text):
-            msg_text = extract_description_from_yt(msg_text)
-        elif link_pattern.match(msg_text):
-            msg_text = extract_text_from_url(msg_text)
+        deadline = deadline or Deadline()
+        move_reserve = DEADLINE_OPTIONS['move_reserve_s']
 
-        msg_text = msg_text.lower().strip()
-
-        curr_topics = db_controller.get_user_topics(user_id, chat_id)
+        with deadline.track('topics'):
+            curr_topics = db_controller.get_user_topics(user_id, chat_id)
 
         if curr_topics is None:
             await message.answer('Ошибка определения списка доступных категорий/топиков')
@@ -319,27 +557,164 @@ class TgController:
             await message.answer('Список доступных категорий/топиков пуст')
             return False, ''
 
-        msg_emb = embedder.model.encode(msg_text)
+        # reposts inherit the topic of their stored duplicate and skip enrichment, embedding and GPT;
+        # the caption of a document isn't its content, so documents aren't matched by it
+        msg_fingerprint = message_fingerprint(msg_text)
+        has_document = DocumentSandbox.supports(message.document)
 
-        classifier.msg_classes = curr_topics
+        if DEDUP_OPTIONS['enabled'] and msg_fingerprint is not None and not has_document:
+            with deadline.track('dedup'):
+                duplicate = await asyncio.to_thread(DuplicateIndex().find, user_id, chat_id, msg_fingerprint)
 
-        msgData = MsgData(user_id=user_id, chat_id=chat_id, msg_id=msg_id, msg_text=msg_text)
+            topic_names = {topic_id: topic_name for topic_name, topic_id in curr_topics.items()}
 
-        responses = await classifier.predict([msgData])
+            if duplicate is not None and duplicate[1] in topic_names:
+                dupMsgData = MsgData(user_id=user_id, chat_id=chat_id, msg_id=msg_id, msg_text=msg_text)
+                dupMsgData.topic_id = duplicate[1]
+                dupMsgData.msg_fingerprint = msg_fingerprint
 
-        if not responses:
-            await message.answer('Нет ответа от классификатора')
-            return False, ''
+                with deadline.track('dedup'):
+                    saved = msg_controller.save_duplicate(dupMsgData, duplicate[0]) == 0
+
+                if saved:
+                    trace_set(classified_by='duplicate', category=topic_names[duplicate[1]])
+                    return True, topic_names[duplicate[1]]
+
+        # enrichment is optional: it only starts with enough budget left for classification and the move
+        urls = extract_urls(msg_text, entities)[:ENRICH_OPTIONS['max_links']]
+        enrich_reserve = DEADLINE_OPTIONS['classify_min_s'] + move_reserve
+        own_text = strip_urls(msg_text, urls)
+        enriched_url, link_emb, extra_texts = None, None, []
+
+        if urls and deadline.allows('enrich', DEADLINE_OPTIONS['enrich_min_s'], reserve=enrich_reserve):
+            # all links are fetched at once within a shared timeout; links shared by other users are
+            # served from zib.url_content together with their embedding
+            timeout = min(DEADLINE_OPTIONS['enrich_max_s'], deadline.remaining(enrich_reserve))
+
+            with trace_span('enrich', links=len(urls)) as span:
+                results = await UrlStore().get_many(urls, timeout)
+
+                if span is not None:
+                    span['pending'] = results.count(None)
+
+            link_texts = [result[0] for result in results if result is not None and result[0]]
+
+            if None in results:
+                deadline.miss('enrich')
+                logger.info(f'Enrichment of message {msg_id}: {results.count(None)} of {len(results)} links out of budget')
+
+            # a message that is just a link reuses the stored embedding of the page
+            if not own_text and not has_document and len(link_texts) == len(results) == 1 \
+                    and len(link_texts[0]) <= ENRICH_OPTIONS['max_chars']:
+                enriched_url, link_emb = urls[0], results[0][1]
+
+            extra_texts.extend(link_texts)
+
+        # documents are parsed by sandboxed worker processes
+        if has_document and deadline.allows('document', DEADLINE_OPTIONS['enrich_min_s'], reserve=enrich_reserve):
+            try:
+                doc_text = await deadline.run(
+                    'document', DocumentSandbox().extract(message.bot, message.document),
+                    reserve=enrich_reserve, limit=DOCUMENT_OPTIONS['timeout_s'] + DEADLINE_OPTIONS['enrich_min_s']
+                )
+            except DeadlineExceeded:
+                doc_text = None
+                logger.info(f'Text extraction of document {msg_id} skipped: out of budget')
+
+            if doc_text:
+                extra_texts.append(doc_text)
+
+        if extra_texts:
+            msg_text = merge_enriched_text(own_text, extra_texts, ENRICH_OPTIONS['max_chars'])
+
+        msg_text = msg_text.lower().strip()
+
+        if not msg_text:
+            # a document without a caption and without extractable text
+            trace_set(classified_by='content_type', category=message.content_type)
+            return True, message.content_type
+
+        async def embed():
+            async with FairScheduler().resource('embedder'):
+                return await asyncio.to_thread(embedder.model.encode, msg_text)
+
+        if enriched_url is not None and link_emb is not None:
+            msg_emb = link_emb
+            trace_add('link_embedding_reused')
         else:
-            response = responses[0]
+            try:
+                msg_emb = await deadline.run('embed', embed(), reserve=move_reserve)
+            except DeadlineExceeded:
+                await message.answer('Сообщение не отсортировано: превышено время обработки')
+                return False, ''
+
+            if enriched_url is not None:
+                UrlStore().save_embedding(enriched_url, msg_emb)
 
-        if response['process_status'].lower() == 'ok':
-            resultMsgData = response['message']
-            resultMsgData.category = response['msg_class']
-            resultMsgData.msg_emb = msg_emb
+        msgData = MsgData(user_id=user_id, chat_id=chat_id, msg_id=msg_id, msg_text=msg_text)
+
+        # confident centroid predictions skip the GPT call, ambiguous messages fall through to it
+        centroid_pred = None
+
+        if CENTROID_OPTIONS['enabled']:
+            with deadline.track('centroid'):
+                centroid_pred = CentroidClassifier().predict(
+                    user_id, chat_id, msg_controller.storage_emb(msg_emb), curr_topics,
+                    lambda topic_name: msg_controller.storage_emb(embedder.model.encode(topic_name))
+                )
+
+        if centroid_pred is not None and centroid_pred['confident']:
+            resultMsgData = msgData
+            resultMsgData.category = centroid_pred['msg_class']
+            trace_set(classified_by='centroid')
         else:
-            await message.answer('Ошибка классификации сообщения')
-            return False, ''
+            classifier.msg_classes = curr_topics
+
+            # the ambiguous centroid prediction is the 'local' step of the classifier's cascade
+            local_class = centroid_pred['msg_class'] if centroid_pred is not None else None
+
+            # filled as requests are sent, so that requests cancelled by the deadline are counted too
+            usage = {}
+
+            async def predict():
+                async with FairScheduler().resource('openai'):
+                    return await classifier.predict([msgData], [local_class], usage)
+
+            responses = None
+            over_budget = UsageLedger().over_budget(user_id)
+
+            if not over_budget and deadline.allows('classify', DEADLINE_OPTIONS['classify_min_s'], reserve=move_reserve):
+                try:
+                    responses = await deadline.run('classify', predict(), reserve=move_reserve)
+                except DeadlineExceeded:
+                    pass
+                finally:
+                    UsageLedger().record(user_id, usage)
+
+            if responses is None:
+                # a degraded class now rather than a better one after the deadline or over the daily OpenAI budget
+                degraded_class = local_class if local_class in curr_topics else 'unknown'
+                reason = 'daily OpenAI budget used up' if over_budget else 'out of time'
+                logger.info(f'Message {msg_id} classified as "{degraded_class}" without GPT: {reason}')
+                responses = [{'message': msgData, 'msg_class': degraded_class, 'process_status': 'ok', 'model': 'degraded'}]
+                trace_set(degraded_reason=reason)
+
+            if not responses:
+                await message.answer('Нет ответа от классификатора')
+                return False, ''
+            else:
+                response = responses[0]
+
+            if response['process_status'].lower() == 'ok':
+                resultMsgData = response['message']
+                resultMsgData.category = response['msg_class']
+                trace_set(classified_by=response.get('model'))
+            else:
+                await message.answer('Ошибка классификации сообщения')
+                return False, ''
+
+        resultMsgData.msg_emb = msg_emb
+        resultMsgData.msg_fingerprint = msg_fingerprint
 
         db_topic_id = curr_topics.get(resultMsgData.category, None)
 
@@ -349,20 +724,25 @@ class TgController:
         else:
             resultMsgData.topic_id = db_topic_id
 
-        db_result = msg_controller.save_messages([resultMsgData])
+        with deadline.track('save'):
+            db_result = msg_controller.save_messages([resultMsgData])
 
         if db_result != 0:
             message.answer('Ошибка сохранения результата классификации')
             return False, ''
 
+        trace_set(category=resultMsgData.category)
+
         return True, resultMsgData.category
 
     @staticmethod
-    async def search_messages(message: Message, msg_pattern: str, embedder: SentenceTransformer, top_k: int = 3) -> List[str]:
+    @profiled_stage
+    async def search_messages(message: Message, msg_pattern: str, embedder: SentenceTransformer,
+                              top_k: int = 3) -> Tuple[Optional[str], Optional[types.InlineKeyboardMarkup]]:
         """
         Searches for messages that are semantically similar to a given message pattern within the Telegram group chat.
         It uses a SentenceTransformer model to generate embeddings for the pattern and retrieves the top k similar messages
-        based on these embeddings.
+        based on these embeddings. The ranked message ids are cached, and the first page of results is rendered.
 
         Args:
             message (Message): The Telegram message object where the search command was invoked.
@@ -371,23 +751,56 @@ class TgController:
             top_k (int, optional): The number of top similar messages to retrieve. Defaults to 3.
 
         Returns:
-            List[str]: A list of similar message texts.
+            Tuple[str, InlineKeyboardMarkup]: The HTML text of the first page and its paging buttons, or (None, None)
+            if nothing was found.
 
         Raises:
             Responds with an error message if there are issues in generating embeddings or retrieving similar messages.
         """
         user_id = message.from_user.id
         chat_id = message.chat.id
-        msg_emb = embedder.model.encode(msg_pattern.lower().strip())
+
+        async with FairScheduler().resource('embedder'):
+            msg_emb = await asyncio.to_thread(embedder.model.encode, msg_pattern.lower().strip())
 
         sim_messages = msg_controller.search_sim_messages(user_id, chat_id, msg_emb, top_k)
 
         if sim_messages is None:
             await message.answer('Ошибка определения похожих сообщений')
-            return []
+            return None, None
 
         if len(sim_messages) == 0:
             await message.answer('Список похожих сообщений пуст')
-            return []
+            return None, None
+
+        entry = SearchEntry(user_id, chat_id, msg_pattern, [msg.msg_id for msg in sim_messages])
+        token = SearchCache().put(entry)
+
+        text, markup = TgController.search_page(token, entry, 0)
+
+        if text is None:
+            await message.answer('Ошибка определения похожих сообщений')
+
+        return text, markup
+
+    @staticmethod
+    def search_page(token: str, entry: SearchEntry, page: int) -> Tuple[Optional[str], Optional[types.InlineKeyboardMarkup]]:
+        """
+        Renders a page of cached search results; only the messages of the page are read from the database.
+
+        Args:
+            token (str): The token of the cached results.
+            entry (SearchEntry): The cached results, see `SearchCache.get`.
+            page (int): Zero-based page number, clamped to the existing pages.
+
+        Returns:
+            Tuple[str, InlineKeyboardMarkup]: The HTML text of the page and its paging buttons, (None, None) in case of
+            an error.
+        """
+        page = min(max(page, 0), entry.pages - 1)
+        messages = msg_controller.get_messages_by_ids(entry.user_id, entry.chat_id, entry.page_ids(page))
+
+        if messages is None:
+            return None, None
 
-        return sim_messages
\ No newline at end of file
+        return render_page(token, entry, messages, page)
\ No newline at end of file
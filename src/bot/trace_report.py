@@ -0,0 +1,237 @@
+"""
+Offline report of the per-message traces written with `trace_enabled=1` (see src/utils/tracing.py).
+
+Reads the trace file and its rotated backups (or the given files) and prints the outcomes and total latency of
+the messages, per-stage latency percentiles, the summed counters (cache hits, retries, tokens) and the slowest
+messages with their latency waterfall:
+
+    python -m src.bot.trace_report traces/messages.jsonl --top 10
+    python -m src.bot.trace_report traces/ --handler text --since 2024-05-01T10:00 --waterfalls 3
+
+Doesn't import the bot's configuration, so it runs anywhere the trace files are copied to.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+DEFAULT_PATH = os.path.join('traces', 'messages.jsonl')
+
+
+def trace_files(paths: Iterable[str]) -> List[str]:
+    """Expands directories and trace files into the files themselves and their rotated backups, oldest first."""
+    files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, '*.jsonl*')))
+        else:
+            files.extend(glob.glob(path + '*') or [path])
+
+    def age(file: str) -> Tuple[str, int]:
+        base, _, suffix = file.rpartition('.')
+        return (base, -int(suffix)) if suffix.isdigit() else (file, 0)
+
+    return sorted(set(files), key=age)
+
+
+def load_traces(files: Iterable[str], handler: Optional[str] = None, since: Optional[str] = None) -> Tuple[List[Dict], int]:
+    """
+    Loads trace records.
+
+    Args:
+        files (Iterable[str]): JSON lines files.
+        handler (str, optional): Only records of this handler.
+        since (str, optional): Only records at or after this ISO timestamp (UTC).
+
+    Returns:
+        Tuple[List[Dict], int]: The records and the number of unreadable lines.
+    """
+    records, bad = [], 0
+
+    for file in files:
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    bad += 1
+                    continue
+
+                if handler and record.get('handler') != handler:
+                    continue
+
+                if since and record.get('ts', '') < since:
+                    continue
+
+                records.append(record)
+
+    return records, bad
+
+
+def span_end(span: Dict, record: Dict) -> float:
+    # stages still running when the record was written, e.g. shared link fetches, end with the message
+    return span.get('end_ms', record['total_ms'])
+
+
+def self_times(record: Dict) -> List[Tuple[Dict, float]]:
+    """Returns every span with its own time, i.e. its duration minus that of its direct children."""
+    spans = record['spans']
+    result = []
+
+    for i, span in enumerate(spans):
+        duration = span_end(span, record) - span['start_ms']
+        children = 0.0
+
+        for child in spans[i + 1:]:
+            if child['depth'] <= span['depth']:
+                break
+
+            if child['depth'] == span['depth'] + 1:
+                children += span_end(child, record) - child['start_ms']
+
+        result.append((span, max(duration - children, 0.0)))
+
+    return result
+
+
+def percentiles(values: List[float]) -> str:
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f'{p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {max(values):>9.1f}'
+
+
+def print_summary(records: List[Dict]):
+    totals = [r['total_ms'] for r in records]
+    outcomes = Counter(r['attrs'].get('outcome', 'incomplete') for r in records)
+    classified = Counter(r['attrs'].get('classified_by') or '-' for r in records)
+
+    print(f'{len(records)} messages from {records[0]["ts"]} to {records[-1]["ts"]}')
+    print(f'outcome       {"  ".join(f"{k}={v}" for k, v in outcomes.most_common())}')
+    print(f'classified by {"  ".join(f"{k}={v}" for k, v in classified.most_common())}')
+    print(f'\n{"total ms":<28} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}')
+
+    print(f'{"all":<28} {percentiles(totals)}')
+
+    for handler in sorted({r['handler'] for r in records}):
+        print(f'{handler:<28} {percentiles([r["total_ms"] for r in records if r["handler"] == handler])}')
+
+
+def print_stages(records: List[Dict]):
+    """Prints per-stage percentiles of the time per message, and the share of all messages' time the stage owns."""
+    durations: Dict[str, List[float]] = defaultdict(list)
+    own: Counter = Counter()
+    errors: Counter = Counter()
+    total = sum(r['total_ms'] for r in records) or 1.0
+
+    for record in records:
+        per_message: Counter = Counter()
+
+        for span, self_time in self_times(record):
+            name = span['name']
+            per_message[name] += span_end(span, record) - span['start_ms']
+            own[name] += self_time
+
+            if 'error' in span:
+                errors[name] += 1
+
+        for name, duration in per_message.items():
+            durations[name].append(duration)
+
+    print(f'\n{"stage ms per message":<28} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9} {"msgs":>6} {"own %":>6} {"errors":>6}')
+
+    for name in sorted(durations, key=lambda name: -own[name]):
+        print(f'{name:<28} {percentiles(durations[name])} {len(durations[name]):>6} '
+              f'{own[name] / total * 100:>6.1f} {errors[name]:>6}')
+
+
+def print_counters(records: List[Dict]):
+    sums: Counter = Counter()
+    messages: Counter = Counter()
+
+    for record in records:
+        for key, value in record['counters'].items():
+            sums[key] += value
+            messages[key] += 1
+
+    if not sums:
+        return
+
+    print(f'\n{"counter":<28} {"sum":>9} {"msgs":>6} {"per msg":>9}')
+
+    for key in sorted(sums):
+        print(f'{key:<28} {sums[key]:>9} {messages[key]:>6} {sums[key] / len(records):>9.2f}')
+
+
+def waterfall(record: Dict, width: int = 60) -> List[str]:
+    """Renders the spans of a message as bars on a time axis from its arrival to the end of its handler."""
+    total = max(record['total_ms'], 1e-3)
+    lines = []
+
+    for span, self_time in self_times(record):
+        start = int(span['start_ms'] / total * width)
+        end = max(int(span_end(span, record) / total * width), start + 1)
+        bar = ' ' * start + '█' * (min(end, width) - start)
+        label = '  ' * span['depth'] + span['name']
+        extra = ' '.join(f'{k}={v}' for k, v in span.items() if k not in ('name', 'depth', 'start_ms', 'end_ms'))
+
+        lines.append(f'  {label[:30]:<30} |{bar:<{width}}| {span_end(span, record) - span["start_ms"]:>8.1f} ms '
+                     f'(own {self_time:.1f}) {extra}'.rstrip())
+
+    return lines
+
+
+def print_slowest(records: List[Dict], top: int, waterfalls: int, width: int):
+    slowest = sorted(records, key=lambda r: -r['total_ms'])[:top]
+
+    print(f'\nslowest {len(slowest)} messages')
+
+    for rank, record in enumerate(slowest, 1):
+        attrs = ' '.join(f'{k}={v}' for k, v in record['attrs'].items())
+        counters = ' '.join(f'{k}={v}' for k, v in record['counters'].items())
+        bottleneck = max(self_times(record), key=lambda item: item[1], default=None)
+        slow_stage = f'{bottleneck[0]["name"]} {bottleneck[1]:.0f} ms' if bottleneck else '-'
+
+        print(f'\n#{rank} {record["total_ms"]:.0f} ms  {record["ts"]}  {record["handler"]}  user {record["user_id"]}  '
+              f'chat {record["chat_id"]}  msgs {record["msg_ids"]}')
+        print(f'  bottleneck {slow_stage}  {attrs}  {counters}'.rstrip())
+
+        if rank <= waterfalls:
+            print('\n'.join(waterfall(record, width)))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=[DEFAULT_PATH], help='trace files or directories')
+    parser.add_argument('--handler', help='only messages of this handler: text, media_group or media')
+    parser.add_argument('--since', help='only messages at or after this ISO timestamp (UTC)')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest messages listed')
+    parser.add_argument('--waterfalls', type=int, default=5, help='number of slowest messages drawn as waterfalls')
+    parser.add_argument('--width', type=int, default=60, help='width of the waterfall bars')
+    args = parser.parse_args(argv)
+
+    files = trace_files(args.paths)
+    records, bad = load_traces(files, args.handler, args.since)
+
+    if bad:
+        print(f'{bad} unreadable lines skipped', file=sys.stderr)
+
+    if not records:
+        print(f'No trace records in {", ".join(files) or ", ".join(args.paths)}', file=sys.stderr)
+        return 1
+
+    records.sort(key=lambda r: r['ts'])
+
+    print_summary(records)
+    print_stages(records)
+    print_counters(records)
+    print_slowest(records, args.top, args.waterfalls, args.width)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
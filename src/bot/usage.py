@@ -0,0 +1,143 @@
+import asyncio
+from datetime import date, datetime, timezone
+from typing import Dict, List, Tuple
+from loguru import logger
+from src.config import USAGE_OPTIONS, GPT_POLICY_OPTIONS
+from database.usage_controller import UsageController
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+class UsageLedger:
+    """
+    A singleton ledger of the OpenAI usage of every user.
+
+    The OpenAI requests of the classifier are added to in-memory per-user counters as they are sent, so requests
+    cancelled by the message deadline and the losing requests of hedged pairs are counted too (with their estimated
+    prompt tokens); nothing is written on the request path.
+    `run` adds the accumulated counters to `zib.usage` every `usage_flush_interval_s` in one batched upsert and
+    reloads the day's totals of all bot replicas, which together with the unwritten counters decide whether a
+    user is over the daily token budget. Counters of a failed write are kept for the next one.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._day = _today()
+            # [requests, prompt tokens, completion tokens, cost in USD] per (user, day)
+            cls._instance._pending: Dict[Tuple[int, date], List] = {}
+            cls._instance._flushing: Dict[Tuple[int, date], List] = {}
+            cls._instance._stored: Dict[int, int] = {}
+            cls._instance._lock = asyncio.Lock()
+
+        return cls._instance
+
+    def record(self, user_id: int, usage: Dict[str, List[int]]):
+        """
+        Adds the OpenAI usage of a classification to the user's counters.
+
+        Args:
+            user_id (int): The user whose messages were classified.
+            usage (Dict[str, List[int]]): [requests, prompt tokens, completion tokens] per model, as filled by
+                `GptClassifier.predict`, also when the call was cancelled.
+        """
+        if not USAGE_OPTIONS['enabled'] or not usage:
+            return
+
+        key = (user_id, _today())
+        counters = self._pending.setdefault(key, [0, 0, 0, 0.0])
+
+        for model, (requests, prompt_tokens, completion_tokens) in usage.items():
+            prompt_price, completion_price = self._prices(model)
+
+            counters[0] += requests
+            counters[1] += prompt_tokens
+            counters[2] += completion_tokens
+            counters[3] += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def over_budget(self, user_id: int) -> bool:
+        """
+        Checks whether the user has used up the daily token budget, in which case messages are classified locally.
+
+        Args:
+            user_id (int): The user's identifier.
+        """
+        budget = USAGE_OPTIONS['user_daily_tokens'].get(user_id, USAGE_OPTIONS['daily_tokens'])
+
+        if not USAGE_OPTIONS['enabled'] or budget <= 0:
+            return False
+
+        return self.tokens_today(user_id) >= budget
+
+    def tokens_today(self, user_id: int) -> int:
+        """Returns the tokens used by the user today (UTC) by all replicas, including counters not written yet."""
+        today = _today()
+
+        if today != self._day:
+            # the stored totals are of the previous day until the next flush reloads them
+            self._day, self._stored = today, {}
+
+        key = (user_id, today)
+        tokens = self._stored.get(user_id, 0)
+
+        for counters in (self._pending, self._flushing):
+            usage = counters.get(key)
+
+            if usage is not None:
+                tokens += usage[1] + usage[2]
+
+        return tokens
+
+    async def run(self):
+        """Flushes the counters periodically; runs until cancelled, then flushes what is left."""
+        await self.flush()
+
+        try:
+            while True:
+                await asyncio.sleep(USAGE_OPTIONS['flush_interval_s'])
+                await self.flush()
+        finally:
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        """Adds the accumulated counters to `zib.usage` in one statement and reloads today's totals."""
+        if not USAGE_OPTIONS['enabled']:
+            return
+
+        async with self._lock:
+            self._flushing, self._pending = self._pending, {}
+            rows = [(user_id, day, *usage) for (user_id, day), usage in self._flushing.items() if any(usage)]
+
+            if await asyncio.to_thread(UsageController.add_usage, rows) != 0:
+                logger.warning(f'Failed to write the usage of {len(rows)} users, kept for the next flush')
+
+                for key, usage in self._flushing.items():
+                    pending = self._pending.setdefault(key, [0, 0, 0, 0.0])
+
+                    for i, value in enumerate(usage):
+                        pending[i] += value
+
+                self._flushing = {}
+                return
+
+            day = _today()
+            stored = await asyncio.to_thread(UsageController.get_daily_tokens, day)
+
+            if stored is not None:
+                self._day, self._stored = day, stored
+            else:
+                for (user_id, usage_day), usage in self._flushing.items():
+                    if usage_day == self._day:
+                        self._stored[user_id] = self._stored.get(user_id, 0) + usage[1] + usage[2]
+
+            self._flushing = {}
+
+    @staticmethod
+    def _prices(model: str) -> Tuple[float, float]:
+        prices = USAGE_OPTIONS['prices']
+
+        # models without a configured price are priced as the first model of the cascade
+        return prices.get(model) or prices.get(GPT_POLICY_OPTIONS['cascade'][0][0]) or (0.0, 0.0)
@@ -28,3 +28,261 @@ DB_PARAMS = {
 
 if not all(DB_PARAMS.values()):
     raise RuntimeError('Database parameters environment variables are not set.')
+
+# in-process exact search over hot users' embeddings (see database/vector_cache.py)
+VECTOR_CACHE_OPTIONS = {
+    'enabled': os.getenv('vector_cache_enabled', '1') == '1',
+    'max_bytes': int(os.getenv('vector_cache_max_bytes', 256 * 1024 * 1024)),
+    'max_rows': int(os.getenv('vector_cache_max_rows', 20000))
+}
+
+# sentence embedding model; every stored vector records the version of the model (and projection) that produced it,
+# searches only compare vectors of the current version (see database/reembed.py for rolling a new model)
+EMBEDDER_OPTIONS = {
+    'model_name': os.getenv('emb_model_name', 'cointegrated/rubert-tiny2'),
+    'version': int(os.getenv('emb_model_version', 1)),
+    # thread count, batching and backend tuned for the host by benchmarks/embedder_autotune.py
+    'profile_path': os.getenv('emb_profile_path', '')
+}
+
+# embedding storage: 'vector' (float32) or 'halfvec' (float16, pgvector >= 0.7),
+# optionally reduced with a projection fitted by database/reduce_embeddings.py
+EMB_STORAGE_OPTIONS = {
+    'type': os.getenv('emb_storage_type', 'vector'),
+    'projection_path': os.getenv('emb_projection_path', '')
+}
+
+if EMB_STORAGE_OPTIONS['type'] not in ('vector', 'halfvec'):
+    raise RuntimeError('emb_storage_type must be either "vector" or "halfvec".')
+
+# near-duplicate detection of reposts before classification (see database/dup_index.py)
+DEDUP_OPTIONS = {
+    'enabled': os.getenv('dedup_enabled', '1') == '1',
+    'max_distance': int(os.getenv('dedup_max_distance', 6)),
+    'min_bigrams': int(os.getenv('dedup_min_bigrams', 8)),
+    'max_chats': int(os.getenv('dedup_max_chats', 10000)),
+    'report_every': 1000
+}
+
+# LLM-free classification by topic centroids (see src/models/centroid_classifier.py);
+# only predictions passing all thresholds skip the GPT call
+CENTROID_OPTIONS = {
+    'enabled': os.getenv('centroid_enabled', '1') == '1',
+    'min_similarity': float(os.getenv('centroid_min_similarity', 0.5)),
+    'min_margin': float(os.getenv('centroid_min_margin', 0.1)),
+    'min_count': int(os.getenv('centroid_min_count', 5)),
+    'max_chats': int(os.getenv('centroid_max_chats', 10000))
+}
+
+def _parse_cascade(value: str) -> list:
+    """Parses 'model:timeout_s,model,local' into [(model, timeout_s), ...]; the timeout defaults to 5 s."""
+    steps = []
+
+    for step in value.split(','):
+        model, _, timeout = step.strip().rpartition(':')
+
+        if not model or not timeout.replace('.', '', 1).isdigit():
+            model, timeout = step.strip(), 5
+
+        steps.append((model, float(timeout)))
+
+    return steps
+
+
+# request policy of GptClassifier (see src/models/gpt_classifier.py): every cascade step is a model with its
+# timeout or 'local' (the caller's own prediction, e.g. the nearest centroid); a request still waiting at the
+# observed `hedge_quantile` latency of its model is duplicated and the slower copy is cancelled
+GPT_POLICY_OPTIONS = {
+    'cascade': _parse_cascade(os.getenv('gpt_cascade', f'{GPT_VERSION}:5,local')),
+    'hedge_enabled': os.getenv('gpt_hedge_enabled', '1') == '1',
+    'hedge_quantile': float(os.getenv('gpt_hedge_quantile', 0.9)),
+    'hedge_initial_delay_s': float(os.getenv('gpt_hedge_initial_delay_s', 2)),
+    'hedge_min_samples': 20,
+    'hedge_max_ratio': float(os.getenv('gpt_hedge_max_ratio', 0.1)),
+    'latency_window': 500,
+    'report_every': 1000
+}
+
+# token budget of the message text in classification prompts (see src/models/prompt_builder.py)
+PROMPT_OPTIONS = {
+    'max_msg_tokens': int(os.getenv('prompt_max_msg_tokens', 256))
+}
+
+# optional read replica; read-only lookups are routed to it while its replay lag is acceptable
+DB_REPLICA_PARAMS = {
+    'host': os.getenv('db_replica_host'),
+    'database': os.getenv('db_replica_name', os.getenv('db_name')),
+    'port': int(os.getenv('db_replica_port', os.getenv('db_port'))),
+    'user': os.getenv('db_replica_user', os.getenv('db_user')),
+    'password': os.getenv('db_replica_pwd', os.getenv('db_pwd'))
+} if os.getenv('db_replica_host') else None
+
+DB_ROUTING_OPTIONS = {
+    'max_replica_lag_s': float(os.getenv('db_max_replica_lag_s', 5)),
+    'lag_check_interval_s': float(os.getenv('db_lag_check_interval_s', 1)),
+    # reads of a user who has just written go to the primary for this long
+    'sticky_s': float(os.getenv('db_sticky_s', 10))
+}
+
+# rows fetched per round trip by server-side cursors scanning full histories (see PgConnector.stream_data)
+DB_STREAM_OPTIONS = {
+    'itersize': int(os.getenv('db_stream_itersize', 2000))
+}
+
+# re-sorting of 'unknown' messages into a topic after /add_topic and /edit_topic: messages at least
+# `accept_similarity` close to the topic name move directly, those above `min_similarity` are checked by GPT
+REROUTE_OPTIONS = {
+    'enabled': os.getenv('reroute_enabled', '1') == '1',
+    'accept_similarity': float(os.getenv('reroute_accept_similarity', 0.6)),
+    'min_similarity': float(os.getenv('reroute_min_similarity', 0.35)),
+    'max_messages': int(os.getenv('reroute_max_messages', 5000)),
+    'max_gpt': int(os.getenv('reroute_max_gpt', 100)),
+    'gpt_batch': 20,
+    # Bot API limit of forwardMessages/deleteMessages
+    'tg_batch': 100
+}
+
+# admission of pipeline jobs (see src/bot/scheduler.py): per-user deficit round robin for incoming messages,
+# priority for interactive commands and concurrency limits per external resource
+SCHEDULER_OPTIONS = {
+    'max_in_flight': int(os.getenv('scheduler_max_in_flight', 16)),
+    'interactive_reserve': int(os.getenv('scheduler_interactive_reserve', 8)),
+    'quantum': 1,
+    'max_user_queue': int(os.getenv('scheduler_max_user_queue', 500)),
+    'max_queue': int(os.getenv('scheduler_max_queue', 10000)),
+    'notice_interval_s': 60,
+    'resources': {
+        'openai': int(os.getenv('scheduler_openai_limit', 16)),
+        'embedder': int(os.getenv('scheduler_embedder_limit', 2)),
+        'telegram': int(os.getenv('scheduler_telegram_limit', 8))
+    }
+}
+
+# time budget of a message from admission to sorted (see src/bot/deadline.py): enrichment is skipped and an
+# ambiguous local prediction or 'unknown' is used instead of GPT when too little of the budget is left
+DEADLINE_OPTIONS = {
+    'budget_s': float(os.getenv('msg_deadline_s', 20)),
+    'enrich_min_s': float(os.getenv('msg_deadline_enrich_min_s', 4)),
+    'enrich_max_s': float(os.getenv('msg_deadline_enrich_max_s', 8)),
+    'classify_min_s': float(os.getenv('msg_deadline_classify_min_s', 1.5)),
+    'move_reserve_s': float(os.getenv('msg_deadline_move_reserve_s', 3)),
+    # the Telegram calls of the move aren't cancelled by the budget, only bounded by this timeout
+    'move_call_timeout_s': float(os.getenv('msg_deadline_move_call_timeout_s', 10)),
+    'report_every': 100
+}
+
+# extracted text and embeddings of links shared by all users and bot replicas in zib.url_content
+# (see src/utils/url_store.py): stale entries are served while they are refreshed in the background
+URL_CONTENT_OPTIONS = {
+    'enabled': os.getenv('url_cache_enabled', '1') == '1',
+    'ttl_s': float(os.getenv('url_cache_ttl_s', 24 * 3600)),
+    'fetch_timeout_s': float(os.getenv('url_cache_fetch_timeout_s', 10)),
+    'lease_s': float(os.getenv('url_cache_lease_s', 30)),
+    # fetches wait on the network, so they get their own pool rather than the default executor's cpu_count + 4 threads
+    'fetch_threads': int(os.getenv('url_fetch_threads', 32)),
+    'poll_s': 0.25,
+    'text_limit': 2000
+}
+
+# links of a message fetched concurrently and merged with the user's own text into a bounded classification input
+ENRICH_OPTIONS = {
+    'max_links': int(os.getenv('enrich_max_links', 5)),
+    'max_chars': int(os.getenv('enrich_max_chars', 2000))
+}
+
+def _parse_pairs(value: str) -> dict:
+    """Parses 'key:value,key:value' into a dict; the value may itself contain colons."""
+    pairs = {}
+
+    for pair in value.split(','):
+        key, _, item = pair.strip().partition(':')
+
+        if key and item:
+            pairs[key] = item
+
+    return pairs
+
+
+# text of documents (PDF, txt, md, docx) extracted by sandboxed worker processes (see src/utils/document_sandbox.py)
+# and classified together with the caption; every job is limited in CPU time, memory and wall time
+DOCUMENT_OPTIONS = {
+    'enabled': os.getenv('doc_enabled', '1') == '1',
+    'max_bytes': int(os.getenv('doc_max_bytes', 10 * 1024 * 1024)),
+    'workers': int(os.getenv('doc_workers', 2)),
+    'cpu_s': int(os.getenv('doc_cpu_s', 5)),
+    'memory_mb': int(os.getenv('doc_memory_mb', 512)),
+    'timeout_s': float(os.getenv('doc_timeout_s', 10)),
+    'max_pages': 20,
+    'text_limit': 2000
+}
+
+# /search results are sent as one message paged with an inline keyboard (see src/bot/search.py); the ranked ids
+# of a search are kept in memory under the token of its buttons, so turning a page embeds and searches nothing,
+# while repeating the search ranks again; pages are kept within Telegram's 4096 characters
+SEARCH_OPTIONS = {
+    'default_top_k': int(os.getenv('search_default_top_k', 10)),
+    'max_top_k': int(os.getenv('search_max_top_k', 50)),
+    'page_size': int(os.getenv('search_page_size', 5)),
+    'cache_ttl_s': float(os.getenv('search_cache_ttl_s', 600)),
+    'cache_size': 1000,
+    'snippet_chars': 200,
+    'pattern_chars': 100,
+    'max_text_chars': 4096
+}
+
+# per-user OpenAI usage accumulated in memory and added to zib.usage in batches (see src/bot/usage.py);
+# a user over the daily token budget is classified locally until the next day (UTC), 0 disables the budget
+USAGE_OPTIONS = {
+    'enabled': os.getenv('usage_enabled', '1') == '1',
+    'flush_interval_s': float(os.getenv('usage_flush_interval_s', 30)),
+    'daily_tokens': int(os.getenv('usage_daily_tokens', 0)),
+    'user_daily_tokens': {int(user_id): int(tokens) for user_id, tokens in _parse_pairs(os.getenv('usage_user_daily_tokens', '')).items()},
+    # USD per 1000 prompt and completion tokens
+    'prices': {
+        model: tuple(float(price) for price in prices.split(':'))
+        for model, prices in _parse_pairs(os.getenv('usage_prices', f'{GPT_VERSION}:0.0005:0.0015')).items()
+    }
+}
+
+# on-demand profiling (see src/bot/profiling.py): a sampling profiler started by /profile or SIGUSR1,
+# cProfile captures of the slowest handler calls and a detector of callbacks blocking the event loop
+PROFILING_OPTIONS = {
+    'admin_ids': {int(user_id) for user_id in os.getenv('admin_ids', '').split(',') if user_id.strip()},
+    'output_dir': os.getenv('profile_dir', 'profiles'),
+    'sample_interval_ms': float(os.getenv('profile_sample_interval_ms', 10)),
+    'default_seconds': int(os.getenv('profile_default_seconds', 30)),
+    'max_seconds': 600,
+    'handlers_enabled': os.getenv('profile_handlers', '0') == '1',
+    'handler_rate': float(os.getenv('profile_handler_rate', 0.1)),
+    'handler_threshold_ms': float(os.getenv('profile_handler_threshold_ms', 2000)),
+    'handler_keep': int(os.getenv('profile_handler_keep', 10)),
+    'loop_watchdog': os.getenv('loop_watchdog', '1') == '1',
+    'loop_threshold_ms': float(os.getenv('loop_threshold_ms', 200))
+}
+
+# opt-in per-message traces (see src/utils/tracing.py): stage spans, cache hits, retries, tokens and the outcome of a
+# `trace_rate` share of messages, appended as JSON lines to a rotating file by a background thread;
+# `python -m src.bot.trace_report` prints latency waterfalls, per-stage percentiles and the slowest messages
+TRACE_OPTIONS = {
+    'enabled': os.getenv('trace_enabled', '0') == '1',
+    'rate': float(os.getenv('trace_rate', 1.0)),
+    'path': os.getenv('trace_path', 'traces/messages.jsonl'),
+    'max_bytes': int(os.getenv('trace_max_mb', 50)) * 1024 * 1024,
+    'backups': int(os.getenv('trace_backups', 5)),
+    'queue_size': 10000
+}
+
+# albums are collected by src/bot/media_group.py until they have `max_parts` parts, a later message of the chat
+# arrives, or no part arrived for a wait adapted to the observed gaps between parts (`gap_quantile` times
+# `gap_factor`, within `min_wait_s`..`max_wait_s`; `initial_wait_s` until `min_samples` gaps are observed)
+MEDIA_GROUP_OPTIONS = {
+    'max_parts': 10,
+    'initial_wait_s': float(os.getenv('media_group_initial_wait_s', 0.5)),
+    'min_wait_s': float(os.getenv('media_group_min_wait_s', 0.1)),
+    'max_wait_s': float(os.getenv('media_group_max_wait_s', 1.0)),
+    'gap_quantile': float(os.getenv('media_group_gap_quantile', 0.99)),
+    'gap_factor': float(os.getenv('media_group_gap_factor', 2.0)),
+    'min_samples': 20,
+    'window': 500,
+    'closed_size': 1000
+}
@@ -0,0 +1,365 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from loguru import logger
+from src.config import CENTROID_OPTIONS
+from database.centroid_controller import CentroidController
+
+
+class ChatCentroids:
+    """
+    Running mean embeddings of the topics of a single (user, chat) pair.
+
+    Attributes:
+        topic_ids (List[int]): Topic identifiers, aligned with the matrix rows.
+        means (np.ndarray): (k, dim) float32 matrix of topic mean embeddings.
+        counts (np.ndarray): Number of messages averaged into every mean; 0 for topics seeded from their name.
+        normed (np.ndarray): L2-normalised copy of `means` used for classification.
+    """
+    def __init__(self, dim: int):
+        self.topic_ids: List[int] = []
+        self.means = np.empty((0, dim), dtype=np.float32)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.normed = np.empty((0, dim), dtype=np.float32)
+
+    def set(self, topic_id: int, msg_count: int, centroid: np.ndarray):
+        """
+        Inserts or replaces the centroid of a topic.
+
+        Args:
+            topic_id (int): The topic's identifier.
+            msg_count (int): The number of messages averaged into the centroid.
+            centroid (np.ndarray): The mean embedding of the topic.
+        """
+        if topic_id in self.topic_ids:
+            row = self.topic_ids.index(topic_id)
+        else:
+            row = len(self.topic_ids)
+            self.topic_ids.append(topic_id)
+            self.means = np.vstack([self.means, np.zeros((1, self.means.shape[1]), dtype=np.float32)])
+            self.normed = np.vstack([self.normed, np.zeros((1, self.normed.shape[1]), dtype=np.float32)])
+            self.counts = np.append(self.counts, 0)
+
+        self.means[row] = centroid
+        self.counts[row] = msg_count
+        self._renorm(row)
+
+    def add(self, topic_id: int, msg_emb: np.ndarray) -> Optional[Tuple[int, np.ndarray]]:
+        """
+        Folds a message embedding into the running mean of its topic in O(dim).
+
+        Args:
+            topic_id (int): The topic's identifier.
+            msg_emb (np.ndarray): The message embedding.
+
+        Returns:
+            Optional[Tuple[int, np.ndarray]]: The updated (count, mean), or None if the topic is unknown.
+        """
+        if topic_id not in self.topic_ids:
+            return None
+
+        row = self.topic_ids.index(topic_id)
+        self.counts[row] += 1
+        self.means[row] += (msg_emb - self.means[row]) / self.counts[row]
+        self._renorm(row)
+
+        return int(self.counts[row]), self.means[row]
+
+    def subtract(self, topic_id: int, msg_emb: np.ndarray) -> Optional[Tuple[int, np.ndarray]]:
+        """
+        Takes a message embedding out of the running mean of its topic in O(dim); the mean of a topic left without
+        messages is kept.
+
+        Args:
+            topic_id (int): The topic's identifier.
+            msg_emb (np.ndarray): The message embedding.
+
+        Returns:
+            Optional[Tuple[int, np.ndarray]]: The updated (count, mean), or None if the topic is unknown.
+        """
+        if topic_id not in self.topic_ids:
+            return None
+
+        row = self.topic_ids.index(topic_id)
+
+        if self.counts[row] > 1:
+            self.means[row] += (self.means[row] - msg_emb) / (self.counts[row] - 1)
+            self._renorm(row)
+
+        self.counts[row] = max(self.counts[row] - 1, 0)
+
+        return int(self.counts[row]), self.means[row]
+
+    def remove(self, topic_id: int):
+        """
+        Removes the centroid of a topic.
+
+        Args:
+            topic_id (int): The topic's identifier.
+        """
+        if topic_id not in self.topic_ids:
+            return
+
+        row = self.topic_ids.index(topic_id)
+        del self.topic_ids[row]
+        self.means = np.delete(self.means, row, axis=0)
+        self.normed = np.delete(self.normed, row, axis=0)
+        self.counts = np.delete(self.counts, row)
+
+    def count(self, topic_id: int) -> int:
+        """Returns the number of messages averaged into the topic's centroid, -1 if the topic is unknown."""
+        if topic_id not in self.topic_ids:
+            return -1
+
+        return int(self.counts[self.topic_ids.index(topic_id)])
+
+    def _renorm(self, row: int):
+        norm = np.linalg.norm(self.means[row])
+        self.normed[row] = self.means[row] / norm if norm > 0 else self.means[row]
+
+
+class CentroidClassifier:
+    """
+    A singleton LLM-free classifier that assigns a message to the topic with the most similar mean embedding,
+    in the spirit of Semantic Router. Centroids are kept per (user, chat) in memory and in `zib.topic_centroids`,
+    updated on every saved message and seeded from the embedded topic name for topics without messages.
+    Only predictions with enough similarity and margin over the runner-up are considered confident.
+
+    Attributes:
+        min_similarity (float): Minimum cosine similarity to the best centroid.
+        min_margin (float): Minimum difference between the best and the second best similarity.
+        min_count (int): Minimum number of messages in the best topic.
+        max_chats (int): The maximum number of chats kept in memory.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.min_similarity = CENTROID_OPTIONS['min_similarity']
+            cls._instance.min_margin = CENTROID_OPTIONS['min_margin']
+            cls._instance.min_count = CENTROID_OPTIONS['min_count']
+            cls._instance.max_chats = CENTROID_OPTIONS['max_chats']
+            cls._instance._chats: 'OrderedDict[Tuple[int, int], ChatCentroids]' = OrderedDict()
+            cls._instance._lock = threading.Lock()
+
+        return cls._instance
+
+    def predict(self, user_id: int, chat_id: int, msg_emb: np.ndarray, topics: Dict[str, int],
+                embed: Callable[[str], np.ndarray]) -> Dict:
+        """
+        Classifies a message against the centroids of the chat's topics.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            msg_emb (np.ndarray): The message embedding in storage space.
+            topics (Dict[str, int]): A dictionary mapping topic names to topic IDs.
+            embed (Callable[[str], np.ndarray]): Embeds a topic name into storage space, used to seed cold topics.
+
+        Returns:
+            Dict: {"msg_class": str or None, "similarity": float, "margin": float, "confident": bool}
+        """
+        result = {'msg_class': None, 'similarity': 0.0, 'margin': 0.0, 'confident': False}
+
+        # 'unknown' collects unrelated messages, its mean is not a meaningful class prototype
+        candidates = {name: topic_id for name, topic_id in topics.items() if name != 'unknown'}
+
+        if not candidates:
+            return result
+
+        chat = self._get(user_id, chat_id, candidates, embed, len(msg_emb))
+
+        if chat is None:
+            return result
+
+        names = {topic_id: name for name, topic_id in candidates.items()}
+        rows = [i for i, topic_id in enumerate(chat.topic_ids) if topic_id in names]
+
+        if not rows:
+            return result
+
+        norm = np.linalg.norm(msg_emb)
+        query = msg_emb / norm if norm > 0 else msg_emb
+        scores = chat.normed[rows] @ query
+
+        order = np.argsort(-scores)
+        best = rows[order[0]]
+        similarity = float(scores[order[0]])
+        margin = similarity - float(scores[order[1]]) if len(order) > 1 else similarity
+
+        result.update(
+            msg_class=names[chat.topic_ids[best]],
+            similarity=similarity,
+            margin=margin,
+            confident=bool(similarity >= self.min_similarity and margin >= self.min_margin and chat.counts[best] >= self.min_count)
+        )
+
+        return result
+
+    def add(self, user_id: int, chat_id: int, topic_id: int, msg_emb: np.ndarray):
+        """
+        Folds a saved message into its topic centroid if the chat is loaded and persists the result.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+            msg_emb (np.ndarray): The message embedding in storage space.
+        """
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is None or len(msg_emb) != chat.means.shape[1]:
+                return
+
+            updated = chat.add(topic_id, np.asarray(msg_emb, dtype=np.float32))
+
+        if updated is not None:
+            CentroidController.save_centroid(user_id, chat_id, topic_id, updated[0], updated[1])
+
+    def add_many(self, user_id: int, chat_id: int, topic_id: int, msg_embs: np.ndarray):
+        """
+        Folds a batch of messages moved into a topic into its centroid and persists the result once.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+            msg_embs (np.ndarray): (n, dim) message embeddings in storage space.
+        """
+        updated = None
+
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is None or msg_embs.shape[1] != chat.means.shape[1]:
+                return
+
+            for msg_emb in np.asarray(msg_embs, dtype=np.float32):
+                updated = chat.add(topic_id, msg_emb)
+
+                if updated is None:
+                    return
+
+        if updated is not None:
+            CentroidController.save_centroid(user_id, chat_id, topic_id, updated[0], updated[1])
+
+    def remove_many(self, user_id: int, chat_id: int, topic_id: int, msg_embs: np.ndarray):
+        """
+        Takes a batch of messages moved out of a topic out of its centroid and persists the result once.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+            msg_embs (np.ndarray): (n, dim) message embeddings in storage space.
+        """
+        updated = None
+
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is None or msg_embs.shape[1] != chat.means.shape[1]:
+                return
+
+            for msg_emb in np.asarray(msg_embs, dtype=np.float32):
+                updated = chat.subtract(topic_id, msg_emb)
+
+                if updated is None:
+                    return
+
+        if updated is not None:
+            CentroidController.save_centroid(user_id, chat_id, topic_id, updated[0], updated[1])
+
+    def reset_topic(self, user_id: int, chat_id: int, topic_id: int):
+        """
+        Drops a topic centroid that has no messages yet, so that it is seeded again from the new topic name.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+        """
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is not None and chat.count(topic_id) > 0:
+                return
+
+            if chat is not None:
+                chat.remove(topic_id)
+
+        CentroidController.del_centroid(user_id, chat_id, topic_id)
+
+    def remove_topic(self, user_id: int, chat_id: int, topic_id: int):
+        """
+        Removes a deleted topic from the in-memory centroids. The stored row is removed with the topic.
+
+        Args:
+            user_id (int): The user's identifier.
+            chat_id (int): The chat's identifier.
+            topic_id (int): The topic's identifier.
+        """
+        with self._lock:
+            chat = self._chats.get((user_id, chat_id))
+
+            if chat is not None:
+                chat.remove(topic_id)
+
+    def _get(self, user_id: int, chat_id: int, topics: Dict[str, int], embed: Callable[[str], np.ndarray],
+             dim: int) -> Optional[ChatCentroids]:
+        key = (user_id, chat_id)
+
+        with self._lock:
+            chat = self._chats.get(key)
+
+            if chat is not None:
+                self._chats.move_to_end(key)
+
+        if chat is None:
+            chat = self._load(user_id, chat_id, dim)
+
+            if chat is None:
+                return None
+
+        for name, topic_id in topics.items():
+            if chat.count(topic_id) < 0:
+                seed = np.asarray(embed(name), dtype=np.float32)
+
+                with self._lock:
+                    chat.set(topic_id, 0, seed)
+
+                CentroidController.save_centroid(user_id, chat_id, topic_id, 0, seed)
+
+        return chat
+
+    def _load(self, user_id: int, chat_id: int, dim: int) -> Optional[ChatCentroids]:
+        centroids = CentroidController.get_centroids(user_id, chat_id)
+
+        if centroids is None:
+            return None
+
+        if not centroids:
+            # chats created before centroids were maintained are bootstrapped from their messages
+            centroids = CentroidController.compute_centroids(user_id, chat_id) or {}
+
+            for topic_id, (msg_count, centroid) in centroids.items():
+                CentroidController.save_centroid(user_id, chat_id, topic_id, msg_count, centroid)
+
+            logger.info(f'Built {len(centroids)} topic centroids for user {user_id} chat {chat_id}')
+
+        chat = ChatCentroids(dim)
+
+        for topic_id, (msg_count, centroid) in centroids.items():
+            if len(centroid) == dim:
+                chat.set(topic_id, msg_count, centroid)
+
+        with self._lock:
+            self._chats[(user_id, chat_id)] = chat
+
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+
+        return chat
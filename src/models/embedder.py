@@ -1,5 +1,19 @@
+import json
+from typing import Dict, List
+import numpy as np
+from loguru import logger
 from sentence_transformers import SentenceTransformer
 import torch
+from src.config import EMBEDDER_OPTIONS
+from database.msg_data import MsgBatch
+
+# runtime settings of a TextEmbedder; a profile written by benchmarks/embedder_autotune.py overrides them
+DEFAULT_PROFILE = {
+    'num_threads': 0,           # torch intra-op threads, 0 keeps the torch default
+    'batch_size': 64,           # texts per model call
+    'max_batch_tokens': 0,      # padded tokens per model call for length-bucketed batching, 0 disables bucketing
+    'backend': 'torch'          # 'torch' (float32) or 'int8' (dynamically quantized linear layers, CPU only)
+}
 
 
 class TextEmbedder:
@@ -9,16 +23,20 @@ class TextEmbedder:
     Attributes:
         model_name (str): The name of the model to be loaded.
         use_gpu (bool): Flag indicating whether to use GPU if available.
+        profile (Dict): Runtime settings, see DEFAULT_PROFILE.
         model (SentenceTransformer): The loaded SentenceTransformer model instance.
     """
 
-    def __init__(self, model_name: str = 'cointegrated/rubert-tiny2', use_gpu: bool = False):
+    def __init__(self, model_name: str = 'cointegrated/rubert-tiny2', use_gpu: bool = False,
+                 profile_path: str = EMBEDDER_OPTIONS['profile_path']):
         """
         Initializes a SentenceTransformer model.
 
         Parameters:
             model_name (str): The name of the model to be loaded. Defaults to 'cointegrated/rubert-tiny2'.
             use_gpu (bool): Flag indicating whether to use GPU if available. Defaults to False.
+            profile_path (str): Profile written by benchmarks/embedder_autotune.py; empty for the defaults.
+                Defaults to `emb_profile_path`.
 
         Raises:
             ValueError: If the provided model name is empty.
@@ -26,8 +44,38 @@ class TextEmbedder:
         """
         self.model_name = model_name
         self.use_gpu = use_gpu
+        self.profile = self.load_profile(profile_path, model_name)
         self.model = self.init_model()
 
+    @staticmethod
+    def load_profile(path: str, model_name: str) -> Dict:
+        """
+        Loads runtime settings tuned for this host. Profiles of another model are ignored.
+
+        Args:
+            path (str): Path to the JSON profile; empty for the defaults.
+            model_name (str): The model the profile must have been tuned for.
+
+        Returns:
+            Dict: The settings, defaults filled in.
+        """
+        profile = dict(DEFAULT_PROFILE)
+
+        if not path:
+            return profile
+
+        with open(path, 'r', encoding='utf-8') as f:
+            tuned = json.load(f)
+
+        if tuned.get('model_name') != model_name:
+            logger.warning(f"Embedder profile {path} was tuned for '{tuned.get('model_name')}', not '{model_name}'; using defaults")
+            return profile
+
+        profile.update({key: tuned[key] for key in DEFAULT_PROFILE if key in tuned})
+        logger.info(f'Loaded embedder profile from {path}: {profile}')
+
+        return profile
+
     def init_model(self):
         """
         Loads the SentenceTransformer model and assigns it to a device based on the availability of CUDA and the user's preference for using GPU.
@@ -38,10 +86,106 @@ class TextEmbedder:
         if self.model_name.strip() == '':
             raise ValueError('Model name cannot be empty.')
 
+        if self.profile['backend'] not in ('torch', 'int8'):
+            raise ValueError(f"Unknown embedder backend '{self.profile['backend']}'.")
+
         try:
             device = "cuda" if torch.cuda.is_available() and self.use_gpu else "cpu"
             model = SentenceTransformer(self.model_name, device=device)
         except Exception as e:
             raise RuntimeError(f"Failed to load the model '{self.model_name}' on the specified device '{device}'. Error: {e}")
 
+        # the thread count is process-wide
+        if self.profile['num_threads'] > 0:
+            torch.set_num_threads(self.profile['num_threads'])
+
+        if self.profile['backend'] == 'int8' and device == 'cpu':
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
         return model
+
+    def encode(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """
+        Embeds a list of texts into one contiguous matrix.
+
+        With `max_batch_tokens` set, texts are sorted by token length and grouped into batches whose padded size
+        fits the token budget, so short texts are embedded in large batches and long texts don't pad short ones.
+
+        Args:
+            texts (List[str]): The texts to embed.
+            batch_size (int): Batch size of the model; the profile's if not given. With bucketing, the batch
+                size is derived from the token budget instead.
+
+        Returns:
+            np.ndarray: (n, dim) float32 embeddings.
+        """
+        max_batch_tokens = self.profile['max_batch_tokens']
+
+        if max_batch_tokens <= 0 or len(texts) <= 1:
+            embs = self.model.encode(texts, batch_size=batch_size or self.profile['batch_size'], convert_to_numpy=True)
+            return np.ascontiguousarray(embs, dtype=np.float32)
+
+        embs = None
+
+        for rows in self.length_buckets(texts, max_batch_tokens):
+            batch_embs = self.model.encode([texts[i] for i in rows], batch_size=len(rows), convert_to_numpy=True)
+
+            if embs is None:
+                embs = np.empty((len(texts), batch_embs.shape[1]), dtype=np.float32)
+
+            embs[rows] = batch_embs
+
+        return embs
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        """
+        Counts the tokens of every text as the model sees them, truncated to its maximum sequence length.
+
+        Args:
+            texts (List[str]): The texts.
+
+        Returns:
+            np.ndarray: int64 token counts.
+        """
+        encoded = self.model.tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)
+
+        return np.array([len(ids) for ids in encoded['input_ids']], dtype=np.int64)
+
+    def length_buckets(self, texts: List[str], max_batch_tokens: int) -> List[np.ndarray]:
+        """
+        Splits texts into batches of similar length whose padded size stays within a token budget.
+
+        Args:
+            texts (List[str]): The texts.
+            max_batch_tokens (int): Maximum number of rows times the longest row of a batch.
+
+        Returns:
+            List[np.ndarray]: Row indices of every batch.
+        """
+        lengths = self.token_lengths(texts)
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        start = 0
+
+        # rows are sorted by length, so the last row of a batch is its longest
+        for end in range(1, len(order) + 1):
+            if end == len(order) or (end + 1 - start) * lengths[order[end]] > max_batch_tokens:
+                batches.append(order[start:end])
+                start = end
+
+        return batches
+
+    def encode_batch(self, batch: MsgBatch, batch_size: int = None) -> MsgBatch:
+        """
+        Embeds the texts of a message batch and stores the matrix in `batch.msg_embs`.
+
+        Args:
+            batch (MsgBatch): The messages to embed.
+            batch_size (int): Batch size of the model; the profile's if not given.
+
+        Returns:
+            MsgBatch: The same batch with embeddings set.
+        """
+        batch.msg_embs = self.encode(batch.msg_texts, batch_size)
+
+        return batch
@@ -1,33 +1,49 @@
-from typing import List, Dict
+from collections import Counter, deque
+from typing import List, Dict, Optional, Tuple, Union
 import asyncio
 import time
+import numpy as np
 import yaml
 from loguru import logger
 from openai import AsyncOpenAI, OpenAIError
-from src.config import GPT_VERSION, OPENAI_API_KEY, OPENAI_OPTIONS
-from database.msg_controller import MsgData
+from src.config import GPT_VERSION, OPENAI_API_KEY, OPENAI_OPTIONS, PROMPT_OPTIONS, GPT_POLICY_OPTIONS
+from src.models.prompt_builder import PromptBuilder
+from src.utils.tracing import trace_span, trace_add
+from database.msg_data import MsgData, MsgBatch
 
 
 class GptClassifier:
     """A class for categorizing messages using the OpenAI GPT model.
 
+    Requests follow the cascade of `gpt_cascade`: every model is tried with its own timeout, and the 'local' step
+    accepts the caller's local prediction, before the message is given up. A request still waiting at the observed
+    `hedge_quantile` latency of its model is hedged with a duplicate, the first response wins and the other request
+    is cancelled; hedges are limited to `hedge_max_ratio` of all requests.
+
     Attributes:
         client: An instance of AsyncOpenAI for interacting with the OpenAI API.
-        timelimit: An integer representing the maximum time limit for API calls.
+        timelimit: The timeout of the first cascade step in seconds.
+        cascade: A list of (model, timeout in seconds) steps, 'local' for the caller's prediction.
         msg_classes: A dictionary mapping message classes to their respective prompts.
         prompt_template: A string template for generating prompts.
+        prompt_builder: A PromptBuilder rendering the template within the token budget.
+        counters: Counters of requests, hedges, cascade steps and failures, shared by copies of the classifier.
     """
     def __init__(self, msg_classes: List[str]):
         """Initialize the GptClassifier."""
         try:
             self.client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-            self.timelimit: int = 5
+            self.cascade: List[Tuple[str, float]] = GPT_POLICY_OPTIONS['cascade']
+            self.timelimit: float = self.cascade[0][1]
 
             with open('prompts.yml', 'r', encoding='utf-8') as f:
                 prompt_config = yaml.safe_load(f)
 
             self.msg_classes = msg_classes
             self.prompt_template = prompt_config['msg_classification_prompt']
+            self.prompt_builder = PromptBuilder(self.prompt_template, PROMPT_OPTIONS['max_msg_tokens'], GPT_VERSION)
+            self.counters: Counter = Counter()
+            self._latencies: Dict[str, deque] = {}
         except FileNotFoundError as e:
             print(f'Config file not found: {e}')
             raise
@@ -44,135 +60,295 @@ class GptClassifier:
             print(f'An unexpected error occurred: {e}')
             raise
 
-    async def predict(self, messages: List[MsgData]) -> List[Dict]:
+    async def predict(self, messages: Union[List[MsgData], MsgBatch],
+                      local_classes: Optional[List[Optional[str]]] = None,
+                      usage: Optional[Dict[str, List[int]]] = None) -> Union[List[Dict], MsgBatch]:
         """Predict the class of input messages.
 
         Args:
-            messages: A list of objects(MsgData) representing messages to classify.
+            messages: A list of objects(MsgData) or a MsgBatch representing messages to classify.
+            local_classes: Optional local predictions per message, used by the 'local' cascade step.
+            usage: Optional [requests, prompt tokens, completion tokens] per model, updated as requests are sent:
+                every request, hedged duplicates and requests cancelled by a timeout or by the caller included,
+                is charged its estimated prompt tokens, replaced by the reported usage once it responds. It is
+                complete even if the call is cancelled.
 
         Returns:
-            A list of dictionaries for every message of the following structure:
+            For a MsgBatch, the same batch with `categories` set (None where the message couldn't be classified).
+            Otherwise a list of dictionaries for every message of the following structure:
             {
                 "message": MsgData,
                 "msg_class": str or None,   # Predicted message class or None if not classified
                 "process_status": str,      # Process status, including any errors or warnings.
+                "model": str or None,       # The cascade step that produced the class
+                "hedged": bool,             # Whether the class came from a hedged duplicate request
+                "requests": int,            # Number of cascade steps sent to OpenAI
                 "prompt_tokens": int,       # Number of tokens used in the prompt
                 "completion_tokens": int,   # Number of tokens in the completion
                 "time_spent": float         # Time spent processing the message in seconds
             }
         """
+        local_classes = local_classes or [None] * len(messages)
+
+        if isinstance(messages, MsgBatch):
+            results = await asyncio.gather(*[
+                self._predict_text(text, local_class, usage) for text, local_class in zip(messages.msg_texts, local_classes)
+            ])
+            messages.categories = [result['msg_class'] for result in results]
+            return messages
+
         if not messages:
             return []
 
         # create task for each message
-        tasks = [self._predict_message(msg) for msg in messages]
+        tasks = [self._predict_message(msg, local_class, usage) for msg, local_class in zip(messages, local_classes)]
 
         # run all tasks concurrently
         results = await asyncio.gather(*tasks)
 
         return results
 
-    def _create_prompt(self, message: str) -> str:
+    def stats(self) -> Dict:
+        """Returns the counters and the current hedge delay of every model."""
+        return {**self.counters, **{f'hedge_delay_s:{model}': self._hedge_delay(model) for model in self._latencies}}
+
+    def _create_prompt(self, message: str) -> Tuple[str, int]:
         """Create a prompt for the given message.
 
         Args:
             message: A string representing the input message.
 
         Returns:
-            A string representing the prompt.
+            A tuple of the prompt and its number of tokens.
         """
-        prompt = self.prompt_template.format(
-            msg_classes = self.msg_classes,
-            msg_text = message
-        )
+        return self.prompt_builder.build(self.msg_classes, message)
 
-        return prompt
-
-    async def _predict_message(self, message: MsgData) -> Dict:
+    async def _predict_message(self, message: MsgData, local_class: Optional[str] = None,
+                               usage: Optional[Dict[str, List[int]]] = None) -> Dict:
         """Predict the class of a single message.
 
         Args:
-            message: A string representing the input message.
+            message: A MsgData object representing the input message.
+            local_class: The local prediction used by the 'local' cascade step.
+            usage: Optional usage per model updated as requests are sent, see `predict`.
 
         Returns:
             A dictionary containing the message, predicted class, process status,
             prompt tokens, completion tokens, and time spent for the message.
         """
+        with trace_span('gpt') as span:
+            result = await self._predict_text(message.msg_text, local_class, usage)
+
+            # the cascade steps after the first one are retries with another model
+            if span is not None:
+                span.update(model=result['model'], hedged=result['hedged'], requests=result['requests'],
+                            ok=result['msg_class'] is not None)
+                trace_add('gpt_requests', result['requests'])
+                trace_add('gpt_retries', max(result['requests'] - 1, 0))
+                trace_add('gpt_hedged', int(result['hedged']))
+                trace_add('prompt_tokens', result['prompt_tokens'])
+                trace_add('completion_tokens', result['completion_tokens'])
+
+        return {'message': message, **result}
+
+    async def _predict_text(self, msg_text: str, local_class: Optional[str] = None,
+                            usage: Optional[Dict[str, List[int]]] = None) -> Dict:
+        """Predict the class of a single message text, going through the cascade until a step succeeds.
+
+        Args:
+            msg_text: A string representing the input message.
+            local_class: The local prediction used by the 'local' cascade step.
+            usage: Optional usage per model updated as requests are sent, see `predict`.
+
+        Returns:
+            A dictionary containing the predicted class, process status, the step that produced it,
+            the number of requests, prompt tokens, completion tokens, and time spent for the message.
+        """
         # record the start time
         start_time = time.time()
-        time_spent = None
 
         # initialize response variables
         pred_msg_class = None
         process_status = "ok"
         prompt_tokens = 0
         completion_tokens = 0
+        used_model = None
+        hedged = False
+        requests = 0
 
-        # crop long message
-        text = message.msg_text[:1024]
+        # long messages are cropped to the token budget by the prompt builder
+        prompt, prompt_tokens_estimate = self._create_prompt(msg_text)
 
-        prompt = self._create_prompt(text)
+        for step, (model, timeout) in enumerate(self.cascade):
+            if step > 0:
+                self.counters[f'cascade:{model}'] += 1
 
-        try:
-            logger.debug('The request has been sent to the OpenAPI')
+            if model == 'local':
+                if local_class is not None and local_class in self.msg_classes:
+                    pred_msg_class, used_model, process_status = local_class, model, 'ok'
+                    break
 
-            # call the _api_call method with a timeout
-            response = await asyncio.wait_for(
-                self._api_call(prompt), timeout=self.timelimit
-            )
+                continue
+
+            requests += 1
+
+            try:
+                logger.debug(f'The request has been sent to {model}, prompt tokens: {prompt_tokens_estimate}')
+
+                # hedged duplicates share the step's timeout
+                response, hedged = await asyncio.wait_for(
+                    self._hedged_call(prompt, model, prompt_tokens_estimate, usage), timeout=timeout
+                )
+
+                # process OpenAI response
+                prompt_tokens += response.usage.prompt_tokens
+                completion_tokens += response.usage.completion_tokens
+
+                # the responding request is charged its reported usage instead of the estimate
+                if usage is not None:
+                    usage[model][1] += response.usage.prompt_tokens - prompt_tokens_estimate
+                    usage[model][2] += response.usage.completion_tokens
+                response_text = response.choices[0].message.content
+                pred_msg_class = str(response_text).strip().lower()
 
-            # process OpenAI response
-            prompt_tokens = response.usage.prompt_tokens
-            completion_tokens = response.usage.completion_tokens
-            response_text = response.choices[0].message.content
-            pred_msg_class = str(response_text).strip().lower()
-            time_spent = round(time.time() - start_time, 2)
+                if pred_msg_class in self.msg_classes:
+                    used_model, process_status = model, 'ok'
+                    logger.debug('Succesfully received a response from OpenAI')
+                    break
 
-            if pred_msg_class not in self.msg_classes:
                 pred_msg_class = None
-                process_status = f'Couldn\'t interpret the OpenAI response: {response_text}'
+                process_status = f'Couldn\'t interpret the {model} response: {response_text}'
                 logger.error(process_status)
 
-            logger.debug('Succesfully received a response from OpenAI')
+            except asyncio.TimeoutError:
+                # if the request times out
+                self.counters['timeouts'] += 1
+                process_status = f'The response of {model} timed out and was aborted after {timeout} sec.'
+                logger.error(process_status)
+            except OpenAIError as e:
+                self.counters['errors'] += 1
+                process_status = f'OpenAI API Error: {e}'
+                logger.exception(process_status)
+            except Exception as e:
+                self.counters['errors'] += 1
+                process_status = f'An unexpected error occurred: {e}'
+                logger.exception(process_status)
 
-        except asyncio.TimeoutError:
-            # if the request times out
-            time_spent = round(time.time() - start_time, 2)
-            process_status = f'The response timed out and was aborted after {self.timelimit} sec.'
-            logger.error(process_status)
-        except OpenAIError as e:
-            time_spent = round(time.time() - start_time, 2)
-            process_status = f'OpenAI API Error: {e}'
-            logger.exception(process_status)
-        except Exception as e:
-            time_spent = round(time.time() - start_time, 2)
-            process_status = f'An unexpected error occurred: {e}'
-            logger.exception(process_status)
+        if pred_msg_class is None:
+            self.counters['failed'] += 1
+
+        self.counters['messages'] += 1
+
+        if self.counters['messages'] % GPT_POLICY_OPTIONS['report_every'] == 0:
+            logger.info(f'GptClassifier: {self.stats()}')
 
         return {
-            'message': message,
             'msg_class': pred_msg_class,
             'process_status': process_status,
+            'model': used_model,
+            'hedged': hedged,
+            'requests': requests,
             'prompt_tokens': prompt_tokens,
             'completion_tokens': completion_tokens,
-            'time_spent': time_spent
+            'time_spent': round(time.time() - start_time, 2)
         }
 
-    async def _api_call(self, prompt: str):
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        """Returns the time after which a request to the model is hedged, None if hedging is disabled."""
+        if not GPT_POLICY_OPTIONS['hedge_enabled']:
+            return None
+
+        latencies = self._latencies.get(model)
+
+        if latencies is None or len(latencies) < GPT_POLICY_OPTIONS['hedge_min_samples']:
+            return GPT_POLICY_OPTIONS['hedge_initial_delay_s']
+
+        return float(np.quantile(latencies, GPT_POLICY_OPTIONS['hedge_quantile']))
+
+    async def _hedged_call(self, prompt: str, model: str, prompt_tokens: int = 0,
+                           usage: Optional[Dict[str, List[int]]] = None) -> Tuple[object, bool]:
+        """Calls the model and hedges the request with a duplicate once it is slower than the hedge delay.
+
+        Args:
+            prompt: A string representing the prompt to send to the API.
+            model: The model to call.
+            prompt_tokens: The estimated prompt tokens charged to `usage` for every request sent.
+            usage: Optional usage per model, see `predict`.
+
+        Returns:
+            The first successful response and whether it came from the hedged duplicate.
+        """
+        self.counters['requests'] += 1
+        self._charge(usage, model, prompt_tokens)
+        primary = asyncio.create_task(self._api_call(prompt, model))
+        pending = {primary}
+        delay = self._hedge_delay(model)
+
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+
+                if not done and self.counters['hedges'] < GPT_POLICY_OPTIONS['hedge_max_ratio'] * self.counters['requests']:
+                    self.counters['hedges'] += 1
+                    self._charge(usage, model, prompt_tokens)
+                    pending.add(asyncio.create_task(self._api_call(prompt, model)))
+
+            error = None
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters['hedge_wins'] += 1
+
+                        return task.result(), task is not primary
+
+                    error = task.exception()
+
+            raise error
+        finally:
+            # the slower request is cancelled
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _charge(usage: Optional[Dict[str, List[int]]], model: str, prompt_tokens: int):
+        if usage is not None:
+            counts = usage.setdefault(model, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += prompt_tokens
+
+    async def _api_call(self, prompt: str, model: str = GPT_VERSION):
         """Make a call to the OpenAI API.
 
         Args:
             prompt: A string representing the prompt to send to the API.
+            model: The model to call.
 
         Returns:
             The response from the OpenAI API.
         """
-        logger.info("Send a request to the OpenAI API ...")
+        logger.info(f"Send a request to {model} ...")
+        start = time.perf_counter()
+
+        latencies = self._latencies.get(model)
+
+        if latencies is None:
+            latencies = self._latencies[model] = deque(maxlen=GPT_POLICY_OPTIONS['latency_window'])
+
+        try:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                **OPENAI_OPTIONS
+            )
+        except asyncio.CancelledError:
+            # a cancelled request took at least this long, so the tail isn't lost from the window
+            latencies.append(time.perf_counter() - start)
+            raise
 
-        response = await self.client.chat.completions.create(
-            model=GPT_VERSION,
-            messages=[{"role": "user", "content": prompt}],
-            **OPENAI_OPTIONS
-        )
+        latencies.append(time.perf_counter() - start)
 
         return response
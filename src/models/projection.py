@@ -0,0 +1,131 @@
+from typing import Optional
+import numpy as np
+from loguru import logger
+
+
+class EmbeddingProjection:
+    """
+    A linear dimensionality reduction applied to embeddings before they are stored or searched.
+
+    Two methods are supported:
+        - 'pca': projects centred vectors onto the top principal components fitted offline.
+        - 'truncate': keeps the first `dim` components (Matryoshka-style models).
+
+    Attributes:
+        method (str): Projection method, 'pca' or 'truncate'.
+        dim (int): Output dimension.
+        mean (np.ndarray): Mean vector subtracted before projecting (pca only).
+        components (np.ndarray): (dim, input_dim) projection matrix (pca only).
+    """
+    def __init__(self, method: str, dim: int, mean: Optional[np.ndarray] = None, components: Optional[np.ndarray] = None):
+        if method not in ('pca', 'truncate'):
+            raise ValueError(f"Unknown projection method '{method}'.")
+
+        if method == 'pca' and (mean is None or components is None):
+            raise ValueError('PCA projection requires mean and components.')
+
+        self.method = method
+        self.dim = dim
+        self.mean = None if mean is None else mean.astype(np.float32)
+        self.components = None if components is None else components.astype(np.float32)
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, dim: int, method: str = 'pca') -> 'EmbeddingProjection':
+        """
+        Fits a projection on a sample of stored embeddings.
+
+        Args:
+            embeddings (np.ndarray): (n, input_dim) matrix of embeddings.
+            dim (int): Output dimension.
+            method (str): Projection method, 'pca' or 'truncate'.
+
+        Returns:
+            EmbeddingProjection: The fitted projection.
+        """
+        if dim > embeddings.shape[1]:
+            raise ValueError(f'Output dimension {dim} exceeds input dimension {embeddings.shape[1]}.')
+
+        if method == 'truncate':
+            return cls('truncate', dim)
+
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        mean = embeddings.mean(axis=0)
+        _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+
+        return cls('pca', dim, mean, vt[:dim])
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingProjection':
+        """
+        Loads a projection saved with `save`.
+
+        Args:
+            path (str): Path to the .npz file.
+
+        Returns:
+            EmbeddingProjection: The loaded projection.
+        """
+        data = np.load(path)
+        method = str(data['method'])
+
+        if method == 'truncate':
+            return cls(method, int(data['dim']))
+
+        return cls(method, int(data['dim']), data['mean'], data['components'])
+
+    def save(self, path: str):
+        """
+        Saves the projection to a .npz file.
+
+        Args:
+            path (str): Path to the .npz file.
+        """
+        arrays = {'method': np.array(self.method), 'dim': np.array(self.dim)}
+
+        if self.method == 'pca':
+            arrays.update(mean=self.mean, components=self.components)
+
+        np.savez(path, **arrays)
+
+    def transform(self, emb: np.ndarray) -> np.ndarray:
+        """
+        Projects a single embedding or a matrix of embeddings.
+
+        Args:
+            emb (np.ndarray): (input_dim,) vector or (n, input_dim) matrix.
+
+        Returns:
+            np.ndarray: The projected float32 vector(s).
+        """
+        emb = np.asarray(emb, dtype=np.float32)
+
+        if self.method == 'truncate':
+            return np.ascontiguousarray(emb[..., :self.dim])
+
+        return (emb - self.mean) @ self.components.T
+
+
+_projection = None
+_projection_loaded = False
+
+
+def get_projection(path: str) -> Optional[EmbeddingProjection]:
+    """
+    Returns the configured projection, loading it once per process.
+
+    Args:
+        path (str): Path to the .npz file; empty if no projection is configured.
+
+    Returns:
+        Optional[EmbeddingProjection]: The projection or None if embeddings are stored as is.
+    """
+    global _projection, _projection_loaded
+
+    if not _projection_loaded:
+        _projection_loaded = True
+
+        if path:
+            _projection = EmbeddingProjection.load(path)
+            logger.info(f'Loaded {_projection.method} embedding projection to {_projection.dim} dims from {path}')
+
+    return _projection
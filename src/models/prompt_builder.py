@@ -0,0 +1,88 @@
+from typing import Iterable, Tuple
+import tiktoken
+
+
+class PromptBuilder:
+    """
+    Renders classification prompts within a token budget.
+
+    The template is expected to keep the static instructions first, then the class list and the message
+    text last, so that consecutive requests of a user share the longest possible prefix for provider-side
+    prompt caching. Classes are rendered as a sorted, comma-separated list of names and the message text
+    is truncated with the model tokenizer.
+
+    Attributes:
+        template (str): Prompt template with `{msg_classes}` and `{msg_text}` placeholders.
+        max_msg_tokens (int): Maximum number of message text tokens included in the prompt.
+        encoding (tiktoken.Encoding): Tokenizer of the target model.
+    """
+    def __init__(self, template: str, max_msg_tokens: int, model: str):
+        self.template = template
+        self.max_msg_tokens = max_msg_tokens
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('cl100k_base')
+
+        self._classes_key = None
+        self._classes_text = ''
+
+    def render_classes(self, msg_classes: Iterable[str]) -> str:
+        """
+        Renders class names as a deterministic comma-separated list. The last rendering is memoized,
+        as the same user's classes are rendered for every message.
+
+        Args:
+            msg_classes (Iterable[str]): Class names, or a dictionary keyed by class names.
+
+        Returns:
+            str: The rendered class list.
+        """
+        key = tuple(sorted(set(msg_classes)))
+
+        if key != self._classes_key:
+            self._classes_key = key
+            self._classes_text = ', '.join(key)
+
+        return self._classes_text
+
+    def truncate(self, text: str) -> str:
+        """
+        Truncates the text to `max_msg_tokens` tokens.
+
+        Args:
+            text (str): The message text.
+
+        Returns:
+            str: The truncated text.
+        """
+        tokens = self.encoding.encode(text, disallowed_special=())
+
+        if len(tokens) <= self.max_msg_tokens:
+            return text
+
+        return self.encoding.decode(tokens[:self.max_msg_tokens])
+
+    def count_tokens(self, text: str) -> int:
+        """Returns the number of tokens in the text."""
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def build(self, msg_classes: Iterable[str], text: str) -> Tuple[str, int]:
+        """
+        Builds the prompt for a message.
+
+        Args:
+            msg_classes (Iterable[str]): Class names, or a dictionary keyed by class names.
+            text (str): The message text.
+
+        Returns:
+            Tuple[str, int]: The prompt and its number of tokens. The count excludes the few tokens
+            of chat message framing added by the API.
+        """
+        prompt = self.template.format(
+            msg_classes=self.render_classes(msg_classes),
+            msg_text=self.truncate(text)
+        )
+
+        return prompt, self.count_tokens(prompt)
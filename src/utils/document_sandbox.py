@@ -0,0 +1,115 @@
+import os
+import sys
+import asyncio
+import tempfile
+from collections import Counter
+from typing import Optional
+from loguru import logger
+from aiogram import Bot
+from aiogram.types import Document
+from src.config import DOCUMENT_OPTIONS
+from src.utils.documents import document_kind
+
+# the worker is started as `python -m src.utils.documents` from the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class DocumentSandbox:
+    """
+    A singleton pool of sandboxed worker processes extracting the text of documents.
+
+    A document within `doc_max_bytes` is downloaded through the Bot API to a temporary file and parsed by a fresh
+    worker process (see src/utils/documents.py) that limits its own CPU time and address space before opening the
+    file. At most `doc_workers` workers run at once; a worker still running after `doc_timeout_s` is killed. A huge
+    or malformed file thus costs at most one worker's limits and never blocks the event loop or crashes the bot.
+
+    A process per job is used instead of a long-lived pool: a crashed or killed worker needs no pool recovery,
+    and the bot process, which holds the embedding model and its threads, is never forked.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.counters: Counter = Counter()
+            cls._instance._semaphore = asyncio.Semaphore(DOCUMENT_OPTIONS['workers'])
+
+        return cls._instance
+
+    @staticmethod
+    def supports(document: Optional[Document]) -> bool:
+        """Checks whether the text of a document can be extracted."""
+        return (
+            DOCUMENT_OPTIONS['enabled'] and document is not None
+            and document_kind(document.mime_type, document.file_name) is not None
+            and (document.file_size or 0) <= DOCUMENT_OPTIONS['max_bytes']
+        )
+
+    async def extract(self, bot: Bot, document: Document) -> Optional[str]:
+        """
+        Downloads a document and extracts a bounded prefix of its text.
+
+        Args:
+            bot (Bot): The bot used to download the file.
+            document (Document): The document of the message.
+
+        Returns:
+            str: The text of the document, None if it is unsupported, too large or couldn't be parsed.
+        """
+        if not self.supports(document):
+            self.counters['skipped'] += 1
+            return None
+
+        kind = document_kind(document.mime_type, document.file_name)
+        fd, path = tempfile.mkstemp(prefix='zib-doc-', suffix=f'.{kind}')
+        os.close(fd)
+
+        try:
+            await bot.download(document, destination=path)
+
+            # the declared size may be missing
+            if os.path.getsize(path) > DOCUMENT_OPTIONS['max_bytes']:
+                self.counters['skipped'] += 1
+                return None
+
+            async with self._semaphore:
+                return await self._run_worker(path, kind)
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.warning(f'Failed to extract the text of {document.file_name or document.file_id}: {e}')
+            return None
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def _run_worker(self, path: str, kind: str) -> Optional[str]:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-B', '-m', 'src.utils.documents', path, kind,
+            str(DOCUMENT_OPTIONS['text_limit']), str(DOCUMENT_OPTIONS['max_pages']),
+            str(DOCUMENT_OPTIONS['cpu_s']), str(DOCUMENT_OPTIONS['memory_mb']),
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=ROOT_DIR
+        )
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=DOCUMENT_OPTIONS['timeout_s'])
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            logger.warning(f'Document worker killed after {DOCUMENT_OPTIONS["timeout_s"]} s')
+            return None
+        finally:
+            # also when the caller is cancelled, e.g. by the message deadline
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+        if process.returncode != 0:
+            self.counters['failed'] += 1
+            logger.warning(f'Document worker exited with {process.returncode}: {stderr.decode(errors="replace")[-500:]}')
+            return None
+
+        self.counters['extracted'] += 1
+
+        return stdout.decode('utf-8', errors='replace')[:DOCUMENT_OPTIONS['text_limit']] or None
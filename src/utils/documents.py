@@ -0,0 +1,176 @@
+"""
+Text extraction of documents sent to the bot. Runs in a sandboxed worker process started by DocumentSandbox:
+
+    python -m src.utils.documents <path> <kind> <limit> <max_pages> <cpu_s> <memory_mb>
+
+The worker limits its own CPU time and address space before opening the file and writes at most `limit`
+characters of text to stdout. Only the standard library is imported until the file is parsed.
+"""
+import os
+import sys
+import zipfile
+from typing import Optional
+from xml.etree import ElementTree
+
+DOCX_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+# uncompressed size of word/document.xml read at most, against zip bombs
+DOCX_MAX_XML_BYTES = 64 * 1024 * 1024
+
+MIME_KINDS = {
+    'application/pdf': 'pdf',
+    'text/plain': 'txt',
+    'text/markdown': 'md',
+    'text/x-markdown': 'md',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx'
+}
+EXT_KINDS = {'.pdf': 'pdf', '.txt': 'txt', '.md': 'md', '.markdown': 'md', '.docx': 'docx'}
+
+
+def document_kind(mime_type: Optional[str], file_name: Optional[str]) -> Optional[str]:
+    """
+    Determine the supported kind of a document by its MIME type or, failing that, its extension.
+
+    Args:
+        mime_type (str, optional): MIME type reported by Telegram.
+        file_name (str, optional): Original file name.
+
+    Returns:
+        str: 'pdf', 'txt', 'md' or 'docx', None for unsupported documents.
+    """
+    kind = MIME_KINDS.get((mime_type or '').lower())
+
+    if kind is None and file_name:
+        kind = EXT_KINDS.get(os.path.splitext(file_name)[1].lower())
+
+    return kind
+
+
+def extract_plain_text(path: str, limit: int) -> str:
+    """
+    Read the beginning of a text or markdown file.
+
+    Args:
+        path (str): Path of the file.
+        limit (int): Character limit of the output.
+
+    Returns:
+        str: Text of the file; invalid UTF-8 is replaced.
+    """
+    with open(path, 'rb') as f:
+        # a character takes at most 4 bytes in UTF-8
+        return f.read(limit * 4).decode('utf-8', errors='replace')[:limit]
+
+
+def extract_pdf_text(path: str, limit: int, max_pages: int) -> str:
+    """
+    Extract the text of the first pages of a PDF until the limit is reached.
+
+    Args:
+        path (str): Path of the file.
+        limit (int): Character limit of the output.
+        max_pages (int): Number of pages read at most.
+
+    Returns:
+        str: Text of the pages.
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    parts, size = [], 0
+
+    for page in reader.pages[:max_pages]:
+        text = page.extract_text() or ''
+        parts.append(text)
+        size += len(text)
+
+        if size >= limit:
+            break
+
+    return '\n'.join(parts)[:limit]
+
+
+def extract_docx_text(path: str, limit: int) -> str:
+    """
+    Extract the paragraph text of a DOCX file, parsing word/document.xml incrementally until the limit is reached.
+
+    Args:
+        path (str): Path of the file.
+        limit (int): Character limit of the output.
+
+    Returns:
+        str: Text of the paragraphs.
+    """
+    with zipfile.ZipFile(path) as archive:
+        if archive.getinfo('word/document.xml').file_size > DOCX_MAX_XML_BYTES:
+            raise ValueError('word/document.xml is too large')
+
+        paragraphs, current, size = [], [], 0
+
+        with archive.open('word/document.xml') as xml:
+            for _, element in ElementTree.iterparse(xml):
+                if element.tag == f'{DOCX_NS}t' and element.text:
+                    current.append(element.text)
+                elif element.tag == f'{DOCX_NS}p':
+                    paragraph = ''.join(current)
+                    current = []
+
+                    if paragraph:
+                        paragraphs.append(paragraph)
+                        size += len(paragraph) + 1
+
+                    if size >= limit:
+                        break
+
+                    # parsed paragraphs are dropped to keep memory flat
+                    element.clear()
+
+    return '\n'.join(paragraphs)[:limit]
+
+
+def extract_document_text(path: str, kind: str, limit: int = 2000, max_pages: int = 20) -> str:
+    """
+    Extract a bounded text prefix of a document.
+
+    Args:
+        path (str): Path of the file.
+        kind (str): Kind of the document, see `document_kind`.
+        limit (int, optional): Character limit of the output. Defaults to 2000.
+        max_pages (int, optional): Number of PDF pages read at most. Defaults to 20.
+
+    Returns:
+        str: Text of the document.
+    """
+    if kind == 'pdf':
+        return extract_pdf_text(path, limit, max_pages)
+    if kind == 'docx':
+        return extract_docx_text(path, limit)
+    if kind in ('txt', 'md'):
+        return extract_plain_text(path, limit)
+
+    raise ValueError(f'Unsupported document kind: {kind}')
+
+
+def _limit_resources(cpu_s: int, memory_mb: int):
+    import signal
+    import resource
+
+    # lazily imported modules must not try to write bytecode files under the zero file size limit
+    sys.dont_write_bytecode = True
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_s, cpu_s + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
+    # the worker only reads its input file
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+
+
+def main(argv) -> int:
+    path, kind, limit, max_pages, cpu_s, memory_mb = argv
+    _limit_resources(int(cpu_s), int(memory_mb))
+    text = extract_document_text(path, kind, int(limit), int(max_pages))
+    sys.stdout.buffer.write(text.encode('utf-8'))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
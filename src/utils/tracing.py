@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+from loguru import logger
+from src.config import TRACE_OPTIONS
+
+# the trace of the message handled by the current task and the nesting of its open spans, see `trace_message`;
+# tasks started by a traced task copy both, so spans of concurrent stages nest correctly
+_current: contextvars.ContextVar[Optional['MessageTrace']] = contextvars.ContextVar('message_trace', default=None)
+_depth: contextvars.ContextVar[int] = contextvars.ContextVar('trace_depth', default=0)
+
+
+class MessageTrace:
+    """
+    The structured record of one message (or media group) from its arrival at the handler until it is sorted.
+
+    Spans are stage start and end offsets in milliseconds from the arrival, nested spans have a greater depth.
+    Attributes describe the message's path (duplicate, classified by, category, outcome), counters add up cache
+    hits, retries and tokens. Message texts are never recorded.
+
+    Attributes:
+        handler (str): The handler, e.g. 'text', 'media_group' or 'media'.
+        user_id (int): The user the message belongs to.
+        chat_id (int): The chat of the message.
+        msg_ids (List[int]): The message identifiers, several for a media group.
+        attrs (Dict): Attributes of the message's path.
+        counters (Counter): Cache hits, retries, tokens and deadline misses.
+        spans (List[Dict]): Stage spans in the order they started.
+    """
+    __slots__ = ('handler', 'user_id', 'chat_id', 'msg_ids', 'attrs', 'counters', 'spans', 'started', '_start')
+
+    def __init__(self, handler: str, user_id: int, chat_id: int, msg_ids: List[int]):
+        self.handler = handler
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.msg_ids = msg_ids
+        self.attrs: Dict = {}
+        self.counters: Counter = Counter()
+        self.spans: List[Dict] = []
+        self.started = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000, 2)
+
+    def record(self) -> Dict:
+        """Returns a copy for the writer thread; stages still running, e.g. shared link fetches, have no end."""
+        return {
+            'ts': self.started.isoformat(timespec='milliseconds'),
+            'handler': self.handler,
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'msg_ids': self.msg_ids,
+            'total_ms': self.elapsed_ms(),
+            'attrs': dict(self.attrs),
+            'counters': dict(self.counters),
+            'spans': [dict(span) for span in self.spans]
+        }
+
+
+class TraceWriter:
+    """
+    A singleton background writer of trace records to a rotating JSON lines file.
+
+    `write` only puts the record on a bounded queue, so the event loop never waits for the disk; a daemon thread
+    serialises the records and appends them to `trace_path`, which is rotated at `trace_max_mb` with
+    `trace_backups` old files kept. Records that find the queue full are dropped and counted.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._queue = queue.Queue(maxsize=TRACE_OPTIONS['queue_size'])
+            cls._instance._thread: Optional[threading.Thread] = None
+            cls._instance._lock = threading.Lock()
+            cls._instance.counters: Counter = Counter()
+
+        return cls._instance
+
+    def write(self, record: Dict):
+        """Queues a record for writing without blocking."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                    self._thread.start()
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+            if self.counters['dropped'] % 1000 == 1:
+                logger.warning(f'Trace queue is full, {self.counters["dropped"]} records dropped so far')
+
+    def close(self, timeout: float = 5.0):
+        """Writes the queued records and stops the writer thread."""
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        os.makedirs(os.path.dirname(os.path.abspath(TRACE_OPTIONS['path'])), exist_ok=True)
+        handler = RotatingFileHandler(
+            TRACE_OPTIONS['path'], maxBytes=TRACE_OPTIONS['max_bytes'], backupCount=TRACE_OPTIONS['backups'],
+            encoding='utf-8', delay=True
+        )
+
+        try:
+            while True:
+                record = self._queue.get()
+
+                if record is None:
+                    break
+
+                try:
+                    line = json.dumps(record, ensure_ascii=False, default=str)
+                    handler.emit(logging.makeLogRecord({'msg': line, 'levelno': logging.INFO}))
+                    self.counters['written'] += 1
+                except Exception as e:
+                    self.counters['errors'] += 1
+                    logger.warning(f'Failed to write a trace record: {e}')
+        finally:
+            handler.close()
+
+
+@contextmanager
+def trace_message(handler: str, user_id: int, chat_id: int, msg_ids: List[int], **attrs):
+    """
+    Traces a message handler call; a `trace_rate` share of the calls is traced when `trace_enabled` is set.
+    The outcome is 'sorted' once the message is moved, 'error' if the handler raised, and otherwise set by the
+    handler or left 'incomplete'.
+
+    Args:
+        handler (str): The handler name.
+        user_id (int): The user the message belongs to.
+        chat_id (int): The chat of the message.
+        msg_ids (List[int]): The message identifiers.
+        **attrs: Attributes of the message, e.g. its content type.
+
+    Yields:
+        MessageTrace: The trace, None if the call isn't traced.
+    """
+    if not TRACE_OPTIONS['enabled'] or random.random() >= TRACE_OPTIONS['rate']:
+        yield None
+        return
+
+    trace = MessageTrace(handler, user_id, chat_id, msg_ids)
+    trace.attrs.update(attrs)
+    token = _current.set(trace)
+
+    try:
+        yield trace
+    except BaseException as e:
+        trace.attrs['outcome'] = 'error'
+        trace.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        trace.attrs.setdefault('outcome', 'incomplete')
+        TraceWriter().write(trace.record())
+
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """
+    Records a stage span in the trace of the current message, if any; an exception leaving the span is recorded
+    as its error.
+
+    Args:
+        name (str): The stage name.
+        **attrs: Attributes of the span.
+
+    Yields:
+        Dict: The span, to add attributes known at its end; None if the message isn't traced.
+    """
+    trace = _current.get()
+
+    if trace is None:
+        yield None
+        return
+
+    depth = _depth.get()
+    span = {'name': name, 'depth': depth, 'start_ms': trace.elapsed_ms(), **attrs}
+    trace.spans.append(span)
+    depth_token = _depth.set(depth + 1)
+
+    try:
+        yield span
+    except BaseException as e:
+        span['error'] = type(e).__name__
+        raise
+    finally:
+        _depth.reset(depth_token)
+        span['end_ms'] = trace.elapsed_ms()
+
+
+def trace_set(**attrs):
+    """Sets attributes of the current message's trace, if any."""
+    trace = _current.get()
+
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def trace_add(key: str, value: int = 1):
+    """Adds to a counter of the current message's trace, if any."""
+    trace = _current.get()
+
+    if trace is not None and value:
+        trace.counters[key] += value
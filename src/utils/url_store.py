@@ -0,0 +1,225 @@
+import os
+import time
+import uuid
+import socket
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+import numpy as np
+from loguru import logger
+from src.config import URL_CONTENT_OPTIONS
+from src.utils.tracing import trace_add
+from src.utils.utils import fetch_text_from_url, extract_description_from_yt, is_youtube_url
+from database.url_content import UrlContentController, UrlContent, canonical_url, url_hash
+
+
+class UrlStore:
+    """
+    A singleton front of `zib.url_content`, the extracted text of links shared by all users and bot replicas.
+
+    A link is looked up in the table before any network request. Fetches are single-flight: concurrent requests
+    for a link in this process share one task, and across replicas the one holding the row's lease fetches while
+    the others poll the row for up to `url_cache_lease_s`. Entries older than `url_cache_ttl_s` are served as is
+    and revalidated in the background with the stored ETag/Last-Modified headers.
+
+    The shared task isn't cancelled with its callers, so a link abandoned by a message out of budget is still
+    stored for the next one.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            cls._instance.counters: Counter = Counter()
+            cls._instance._inflight: Dict[int, asyncio.Task] = {}
+            cls._instance._refreshing: Set[asyncio.Task] = set()
+            cls._instance._executor = ThreadPoolExecutor(URL_CONTENT_OPTIONS['fetch_threads'], thread_name_prefix='url-fetch')
+
+        return cls._instance
+
+    async def get(self, url: str, youtube: bool = False) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Returns the text of a link and its stored embedding, fetching the link if it isn't stored.
+
+        Args:
+            url (str): The link as sent by the user.
+            youtube (bool): Extract the video title and description instead of the page paragraphs.
+
+        Returns:
+            Tuple[Optional[str], Optional[np.ndarray]]: The text (None if the link couldn't be fetched) and
+            its embedding by the current model version (None if not computed yet).
+        """
+        if not URL_CONTENT_OPTIONS['enabled']:
+            try:
+                return await self._fetch_text(url, youtube), None
+            except Exception as e:
+                logger.warning(f'Failed to fetch {url}: {e}')
+                return None, None
+
+        try:
+            canonical = canonical_url(url)
+        except ValueError as e:
+            logger.warning(f'Skipped the malformed link {url}: {e}')
+            return None, None
+
+        key = url_hash(canonical)
+        task = self._inflight.get(key)
+
+        if task is None:
+            self.counters['loads'] += 1
+            trace_add('url_loads')
+            task = self._inflight[key] = asyncio.create_task(self._load(key, canonical, url, youtube))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.counters['joined'] += 1
+            trace_add('url_joined')
+
+        return await asyncio.shield(task)
+
+    async def get_many(self, urls: Sequence[str], timeout: float) -> List[Optional[Tuple[Optional[str], Optional[np.ndarray]]]]:
+        """
+        Returns the texts and embeddings of several links fetched concurrently within a shared timeout.
+
+        Args:
+            urls (Sequence[str]): The links as sent by the user; YouTube links get the video description.
+            timeout (float): Seconds to wait for all links together.
+
+        Returns:
+            List[Optional[Tuple[Optional[str], Optional[np.ndarray]]]]: The (text, embedding) pair of `get` for
+            every link, None for links not fetched in time, whose fetches go on and are stored for later messages,
+            and for links whose lookup failed.
+        """
+        tasks = [asyncio.ensure_future(self.get(url, youtube=is_youtube_url(url))) for url in urls]
+
+        if not tasks:
+            return []
+
+        await asyncio.wait(tasks, timeout=max(timeout, 0))
+        results = []
+
+        for url, task in zip(urls, tasks):
+            if task.done():
+                if task.exception() is not None:
+                    logger.warning(f'Failed to get {url}: {task.exception()}')
+                    results.append(None)
+                else:
+                    results.append(task.result())
+            else:
+                # cancels the wait for the shared fetch, not the fetch itself
+                task.cancel()
+                results.append(None)
+
+        return results
+
+    def save_embedding(self, url: str, emb: np.ndarray):
+        """
+        Stores the embedding of a link's text, so that later messages with the link skip the embedder.
+
+        Args:
+            url (str): The link as sent by the user.
+            emb (np.ndarray): The embedding of the text returned by `get`, lowercased and stripped.
+        """
+        if not URL_CONTENT_OPTIONS['enabled']:
+            return
+
+        try:
+            UrlContentController.save_embedding(url_hash(canonical_url(url)), emb)
+        except ValueError as e:
+            logger.warning(f'Skipped the embedding of the malformed link {url}: {e}')
+
+    async def _load(self, key: int, canonical: str, url: str, youtube: bool) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        row = UrlContentController.get_content(key)
+
+        if row is not None and row.content is not None:
+            self.counters['hits'] += 1
+            trace_add('url_cache_hits')
+
+            if row.age_s is not None and row.age_s > URL_CONTENT_OPTIONS['ttl_s'] and not row.leased:
+                self._refresh_in_background(key, canonical, url, youtube, row)
+
+            return row.content, row.emb
+
+        return await self._fetch_or_wait(key, canonical, url, youtube)
+
+    async def _fetch_or_wait(self, key: int, canonical: str, url: str, youtube: bool) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        give_up = time.monotonic() + URL_CONTENT_OPTIONS['lease_s']
+
+        while True:
+            if UrlContentController.claim(key, canonical, self.owner, URL_CONTENT_OPTIONS['lease_s']):
+                self.counters['fetches'] += 1
+                trace_add('url_fetches')
+                return await self._fetch(key, canonical, url, youtube, None), None
+
+            # another replica is fetching the link
+            self.counters['waits'] += 1
+            trace_add('url_waits')
+            await asyncio.sleep(URL_CONTENT_OPTIONS['poll_s'])
+            row = UrlContentController.get_content(key)
+
+            if row is not None and row.content is not None:
+                return row.content, row.emb
+
+            if time.monotonic() > give_up:
+                return None, None
+
+    async def _fetch(self, key: int, canonical: str, url: str, youtube: bool, row: Optional[UrlContent]) -> Optional[str]:
+        """Fetches the link under this replica's lease and stores the result; a failed fetch releases the lease."""
+        try:
+            if youtube:
+                content, etag, last_modified = await self._fetch_text(url, youtube), None, None
+
+                if not content:
+                    raise ValueError('no video description')
+            else:
+                content, etag, last_modified = await self._run(
+                    fetch_text_from_url, self._absolute(url), URL_CONTENT_OPTIONS['text_limit'],
+                    URL_CONTENT_OPTIONS['fetch_timeout_s'],
+                    row.etag if row is not None else None, row.last_modified if row is not None else None
+                )
+        except Exception as e:
+            self.counters['errors'] += 1
+            trace_add('url_errors')
+            logger.warning(f'Failed to fetch {canonical}: {e}')
+            UrlContentController.release(key, self.owner)
+            return row.content if row is not None else None
+
+        if content is None:
+            # 304 Not Modified
+            UrlContentController.revalidate(key)
+            return row.content
+
+        UrlContentController.save_content(key, canonical, content, etag, last_modified)
+
+        return content
+
+    def _refresh_in_background(self, key: int, canonical: str, url: str, youtube: bool, row: UrlContent):
+        async def refresh():
+            if UrlContentController.claim(key, canonical, self.owner, URL_CONTENT_OPTIONS['lease_s']):
+                self.counters['refreshes'] += 1
+                await self._fetch(key, canonical, url, youtube, row)
+
+        task = asyncio.create_task(refresh())
+        self._refreshing.add(task)
+        task.add_done_callback(self._refreshing.discard)
+
+    async def _fetch_text(self, url: str, youtube: bool) -> Optional[str]:
+        if youtube:
+            return await self._run(extract_description_from_yt, url) or None
+
+        content, _, _ = await self._run(
+            fetch_text_from_url, self._absolute(url), URL_CONTENT_OPTIONS['text_limit'], URL_CONTENT_OPTIONS['fetch_timeout_s']
+        )
+
+        return content
+
+    async def _run(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    @staticmethod
+    def _absolute(url: str) -> str:
+        url = url.strip()
+
+        return url if '://' in url else 'https://' + url
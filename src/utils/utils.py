@@ -1,21 +1,222 @@
+from typing import List, Optional, Sequence, Tuple
 from bs4 import BeautifulSoup
 import requests
 from pytube import YouTube
 
+# characters around a link that belong to the sentence rather than the link
+URL_STRIP_CHARS = '()[]{}<>"\'«»“”.,;:!?'
+YT_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'youtu.be')
 
-def extract_text_from_url(url: str, limit: int = 2000) -> str:
+# top-level domains of links written without a scheme, `www.` or a path, so that file names such as `main.py` or
+# `report.pdf` aren't fetched; country codes that are common file extensions (py, md, sh, rs, pl, ...) are left out
+BARE_TLDS = frozenset((
+    'com', 'org', 'net', 'info', 'biz', 'edu', 'gov', 'int', 'io', 'ai', 'app', 'dev', 'me', 'co', 'tv', 'fm', 'gg',
+    'ly', 'to', 'cc', 'xyz', 'site', 'online', 'store', 'shop', 'tech', 'blog', 'news', 'pro', 'club', 'live', 'link',
+    'ru', 'su', 'рф', 'ua', 'by', 'kz', 'uz', 'kg', 'am', 'ge', 'az', 'ee', 'lv', 'lt', 'fi', 'se', 'no', 'dk',
+    'de', 'at', 'ch', 'nl', 'be', 'fr', 'es', 'pt', 'it', 'gr', 'cz', 'sk', 'hu', 'ro', 'bg', 'hr', 'si',
+    'uk', 'ie', 'eu', 'us', 'ca', 'mx', 'br', 'ar', 'cl', 'au', 'nz', 'jp', 'kr', 'cn', 'hk', 'tw', 'sg', 'in', 'il',
+    'tr', 'ae', 'za'
+))
+
+
+def _host(token: str) -> str:
+    return token.split('/', 1)[0].split('?', 1)[0].split('#', 1)[0]
+
+
+def _valid_port(host: str) -> bool:
+    """Checks the port of a host, if any: `utils.py:extract` or `site.ru:99999` aren't links."""
+    if host.startswith('[') or ':' not in host:
+        return True
+
+    port = host.rsplit(':', 1)[1]
+
+    return port == '' or (port.isdigit() and int(port) <= 65535)
+
+
+def _is_url(token: str) -> bool:
+    if token.startswith(('http://', 'https://')):
+        rest = token[token.index('://') + 3:]
+        return bool(rest) and _valid_port(_host(rest).rsplit('@', 1)[-1])
+
+    host = _host(token)
+
+    if '@' in host or '.' not in host or not _valid_port(host):
+        return False
+
+    has_path = token[len(host):].startswith('/')
+    host = host.split(':', 1)[0].lower()
+    labels = host.split('.')
+    tld = labels[-1]
+
+    if not (2 <= len(tld) <= 6 and tld.isalpha() and all(label and all(c.isalnum() or c == '-' for c in label) for label in labels)):
+        return False
+
+    return host.startswith('www.') or has_path or tld in BARE_TLDS
+
+
+def find_urls(text: str) -> List[str]:
     """
-    Extract text from provided URL.
+    Find the links in a text in linear time: every whitespace-separated token is checked once, without regular
+    expressions. A token is a link if it starts with http(s):// or its host part is a dotted domain name with
+    a 2 to 6 letter top-level domain; without a scheme, it also needs a `www.` prefix, a path or a top-level
+    domain from BARE_TLDS, so that file names aren't taken for links.
+
+    Args:
+        text (str): Text to scan.
+
+    Returns:
+        List[str]: Links in the order of appearance, with surrounding punctuation stripped.
+    """
+    urls = []
+
+    for token in text.split():
+        # most words have no dot and are rejected before any parsing
+        if '.' not in token:
+            continue
+
+        token = token.strip(URL_STRIP_CHARS)
+
+        if token and _is_url(token):
+            urls.append(token)
+
+    return urls
+
+
+def extract_urls(text: str, entities: Optional[Sequence] = None) -> List[str]:
+    """
+    Extract the links of a Telegram message: `url` and `text_link` entities if the message has any,
+    otherwise the links found by `find_urls`.
+
+    Args:
+        text (str): Text or caption of the message.
+        entities (Sequence, optional): `entities` or `caption_entities` of the message.
+
+    Returns:
+        List[str]: Distinct links in the order of appearance.
+    """
+    urls = []
+
+    if entities:
+        # entity offsets are in UTF-16 code units
+        encoded = text.encode('utf-16-le')
+
+        for entity in entities:
+            if entity.type == 'url':
+                urls.append(encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le'))
+            elif entity.type == 'text_link' and entity.url:
+                urls.append(entity.url)
+    else:
+        urls = find_urls(text)
+
+    return list(dict.fromkeys(urls))
+
+
+def strip_urls(text: str, urls: Sequence[str]) -> str:
+    """
+    Remove the given links from a text, leaving the user's own words.
+
+    Args:
+        text (str): Text of the message.
+        urls (Sequence[str]): Links to remove.
+
+    Returns:
+        str: The text without the links and with collapsed whitespace.
+    """
+    for url in urls:
+        text = text.replace(url, ' ')
+
+    return ' '.join(text.split())
+
+
+def is_youtube_url(url: str) -> bool:
+    """
+    Check whether a link points to a YouTube video.
+
+    Args:
+        url (str): Link to check.
+
+    Returns:
+        bool: True for youtube.com and youtu.be links.
+    """
+    host = url.split('://', 1)[-1].split('/', 1)[0].split('?', 1)[0].lower()
+
+    return host in YT_HOSTS
+
+
+def merge_enriched_text(own_text: str, link_texts: Sequence[str], limit: int = 2000) -> str:
+    """
+    Merge the user's own text with the text of the linked pages into a classification input of at most `limit`
+    characters. The own text comes first; the rest of the limit is shared equally by the pages, and the share
+    a short page doesn't use goes to the longer ones.
+
+    Args:
+        own_text (str): Text of the message without its links.
+        link_texts (Sequence[str]): Extracted texts of the links.
+        limit (int, optional): Character limit of the result. Defaults to 2000.
+
+    Returns:
+        str: The merged text.
+    """
+    parts = [own_text[:limit]] if own_text else []
+    left = limit - sum(len(part) + 1 for part in parts)
+    link_texts = [text for text in link_texts if text]
+    shares = [0] * len(link_texts)
+    order = sorted(range(len(link_texts)), key=lambda i: len(link_texts[i]))
+
+    for n, i in enumerate(order):
+        share = max(left, 0) // (len(order) - n)
+        shares[i] = min(len(link_texts[i]), share)
+        left -= shares[i] + 1
+
+    parts.extend(text[:share] for text, share in zip(link_texts, shares) if share > 0)
+
+    return '\n'.join(parts)
+
+
+def fetch_text_from_url(url: str, limit: int = 2000, timeout: float = None, etag: Optional[str] = None,
+                        last_modified: Optional[str] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Extract text from provided URL with a conditional request revalidating a previously fetched copy.
 
     Args:
         url (str): URL to parse.
         limit (int, optional): Word limit in the output. Defaults to 2000.
+        timeout (float, optional): Connect and read timeout of the request in seconds. Defaults to none.
+        etag (str, optional): ETag of the previously fetched copy.
+        last_modified (str, optional): Last-Modified header of the previously fetched copy.
 
     Returns:
-        str: Parsed text from the URL.
+        Tuple[Optional[str], Optional[str], Optional[str]]: Parsed text from the URL (None if the page is not
+        modified since the previous copy), its ETag and Last-Modified headers.
+    """
+    headers = {}
+
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = requests.get(url, timeout=timeout, headers=headers)
+
+    if response.status_code == 304:
+        return None, etag, last_modified
+
+    response.raise_for_status()
+
+    return extract_text_from_html(response.text, limit), response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def extract_text_from_html(content: str, limit: int = 2000) -> str:
     """
-    content = requests.get(url).text
+    Extract the paragraph text of an HTML page.
 
+    Args:
+        content (str): HTML of the page.
+        limit (int, optional): Word limit in the output. Defaults to 2000.
+
+    Returns:
+        str: Parsed text of the page.
+    """
     soup = BeautifulSoup(content, "html.parser")
     paragraphs = soup.find_all("p")
     text = "\n".join([p.get_text() for p in paragraphs])[:limit]